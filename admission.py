@@ -0,0 +1,318 @@
+import json
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+import redis
+from placement import replica_room
+from queue_backends import get_connection_pool
+
+# Per-organization limits; None means unlimited. ram, cpu, gpu and deployments cap
+# what the organization has queued or running, submissions_per_minute how many
+# deployments it may submit per minute.
+Quota = namedtuple('Quota', ['ram', 'cpu', 'gpu', 'deployments', 'submissions_per_minute'],
+                   defaults=(None,) * 5)
+
+# Outcome of admission control for one submitted deployment: reason is None if it
+# was admitted, otherwise 'infeasible', 'quota' or 'rate_limited' with a message.
+# estimate is the expected wait in seconds before it starts, None if unknown.
+Admission = namedtuple('Admission', ['estimate', 'reason', 'message'])
+
+# Width of the windows submissions and placements are counted in
+RATE_WINDOW_SECONDS = 60
+
+# Placements are averaged over this many windows to estimate throughput
+PLACEMENT_RATE_WINDOWS = 5
+
+# Usage fields, in the order of Quota and of usage records
+USAGE_FIELDS = ('ram', 'cpu', 'gpu', 'deployments')
+
+# Checks a batch of demands against an organization's quota and submission rate,
+# adding the admitted ones to its usage in one step.
+# KEYS: usage hash, rate counter. ARGV: limits for ram, cpu, gpu, deployments and
+# submissions (-1 for unlimited), counter TTL, then ram, cpu, gpu per demand.
+# Returns per demand 0 if admitted, 1-4 for the USAGE_FIELDS limit exceeded, 5 for the rate.
+ADMIT_SCRIPT = """
+local limits = {tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])}
+local rate_limit = tonumber(ARGV[5])
+local usage = redis.call('HMGET', KEYS[1], 'ram', 'cpu', 'gpu', 'deployments')
+for k = 1, 4 do
+  usage[k] = tonumber(usage[k]) or 0
+end
+local submitted = tonumber(redis.call('GET', KEYS[2])) or 0
+local results = {}
+local admitted = 0
+for i = 7, #ARGV, 3 do
+  local demand = {tonumber(ARGV[i]), tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2]), 1}
+  local code = 0
+  if rate_limit >= 0 and submitted + 1 > rate_limit then
+    code = 5
+  end
+  for k = 1, 4 do
+    if code == 0 and limits[k] >= 0 and usage[k] + demand[k] > limits[k] then
+      code = k
+    end
+  end
+  if code == 0 then
+    for k = 1, 4 do
+      usage[k] = usage[k] + demand[k]
+    end
+    submitted = submitted + 1
+    admitted = admitted + 1
+  end
+  results[#results + 1] = code
+end
+if admitted > 0 then
+  redis.call('HSET', KEYS[1], 'ram', usage[1], 'cpu', usage[2], 'gpu', usage[3], 'deployments', usage[4])
+  redis.call('INCRBY', KEYS[2], admitted)
+  redis.call('EXPIRE', KEYS[2], ARGV[6])
+end
+return results
+"""
+
+
+def parse_quotas(text):
+    """
+    Parses the ORG_QUOTAS setting, a JSON object mapping organization IDs (and
+    'default', for every other organization) to Quota fields, e.g.
+    {"default": {"gpu": 16}, "3": {"gpu": 64, "submissions_per_minute": 600}}.
+    Organization entries override the default field by field. Returns
+    {organization_id or 'default': Quota}; raises ValueError if malformed.
+    """
+    entries = json.loads(text) if text else {}
+    if not isinstance(entries, dict):
+        raise ValueError("ORG_QUOTAS must be a JSON object")
+    for key, limits in entries.items():
+        if not isinstance(limits, dict) or set(limits) - set(Quota._fields):
+            raise ValueError(f"ORG_QUOTAS[{key!r}] must be an object with fields from {', '.join(Quota._fields)}")
+    default = entries.get('default', {})
+    quotas = {'default': Quota(**default)}
+    for key, limits in entries.items():
+        if key != 'default':
+            quotas[int(key)] = Quota(**{**default, **limits})
+    return quotas
+
+
+def quota_for(quotas, organization_id):
+    """Returns the Quota of an organization under parse_quotas() output."""
+    return quotas.get(organization_id) or quotas.get('default') or Quota()
+
+
+def fits(request, replicas, capacities):
+    """
+    True if replicas copies of request (ram, cpu, gpu) fit in the given
+    (ram, cpu, gpu) capacities, spread over them as the placement engine may.
+    """
+    if not len(capacities):
+        return False
+    return int(replica_room(np.asarray(request), np.asarray(capacities), replicas).sum()) >= replicas
+
+
+def estimate_start_seconds(ahead, fits_now, placement_rate):
+    """
+    Estimates how long a deployment waits before it starts: no wait if it fits
+    the free capacity with nothing of equal or higher priority queued ahead of it,
+    otherwise the time the scheduler takes, at its recent placement rate
+    (deployments per second), to start those ahead and then it. None if there
+    have been no recent placements to go by.
+    """
+    if fits_now and not ahead:
+        return 0.0
+    if not placement_rate:
+        return None
+    return (ahead + 1) / placement_rate
+
+
+class UsageTable:
+    """
+    Per-organization usage cached outside the database, so that quotas and rate
+    limits are checked at submission without summing the deployments table. It
+    also counts recent placements, from which time-to-start is estimated. Usage
+    is added when deployments are admitted and removed when they finish, and
+    load() periodically replaces it with totals computed from the database.
+    """
+
+    @property
+    def loaded(self):
+        """True once usage has been filled from the database."""
+        raise NotImplementedError
+
+    def load(self, rows):
+        """Replaces all usage with (organization_id, ram, cpu, gpu, deployments) rows."""
+        raise NotImplementedError
+
+    def usage(self, organization_id):
+        """Returns the organization's (ram, cpu, gpu, deployments) queued or running."""
+        raise NotImplementedError
+
+    def admit(self, organization_id, demands, quota):
+        """
+        Checks (ram, cpu, gpu) demands, one per deployment and in order, against
+        the organization's quota, adding each one admitted to its usage and
+        submission count. Returns per demand None if admitted, or the name of the
+        Quota field it would exceed.
+        """
+        raise NotImplementedError
+
+    def release(self, organization_id, ram, cpu, gpu, deployments=1):
+        """Removes finished deployments' resources from the organization's usage."""
+        raise NotImplementedError
+
+    def record_placements(self, count):
+        """Counts deployments the scheduler placed."""
+        raise NotImplementedError
+
+    def placement_rate(self):
+        """Returns the deployments placed per second over the last PLACEMENT_RATE_WINDOWS windows."""
+        raise NotImplementedError
+
+
+def _window(now=None):
+    return int((time.time() if now is None else now) // RATE_WINDOW_SECONDS)
+
+
+class InProcessUsageTable(UsageTable):
+    def __init__(self):
+        """Keeps usage in this process's memory, for the in-process queue backend and tests."""
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._submissions = {}
+        self._placements = {}
+        self._loaded = False
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, rows):
+        with self._lock:
+            self._usage = {organization_id: [ram or 0, cpu or 0, gpu or 0, deployments or 0]
+                           for organization_id, ram, cpu, gpu, deployments in rows}
+            self._loaded = True
+
+    def usage(self, organization_id):
+        with self._lock:
+            return tuple(self._usage.get(organization_id, (0, 0, 0, 0)))
+
+    def admit(self, organization_id, demands, quota):
+        window = _window()
+        limits = quota[:len(USAGE_FIELDS)]
+        results = []
+        with self._lock:
+            usage = self._usage.setdefault(organization_id, [0, 0, 0, 0])
+            submitted = self._submissions.get((organization_id, window), 0)
+            for demand in demands:
+                demand = (*demand, 1)
+                if quota.submissions_per_minute is not None and submitted + 1 > quota.submissions_per_minute:
+                    results.append('submissions_per_minute')
+                    continue
+                exceeded = next((field for field, used, amount, limit in zip(USAGE_FIELDS, usage, demand, limits)
+                                 if limit is not None and used + amount > limit), None)
+                if exceeded is None:
+                    usage[:] = [used + amount for used, amount in zip(usage, demand)]
+                    submitted += 1
+                results.append(exceeded)
+            # Only the current window is ever read again
+            self._submissions = {key: count for key, count in self._submissions.items() if key[1] == window}
+            self._submissions[(organization_id, window)] = submitted
+        return results
+
+    def release(self, organization_id, ram, cpu, gpu, deployments=1):
+        with self._lock:
+            usage = self._usage.setdefault(organization_id, [0, 0, 0, 0])
+            usage[:] = [used - amount for used, amount in zip(usage, (ram, cpu, gpu, deployments))]
+
+    def record_placements(self, count):
+        if not count:
+            return
+        window = _window()
+        with self._lock:
+            self._placements = {key: placed for key, placed in self._placements.items()
+                                if key > window - PLACEMENT_RATE_WINDOWS}
+            self._placements[window] = self._placements.get(window, 0) + count
+
+    def placement_rate(self):
+        window = _window()
+        with self._lock:
+            placed = sum(placed for key, placed in self._placements.items() if key > window - PLACEMENT_RATE_WINDOWS)
+        return placed / (PLACEMENT_RATE_WINDOWS * RATE_WINDOW_SECONDS)
+
+
+class RedisUsageTable(UsageTable):
+    def __init__(self, host='localhost', port=6379, max_connections=None, name='usage'):
+        """
+        Keeps usage in Redis, one hash per organization, so that every API process
+        enforces the same quotas. Quota checks run as a Lua script, so concurrent
+        submissions from several processes cannot together exceed a quota.
+        """
+        self.redis = redis.Redis(connection_pool=get_connection_pool(host, port, 0, max_connections))
+        self._admit_script = self.redis.register_script(ADMIT_SCRIPT)
+        self.name = name
+        self.loaded_name = f'{name}:loaded'
+
+    def _usage_key(self, organization_id):
+        return f'{self.name}:organization:{organization_id}'
+
+    def _submissions_key(self, organization_id, window):
+        return f'{self.name}:submissions:{organization_id}:{window}'
+
+    def _placements_key(self, window):
+        return f'{self.name}:placements:{window}'
+
+    @property
+    def loaded(self):
+        return bool(self.redis.exists(self.loaded_name))
+
+    def load(self, rows):
+        stale = [key.decode() for key in self.redis.scan_iter(match=f'{self.name}:organization:*')]
+        pipe = self.redis.pipeline()
+        if stale:
+            pipe.delete(*stale)
+        for organization_id, ram, cpu, gpu, deployments in rows:
+            pipe.hset(self._usage_key(organization_id), mapping={
+                'ram': ram or 0, 'cpu': cpu or 0, 'gpu': gpu or 0, 'deployments': deployments or 0})
+        pipe.set(self.loaded_name, 1)
+        pipe.execute()
+
+    def usage(self, organization_id):
+        values = self.redis.hmget(self._usage_key(organization_id), *USAGE_FIELDS)
+        return tuple(int(value or 0) for value in values)
+
+    def admit(self, organization_id, demands, quota):
+        limits = [-1 if limit is None else limit for limit in quota]
+        args = limits + [2 * RATE_WINDOW_SECONDS] + [amount for demand in demands for amount in demand]
+        codes = self._admit_script(
+            keys=[self._usage_key(organization_id), self._submissions_key(organization_id, _window())], args=args)
+        return [None if not code else (USAGE_FIELDS + ('submissions_per_minute',))[int(code) - 1] for code in codes]
+
+    def release(self, organization_id, ram, cpu, gpu, deployments=1):
+        key = self._usage_key(organization_id)
+        pipe = self.redis.pipeline()
+        for field, amount in zip(USAGE_FIELDS, (ram, cpu, gpu, deployments)):
+            pipe.hincrby(key, field, -amount)
+        pipe.execute()
+
+    def record_placements(self, count):
+        if not count:
+            return
+        key = self._placements_key(_window())
+        pipe = self.redis.pipeline()
+        pipe.incrby(key, count)
+        pipe.expire(key, (PLACEMENT_RATE_WINDOWS + 1) * RATE_WINDOW_SECONDS)
+        pipe.execute()
+
+    def placement_rate(self):
+        window = _window()
+        counts = self.redis.mget([self._placements_key(window - k) for k in range(PLACEMENT_RATE_WINDOWS)])
+        return sum(int(count or 0) for count in counts) / (PLACEMENT_RATE_WINDOWS * RATE_WINDOW_SECONDS)
+
+
+def create_usage_table(config):
+    """
+    Builds the usage table matching config['QUEUE_BACKEND']: shared through Redis
+    for the Redis backend, in-process for the in-process queue.
+    """
+    if config.get('QUEUE_BACKEND', 'redis') == 'memory':
+        return InProcessUsageTable()
+    return RedisUsageTable(config.get('REDIS_HOST', 'localhost'), config.get('REDIS_PORT', 6379),
+                           config.get('REDIS_MAX_CONNECTIONS'))
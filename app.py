@@ -1,26 +1,309 @@
 # app.py
-from flask import Flask, request, jsonify, g
-from flask_sqlalchemy import SQLAlchemy
-from flask_httpauth import HTTPBasicAuth
-from scheduler import Scheduler
-from models import db, User, Deployment, Cluster
+import json
+import sys
+import threading
+import time
+from flask import Flask, Response, request, jsonify, g, stream_with_context
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from scheduler import Scheduler, QUEUEABLE_STATUSES, TERMINAL_STATUSES
+from sqlalchemy import insert, select
+from config import Config, init_db
+from queue_backends import create_queue_backend
+from capacity import create_capacity_index, capacity_from_row
+from events import HEARTBEAT_SECONDS, KEEP_ALIVE, RESYNC, StatusEvent, create_broadcaster, format_sse
+from admission import create_usage_table, parse_quotas
+from utilization import MAX_POINTS, resolution_for
+from models import db, Deployment, Cluster
+from utils import verify_credentials, generate_auth_token, verify_auth_token, credential_cache
+from metrics import REGISTRY, CONTENT_TYPE, instrument_engine
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-auth = HTTPBasicAuth()
-scheduler = Scheduler()
+app.config.from_object(Config)
+init_db(app, db)
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+auth = MultiAuth(basic_auth, token_auth)
+scheduler = Scheduler(queue=create_queue_backend(app.config), capacity=create_capacity_index(app.config),
+                      events=create_broadcaster(app.config), usage=create_usage_table(app.config),
+                      quotas=parse_quotas(app.config['ORG_QUOTAS']),
+                      event_retention_seconds=app.config['UTILIZATION_EVENT_RETENTION_DAYS'] * 24 * 3600 or None)
+with app.app_context():
+    instrument_engine(db.engine)
+
+# Page sizes for the keyset-paginated list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Most deployments accepted by one POST /deployments/batch
+MAX_BATCH_SIZE = 1000
+
+# Most replicas in one gang deployment
+MAX_REPLICAS = 1000
+
+# Default window and step of GET /clusters/<id>/utilization, in seconds
+DEFAULT_UTILIZATION_WINDOW = 24 * 3600
+DEFAULT_UTILIZATION_STEP = 3600
+
+# Response status for each reason admission control rejects a deployment
+ADMISSION_ERROR_STATUS = {'infeasible': 400, 'quota': 403, 'rate_limited': 429}
+
+# --- Metrics ---
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'API request latency by route.', ['route', 'method', 'status'])
+QUEUE_DEPTH = REGISTRY.gauge(
+    'scheduler_queue_depth', 'Deployments waiting in the queue, by priority.', ['priority'])
+CLUSTER_UTILIZATION = REGISTRY.gauge(
+    'cluster_utilization_ratio', 'Share of each cluster resource in use.', ['cluster_id', 'resource'])
+CREDENTIAL_CACHE = REGISTRY.gauge(
+    'credential_cache', 'Credential cache hits, misses and current size.', ['stat'])
+EVENT_SUBSCRIBERS = REGISTRY.gauge(
+    'deployment_event_subscribers', 'Open deployment status event streams in this process.')
+
+
+def collect_state():
+    """Refreshes the gauges derived from the queue, the clusters table and the credential cache."""
+    QUEUE_DEPTH.replace({(priority,): depth for priority, depth in scheduler.queue_depth_by_priority().items()})
+    utilization = {}
+    rows = db.session.execute(select(
+        Cluster.id, Cluster.total_ram, Cluster.total_cpu, Cluster.total_gpu,
+        Cluster.available_ram, Cluster.available_cpu, Cluster.available_gpu))
+    for cluster_id, total_ram, total_cpu, total_gpu, available_ram, available_cpu, available_gpu in rows:
+        for resource, total, available in (('ram', total_ram, available_ram), ('cpu', total_cpu, available_cpu),
+                                           ('gpu', total_gpu, available_gpu)):
+            if total:
+                utilization[(cluster_id, resource)] = (total - available) / total
+    CLUSTER_UTILIZATION.replace(utilization)
+    CREDENTIAL_CACHE.replace({(stat,): value for stat, value in credential_cache.stats().items()})
+    EVENT_SUBSCRIBERS.set(scheduler.events.subscriber_count())
+
+
+REGISTRY.add_collector(collect_state)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request_latency(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                                route=route, method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Exposes scheduler, queue, database and API metrics for Prometheus to scrape.
+    Returns:
+        (text): Metrics in the Prometheus text exposition format.
+    """
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
 
 # --- Authentication ---
-@auth.verify_password
+@basic_auth.verify_password
 def verify_password(username, password):
-    user = User.query.filter_by(username=username).first()
-    if user and user.verify_password(password):
+    user = verify_credentials(username, password)
+    if user:
         g.current_user = user
         return True
     return False
 
+
+@token_auth.verify_token
+def verify_token(token):
+    user = verify_auth_token(token)
+    if user:
+        g.current_user = user
+        return True
+    return False
+
+
+@app.route('/login', methods=['POST'])
+def login():
+    """
+    Exchanges a username and password for a bearer token, so later requests
+    skip the password check. Credentials may be sent with HTTP Basic auth or
+    in the JSON body.
+    Expects:
+        username (str): The user's username.
+        password (str): The user's password.
+    Returns:
+        (JSON): The token and its lifetime in seconds, or an error message.
+    """
+    data = request.get_json(silent=True) or {}
+    credentials = request.authorization
+    username = data.get('username') or (credentials.username if credentials else None)
+    password = data.get('password') or (credentials.password if credentials else None)
+    user = verify_credentials(username, password) if username and password else None
+    if not user:
+        return jsonify({'message': 'Invalid credentials!'}), 401
+
+    return jsonify({'token': generate_auth_token(user), 'expires_in': app.config['AUTH_TOKEN_TTL']}), 200
+
+def stream_limit(args):
+    """Returns the ?limit= of an NDJSON stream: None for every row, otherwise at least 1."""
+    limit = args.get('limit', type=int)
+    return max(1, limit) if limit is not None else None
+
+def paginated_response(query, id_column, serialize, collection):
+    """
+    Applies keyset pagination (?after_id=&limit=) to a column-projected select and
+    returns the serialized rows with the cursor for the next page. With
+    ?format=ndjson all remaining rows (up to limit, if given) are streamed instead,
+    one JSON object per line, without building the whole result in memory.
+    """
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        query = query.where(id_column > after_id)
+    query = query.order_by(id_column)
+
+    if request.args.get('format') == 'ndjson':
+        limit = stream_limit(request.args)
+        if limit is not None:
+            query = query.limit(limit)
+
+        def generate():
+            for row in db.session.execute(query.execution_options(yield_per=1000)):
+                yield json.dumps(serialize(row)) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    items = [serialize(row) for row in db.session.execute(query.limit(limit))]
+    next_after_id = items[-1]['id'] if len(items) == limit else None
+    return jsonify({collection: items, 'next_after_id': next_after_id}), 200
+
+def paginated_items(items, serialize, collection):
+    """
+    Like paginated_response, for items already in memory and ordered by ID
+    (e.g. from the capacity index).
+    """
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        items = [item for item in items if item.id > after_id]
+
+    if request.args.get('format') == 'ndjson':
+        limit = stream_limit(request.args)
+        lines = [json.dumps(serialize(item)) + '\n' for item in (items[:limit] if limit is not None else items)]
+        return Response(lines, mimetype='application/x-ndjson')
+
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    page = [serialize(item) for item in items[:limit]]
+    next_after_id = page[-1]['id'] if len(page) == limit else None
+    return jsonify({collection: page, 'next_after_id': next_after_id}), 200
+
+def parse_deployment_spec(data, user):
+    """
+    Validates a deployment request body and returns (values, error): the column
+    values for a new deployment owned by user, or None and an error message.
+    """
+    if not isinstance(data, dict):
+        return None, 'Deployment spec must be an object!'
+    for field in ('name', 'docker_image'):
+        if not isinstance(data.get(field), str) or not data[field]:
+            return None, f'{field} is required!'
+    for field in ('required_ram', 'required_cpu', 'required_gpu'):
+        value = data.get(field)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return None, f'{field} must be a non-negative integer!'
+    priority = data.get('priority', 1)  # Default priority is 1
+    if not isinstance(priority, int) or isinstance(priority, bool) or not 1 <= priority <= 5:
+        return None, 'priority must be an integer from 1 to 5!'
+    replicas = data.get('replicas', 1)
+    if not isinstance(replicas, int) or isinstance(replicas, bool) or not 1 <= replicas <= MAX_REPLICAS:
+        return None, f'replicas must be an integer from 1 to {MAX_REPLICAS}!'
+    cluster_id = data.get('cluster_id')
+    if cluster_id is None and not user.organization_id:
+        return None, 'User not associated with an organization!'
+    if cluster_id is not None and (not isinstance(cluster_id, int) or isinstance(cluster_id, bool)):
+        return None, 'cluster_id must be an integer!'
+
+    return {
+        'name': data['name'],
+        'user_id': user.id,
+        'cluster_id': cluster_id,
+        'organization_id': user.organization_id if cluster_id is None else None,
+        'docker_image': data['docker_image'],
+        'required_ram': data['required_ram'],
+        'required_cpu': data['required_cpu'],
+        'required_gpu': data['required_gpu'],
+        'priority': priority,
+        'replicas': replicas,
+    }, None
+
+def parse_deployment_batch(data, user):
+    """
+    Validates a POST /deployments/batch body. Returns (results, accepted, error):
+    per-spec results in request order, (result, values) pairs for the valid specs,
+    and an error message if the request as a whole is rejected.
+    """
+    specs = data.get('deployments') if isinstance(data, dict) else None
+    if not isinstance(specs, list) or not specs:
+        return [], [], 'deployments must be a non-empty list!'
+    if len(specs) > MAX_BATCH_SIZE:
+        return [], [], f'At most {MAX_BATCH_SIZE} deployments per batch!'
+
+    results = []
+    accepted = []
+    for index, spec in enumerate(specs):
+        values, error = parse_deployment_spec(spec, user)
+        if error:
+            results.append({'index': index, 'error': error})
+        else:
+            results.append({'index': index})
+            accepted.append((results[-1], values))
+    if not accepted:
+        return results, accepted, 'No valid deployments!'
+    return results, accepted, None
+
+def admit_deployment_batch(accepted):
+    """
+    Runs admission control (see Scheduler.admit) on the (result, values) pairs of
+    parse_deployment_batch. Rejected specs get an error in their result, admitted
+    ones their estimated_start_seconds. Returns (admitted, status): the admitted
+    pairs, and the status to answer with if none were (429 if all were rate limited).
+    """
+    admitted = []
+    reasons = set()
+    for (result, values), admission in zip(accepted, scheduler.admit([values for _, values in accepted])):
+        if admission.reason is not None:
+            result['error'] = admission.message
+            reasons.add(admission.reason)
+        else:
+            result['estimated_start_seconds'] = admission.estimate
+            admitted.append((result, values))
+    return admitted, 429 if reasons == {'rate_limited'} else 400
+
+def deployments_query(user_id, args):
+    """Returns the column-projected select for GET /deployments with the filters in args applied."""
+    query = select(
+        Deployment.id, Deployment.name, Deployment.cluster_id, Deployment.docker_image,
+        Deployment.required_ram, Deployment.required_cpu, Deployment.required_gpu,
+        Deployment.status, Deployment.priority, Deployment.replicas, Deployment.created_at,
+    ).where(Deployment.user_id == user_id)
+    if 'status' in args:
+        query = query.where(Deployment.status == args['status'])
+    if 'cluster_id' in args:
+        query = query.where(Deployment.cluster_id == args.get('cluster_id', type=int))
+    if 'priority' in args:
+        query = query.where(Deployment.priority == args.get('priority', type=int))
+    return query
+
+def status_snapshot_query(user_id, deployment_ids):
+    """Selects the current status of the user's deployments among deployment_ids, as StatusEvent fields."""
+    return (select(Deployment.id, Deployment.user_id, Deployment.status, Deployment.cluster_id)
+            .where(Deployment.user_id == user_id, Deployment.id.in_(deployment_ids))
+            .order_by(Deployment.id))
+
+def serialize_deployment(row):
+    deployment = row._asdict()
+    deployment['created_at'] = row.created_at.isoformat(sep=' ', timespec='seconds')
+    return deployment
+
 # --- Cluster Management ---
 @app.route('/cluster', methods=['POST'])
 @auth.login_required
@@ -52,6 +335,7 @@ def create_cluster():
     )
     db.session.add(new_cluster)
     db.session.commit()
+    scheduler.capacity.put(capacity_from_row(new_cluster))
 
     return jsonify({'message': 'Cluster created!', 'cluster_id': new_cluster.id}), 201
 
@@ -60,29 +344,76 @@ def create_cluster():
 @auth.login_required
 def get_clusters():
     """
-    Retrieves all clusters belonging to the user's organization.
+    Retrieves the clusters belonging to the user's organization, one page at a time,
+    from the scheduler's capacity index rather than the database.
+    Expects (query string):
+        after_id (int, optional): Return clusters with an ID greater than this.
+        limit (int, optional): Page size (default 100, at most 1000).
+        format (str, optional): 'ndjson' to stream the clusters as JSON lines.
     Returns:
-        (JSON): A list of cluster details, or an error message.
+        (JSON): A list of cluster details and next_after_id (null on the last page),
+        or an error message.
     """
     user = g.current_user
     if not user.organization_id:
         return jsonify({'message': 'User not associated with an organization!'}), 400
 
-    clusters = Cluster.query.filter_by(organization_id=user.organization_id).all()
-    cluster_list = [
-        {
-            'id': cluster.id,
-            'name': cluster.name,
-            'total_ram': cluster.total_ram,
-            'total_cpu': cluster.total_cpu,
-            'total_gpu': cluster.total_gpu,
-            'available_ram': cluster.available_ram,
-            'available_cpu': cluster.available_cpu,
-            'available_gpu': cluster.available_gpu
-        }
-        for cluster in clusters
-    ]
-    return jsonify({'clusters': cluster_list}), 200
+    def serialize(capacity):
+        fields = capacity._asdict()
+        del fields['organization_id']
+        return fields
+
+    clusters = scheduler.cluster_capacities(organization_ids=[user.organization_id])
+    return paginated_items(clusters, serialize, 'clusters')
+
+
+@app.route('/clusters/<int:cluster_id>/utilization', methods=['GET'])
+@auth.login_required
+def get_cluster_utilization(cluster_id):
+    """
+    Reports how much of a cluster in the user's organization was allocated over time,
+    from the utilization history's precomputed rollups. Shares are of the cluster's
+    current totals.
+    Expects (query string):
+        from (int, optional): Start, in epoch seconds (default a day before to).
+        to (int, optional): End, in epoch seconds (default now).
+        step (int, optional): Seconds per point, a multiple of 60 (default 3600).
+    Returns:
+        (JSON): The window, rounded out to whole steps, the cluster's totals, and
+        points with the average share of ram, cpu and gpu allocated from each
+        start (null for time not yet reached), or an error message.
+    """
+    user = g.current_user
+    capacities = scheduler.cluster_capacities(cluster_ids=[cluster_id])
+    if not capacities or capacities[0].organization_id != user.organization_id:
+        return jsonify({'message': 'Cluster not found!'}), 404
+
+    now = int(time.time())
+    try:
+        step = int(request.args.get('step', DEFAULT_UTILIZATION_STEP))
+        end = int(request.args.get('to', now))
+        start = int(request.args.get('from', end - DEFAULT_UTILIZATION_WINDOW))
+    except ValueError:
+        return jsonify({'message': 'from, to and step must be integers!'}), 400
+    if step <= 0 or resolution_for(step) is None:
+        return jsonify({'message': 'step must be a positive multiple of 60!'}), 400
+    if start >= end:
+        return jsonify({'message': 'from must be before to!'}), 400
+    start -= start % step
+    end += -end % step
+    if (end - start) // step > MAX_POINTS:
+        return jsonify({'message': f'At most {MAX_POINTS} points per query!'}), 400
+
+    seconds, covered = scheduler.cluster_utilization(cluster_id, start, end, step, now)
+    capacity = capacities[0]
+    totals = (capacity.total_ram, capacity.total_cpu, capacity.total_gpu)
+    points = []
+    for index, (allocated, duration) in enumerate(zip(seconds.tolist(), covered.tolist())):
+        shares = [allocated_seconds / (total * duration) if total and duration else None
+                  for allocated_seconds, total in zip(allocated, totals)]
+        points.append({'start': start + index * step, **dict(zip(('ram', 'cpu', 'gpu'), shares))})
+    return jsonify({'cluster_id': cluster_id, 'from': start, 'to': end, 'step': step,
+                    'totals': dict(zip(('ram', 'cpu', 'gpu'), totals)), 'points': points}), 200
 
 # --- Deployment Management ---
 @app.route('/deployment', methods=['POST'])
@@ -92,65 +423,138 @@ def create_deployment():
     Creates a new deployment and adds it to the queue.
     Expects:
         name (str): The name of the deployment.
-        cluster_id (int): The ID of the target cluster.
+        cluster_id (int, optional): The ID of the target cluster. If omitted, the
+            scheduler places the deployment on any cluster in the user's organization.
         docker_image (str): The Docker image path.
         required_ram (int): RAM required for the deployment.
         required_cpu (int): CPU required for the deployment.
         required_gpu (int): GPU required for the deployment.
         priority (int, optional): Priority of the deployment (1-5).
+        replicas (int, optional): Number of identical replicas, each needing the
+            required resources (default 1). Replicas are placed all together or not
+            at all, on one cluster if possible, otherwise spread over clusters in
+            the organization when cluster_id is omitted.
+    Requests that exceed the total capacity of their clusters are rejected (400),
+    as are those over the organization's quota (403) or submission rate (429).
     Returns:
-        (JSON): A success message with the deployment ID, or an error message.
+        (JSON): A success message with the deployment ID and estimated_start_seconds
+        (the expected wait before it starts, null if unknown), or an error message.
     """
-    data = request.get_json()
-    user = g.current_user
-    new_deployment = Deployment(
-        name=data['name'],
-        user_id=user.id,
-        cluster_id=data['cluster_id'],
-        docker_image=data['docker_image'],
-        required_ram=data['required_ram'],
-        required_cpu=data['required_cpu'],
-        required_gpu=data['required_gpu'],
-        priority=data.get('priority', 1)  # Default priority is 1
-    )
+    values, error = parse_deployment_spec(request.get_json(), g.current_user)
+    if error:
+        return jsonify({'message': error}), 400
+    admission = scheduler.admit([values])[0]
+    if admission.reason is not None:
+        return jsonify({'message': admission.message}), ADMISSION_ERROR_STATUS[admission.reason]
+
+    new_deployment = Deployment(**values)
     db.session.add(new_deployment)
     db.session.commit()
 
-    # Enqueue the deployment for scheduling
-    scheduler.enqueue_deployment(new_deployment.id)
+    # Enqueue the deployment; the scheduler worker picks it up
+    scheduler.enqueue_deployment(new_deployment.id, new_deployment.priority, new_deployment.cluster_id)
+
+    return jsonify({'message': 'Deployment created and queued!', 'deployment_id': new_deployment.id,
+                    'estimated_start_seconds': admission.estimate}), 201
+
+
+@app.route('/deployments/batch', methods=['POST'])
+@auth.login_required
+def create_deployments_batch():
+    """
+    Creates many deployments at once and adds them to the queue. Valid specs are
+    inserted in one statement and one commit, and enqueued with one queue call;
+    invalid specs, and specs rejected by admission control, are reported without
+    affecting the rest.
+    Expects:
+        deployments (list): Deployment specs, each as accepted by POST /deployment.
+    Returns:
+        (JSON): Per-spec results in request order, each with either the
+        deployment_id and estimated_start_seconds or an error, or an error message.
+    """
+    results, accepted, error = parse_deployment_batch(request.get_json(), g.current_user)
+    if error:
+        return jsonify({'message': error, **({'results': results} if results else {})}), 400
+    accepted, status = admit_deployment_batch(accepted)
+    if not accepted:
+        return jsonify({'message': 'No deployments admitted!', 'results': results}), status
 
-    # Trigger the scheduler (ideally, this should be a background task)
-    scheduler.schedule_deployments()
+    deployment_ids = db.session.execute(
+        insert(Deployment).returning(Deployment.id, sort_by_parameter_order=True),
+        [values for _, values in accepted],
+    ).scalars().all()
+    db.session.commit()
 
-    return jsonify({'message': 'Deployment created and queued!', 'deployment_id': new_deployment.id}), 201
+    for (result, _), deployment_id in zip(accepted, deployment_ids):
+        result['deployment_id'] = deployment_id
+    scheduler.enqueue_deployments([
+        (deployment_id, values['priority'], values['cluster_id'])
+        for (_, values), deployment_id in zip(accepted, deployment_ids)
+    ])
+
+    return jsonify({'message': f'{len(accepted)} deployments created and queued!', 'results': results}), 201
 
 
 @app.route('/deployments', methods=['GET'])
 @auth.login_required
 def get_deployments():
     """
-    Retrieves all deployments associated with the user.
+    Retrieves the deployments associated with the user, one page at a time.
+    Expects (query string):
+        status (str, optional): Only deployments with this status.
+        cluster_id (int, optional): Only deployments on this cluster.
+        priority (int, optional): Only deployments with this priority.
+        after_id (int, optional): Return deployments with an ID greater than this.
+        limit (int, optional): Page size (default 100, at most 1000).
+        format (str, optional): 'ndjson' to stream the deployments as JSON lines.
     Returns:
-        (JSON): A list of deployment details, or an error message.
+        (JSON): A list of deployment details and next_after_id (null on the last page),
+        or an error message.
     """
-    user = g.current_user
-    deployments = Deployment.query.filter_by(user_id=user.id).all()
-    deployment_list = [
-        {
-            'id': deployment.id,
-            'name': deployment.name,
-            'cluster_id': deployment.cluster_id,
-            'docker_image': deployment.docker_image,
-            'required_ram': deployment.required_ram,
-            'required_cpu': deployment.required_cpu,
-            'required_gpu': deployment.required_gpu,
-            'status': deployment.status,
-            'priority': deployment.priority,
-            'created_at': deployment.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
-        for deployment in deployments
-    ]
-    return jsonify({'deployments': deployment_list}), 200
+    query = deployments_query(g.current_user.id, request.args)
+    return paginated_response(query, Deployment.id, serialize_deployment, 'deployments')
+
+
+@app.route('/deployments/events', methods=['GET'])
+@auth.login_required
+def deployment_events():
+    """
+    Streams status changes of the user's deployments as server-sent events, so
+    clients need not poll GET /deployments. With deployment_id filters the stream
+    starts with the current status of those deployments, so no change between
+    submission and connecting is missed.
+    Expects (query string):
+        deployment_id (int, optional, repeatable): Only these deployments.
+    Returns:
+        (text/event-stream): 'status' events with deployment_id, user_id, status
+        and cluster_id, keep-alive comments while idle, and a final 'resync'
+        event if the client falls too far behind.
+    """
+    deployment_ids = request.args.getlist('deployment_id', type=int)
+    # Subscribe before reading the snapshot, so changes in between are not lost
+    subscription = scheduler.events.subscribe(g.current_user.id, deployment_ids)
+    snapshot = []
+    try:
+        if deployment_ids:
+            snapshot = [StatusEvent(*row) for row in
+                        db.session.execute(status_snapshot_query(g.current_user.id, deployment_ids))]
+    except BaseException:
+        subscription.close()
+        raise
+
+    def generate():
+        for event in snapshot:
+            yield format_sse('status', event._asdict())
+        while not subscription.overflowed:
+            event = subscription.get(HEARTBEAT_SECONDS)
+            yield format_sse('status', event._asdict()) if event is not None else KEEP_ALIVE
+        yield RESYNC
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Unsubscribes when the server closes the response, even if the stream never started
+    response.call_on_close(subscription.close)
+    return response
 
 
 # --- Deployment Status Update (for internal/testing purposes) ---
@@ -158,6 +562,9 @@ def get_deployments():
 def update_deployment_status(deployment_id):
     """
     Updates the status of a deployment (for testing or internal use).
+    A running deployment moved to a terminal status (completed, failed, stopped)
+    returns its resources to its clusters, and the scheduler worker is told to
+    backfill their queues.
     Expects:
         status (str): The new status of the deployment.
     Returns:
@@ -168,11 +575,34 @@ def update_deployment_status(deployment_id):
     if not deployment:
         return jsonify({'message': 'Deployment not found!'}), 404
 
-    deployment.status = data['status']
+    status = data['status']
+    cluster_id = deployment.cluster_id
+    freed_cluster_ids = scheduler.release_resources(deployment, status) if status in TERMINAL_STATUSES else []
+    if not freed_cluster_ids:
+        if status in TERMINAL_STATUSES and deployment.status in QUEUEABLE_STATUSES:
+            # Stopped before it ran; it no longer counts against the organization's quota
+            scheduler.release_usage([deployment])
+        deployment.status = status
     db.session.commit()
 
+    for freed_cluster_id in freed_cluster_ids:
+        scheduler.notify_capacity_freed(freed_cluster_id)
+    scheduler.publish_status_changes([StatusEvent(deployment.id, deployment.user_id, status, cluster_id)])
+
     return jsonify({'message': 'Deployment status updated!', 'deployment_id': deployment.id}), 200
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    if sys.argv[1:] == ['initdb']:
+        from migrations import upgrade
+        with app.app_context():
+            upgrade(db.engine)
+    elif app.config['QUEUE_BACKEND'] == 'memory':
+        # The in-process queue is only visible here, so the worker runs alongside the API
+        def run_worker():
+            with app.app_context():
+                scheduler.run_worker()
+        threading.Thread(target=run_worker, name='scheduler-worker', daemon=True).start()
+        app.run(debug=True, use_reloader=False)
+    else:
+        app.run(debug=True)
@@ -0,0 +1,496 @@
+"""
+ASGI entry point: `uvicorn asgi:application`.
+
+The routes that clients hold open or call at high rates (deployment submission,
+listing and status event streams) are served natively on the event loop, with
+async SQLAlchemy sessions and an awaitable queue (redis.asyncio for the Redis
+backend). Every other route is passed to the Flask app on a bounded thread pool.
+The scheduler runs as a task in the same event loop, waking on queue events like
+`python -m scheduler worker`.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.datastructures import MultiDict
+from app import (
+    app as flask_app, scheduler, ADMISSION_ERROR_STATUS, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, REQUEST_SECONDS,
+    admit_deployment_batch, deployments_query, parse_deployment_batch, parse_deployment_spec,
+    serialize_deployment, status_snapshot_query, stream_limit,
+)
+from events import HEARTBEAT_SECONDS, KEEP_ALIVE, RESYNC, StatusEvent, format_sse
+from config import async_database_uri, configure_sqlite, engine_options
+from models import db, Deployment
+from queue_backends import ALL_QUEUES, create_async_queue
+from utils import TokenUser, verify_auth_token, verify_credentials
+
+logger = logging.getLogger(__name__)
+
+# Sent with 401 responses, as Flask-HTTPAuth does for the WSGI routes
+UNAUTHORIZED_HEADERS = [(b'content-type', b'text/plain; charset=utf-8'),
+                        (b'www-authenticate', b'Basic realm="Authentication Required"')]
+
+SSE_HEADERS = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no')]
+
+
+class Request:
+    def __init__(self, scope, body):
+        """The parts of an ASGI HTTP request the native routes use."""
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    def json(self):
+        """Returns the decoded JSON body, or None if it is missing or malformed."""
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class Response:
+    def __init__(self, body=b'', status=200, headers=(), chunks=None, on_close=None):
+        """
+        A response for a native route: a complete body, or an async iterator of
+        byte chunks (chunks) streamed as they are produced. on_close, if given, is
+        called once sending ends, however it ends.
+        """
+        self.body = body
+        self.status = status
+        self.headers = list(headers)
+        self.chunks = chunks
+        self.on_close = on_close
+
+    async def send(self, send, receive):
+        """Sends the response; a stream stops as soon as the client disconnects."""
+        try:
+            await self._send(send, receive)
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+    async def _send(self, send, receive):
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': self.headers})
+        if self.chunks is None:
+            await send({'type': 'http.response.body', 'body': self.body})
+            return
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        chunks = self.chunks.__aiter__()
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait({next_chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_chunk.done():
+                    # Cancelling the pending step ends the generator, running its cleanup
+                    next_chunk.cancel()
+                    await asyncio.gather(next_chunk, return_exceptions=True)
+                    return
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+
+
+def json_response(payload, status=200):
+    return Response(json.dumps(payload).encode(), status, [(b'content-type', b'application/json')])
+
+
+class AsyncApp:
+    def __init__(self, flask_app, scheduler, threads=None, run_scheduler=None, poll_timeout=5,
+                 reconcile_interval=60):
+        """
+        Serves flask_app over ASGI. threads bounds the pool running the WSGI routes
+        and password checks (default ASGI_THREADS); run_scheduler starts the
+        scheduler loop at startup (default ASGI_RUN_SCHEDULER), polling and
+        reconciling state (see Scheduler.reconcile_state) as `scheduler worker` does.
+        """
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.scheduler = scheduler
+        self.run_scheduler = config.get('ASGI_RUN_SCHEDULER', True) if run_scheduler is None else run_scheduler
+        self.poll_timeout = poll_timeout
+        self.reconcile_interval = reconcile_interval
+        self.executor = ThreadPoolExecutor(max_workers=threads or config.get('ASGI_THREADS', 32),
+                                           thread_name_prefix='asgi')
+        self.routes = {
+            ('POST', '/deployment'): self.create_deployment,
+            ('POST', '/deployments/batch'): self.create_deployments_batch,
+            ('GET', '/deployments'): self.get_deployments,
+            ('GET', '/deployments/events'): self.deployment_events,
+        }
+        self.engine = None
+        self.sessions = None
+        self.queue = None
+        self._scheduler_task = None
+        self._startup_lock = asyncio.Lock()
+
+    # --- Lifecycle ---
+    async def startup(self):
+        """Creates the async engine and queue client and starts the scheduler loop."""
+        async with self._startup_lock:
+            if self.engine is not None:
+                return
+            # Same database as the Flask app's engine, through the async driver
+            with self.flask_app.app_context():
+                uri = db.engine.url.render_as_string(hide_password=False)
+            config = {**self.flask_app.config, 'SQLALCHEMY_DATABASE_URI': uri}
+            engine = create_async_engine(async_database_uri(uri), **engine_options(config))
+            configure_sqlite(engine.sync_engine, config)
+            self.sessions = async_sessionmaker(engine, expire_on_commit=False)
+            self.queue = create_async_queue(self.scheduler.queue)
+            self.engine = engine
+            if self.run_scheduler:
+                self._scheduler_task = asyncio.create_task(self.schedule_forever())
+            logger.info("asgi_started run_scheduler=%s", self.run_scheduler)
+
+    async def shutdown(self):
+        if self._scheduler_task is not None:
+            self._scheduler_task.cancel()
+            try:
+                await self._scheduler_task
+            except asyncio.CancelledError:
+                pass
+            self._scheduler_task = None
+        if self.engine is not None:
+            await self.queue.close()
+            await self.engine.dispose()
+            self.engine = None
+        self.executor.shutdown(wait=False)
+
+    async def schedule_forever(self):
+        """
+        The worker loop on the event loop: waits for queue events without blocking
+        it, and runs each scheduling pass on a thread, since passes use the
+        synchronous session and placement code. If waiting for events fails (e.g. a
+        dropped Redis connection), the loop backs off for poll_timeout seconds and
+        then runs a full pass.
+        """
+        woken = ALL_QUEUES
+        next_reconcile = time.monotonic()
+        started = True
+        while True:
+            reconcile = time.monotonic() >= next_reconcile
+            if reconcile:
+                next_reconcile = time.monotonic() + self.reconcile_interval
+            try:
+                await asyncio.to_thread(self._schedule, woken, reconcile, started)
+                started = False
+            except Exception:
+                logger.exception("scheduling_pass_failed woken=%s", woken)
+            try:
+                woken = await self.queue.wait(self.poll_timeout)
+            except Exception:
+                logger.exception("queue_wait_failed")
+                await asyncio.sleep(self.poll_timeout)
+                woken = ALL_QUEUES
+
+    def _schedule(self, woken, reconcile, rebuild_queue=False):
+        with self.flask_app.app_context():
+            try:
+                if reconcile:
+                    self.scheduler.reconcile_state(rebuild_queue)
+                self.scheduler.handle_wakeup(woken)
+            finally:
+                db.session.remove()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as error:
+                    logger.exception("asgi_startup_failed")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # --- Dispatch ---
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+        # Servers run without lifespan events start the app on its first request
+        if self.engine is None:
+            await self.startup()
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            await self.call_wsgi(scope, body, send)
+            return
+
+        started = time.perf_counter()
+        request = Request(scope, body)
+        user = await self.authenticate(request)
+        if user is None:
+            response = Response(b'Unauthorized Access', 401, UNAUTHORIZED_HEADERS)
+        else:
+            response = await handler(request, user)
+        await response.send(send, receive)
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                route=scope['path'], method=scope['method'], status=response.status)
+
+    async def authenticate(self, request):
+        """
+        Returns the TokenUser for the request's Bearer token or Basic credentials,
+        or None. Tokens are checked on the event loop; password checks can hash,
+        so they run on the thread pool.
+        """
+        scheme, _, credentials = request.headers.get('authorization', '').partition(' ')
+        scheme = scheme.lower()
+        if scheme == 'bearer':
+            with self.flask_app.app_context():
+                return verify_auth_token(credentials.strip())
+        if scheme == 'basic':
+            try:
+                username, _, password = base64.b64decode(credentials.strip()).decode().partition(':')
+            except ValueError:
+                return None
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._verify_password, username, password)
+        return None
+
+    def _verify_password(self, username, password):
+        with self.flask_app.app_context():
+            try:
+                user = verify_credentials(username, password)
+                return TokenUser(user.id, user.username, user.organization_id) if user else None
+            finally:
+                db.session.remove()
+
+    async def run_in_app(self, function, *args):
+        """
+        Runs function(*args) on the thread pool in a Flask app context, for the
+        synchronous scheduler calls (admission control) the native routes make.
+        """
+        def call():
+            with self.flask_app.app_context():
+                try:
+                    return function(*args)
+                finally:
+                    db.session.remove()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    # --- Native routes (same contracts as the Flask routes in app.py) ---
+    async def create_deployment(self, request, user):
+        values, error = parse_deployment_spec(request.json(), user)
+        if error:
+            return json_response({'message': error}, 400)
+        admission = (await self.run_in_app(self.scheduler.admit, [values]))[0]
+        if admission.reason is not None:
+            return json_response({'message': admission.message}, ADMISSION_ERROR_STATUS[admission.reason])
+
+        async with self.sessions() as session:
+            deployment_id = (await session.execute(
+                insert(Deployment).values(**values).returning(Deployment.id))).scalar_one()
+            await session.commit()
+
+        await self.queue.enqueue([(deployment_id, values['priority'], values['cluster_id'])])
+        return json_response({'message': 'Deployment created and queued!', 'deployment_id': deployment_id,
+                              'estimated_start_seconds': admission.estimate}, 201)
+
+    async def create_deployments_batch(self, request, user):
+        results, accepted, error = parse_deployment_batch(request.json(), user)
+        if error:
+            return json_response({'message': error, **({'results': results} if results else {})}, 400)
+        accepted, status = await self.run_in_app(admit_deployment_batch, accepted)
+        if not accepted:
+            return json_response({'message': 'No deployments admitted!', 'results': results}, status)
+
+        async with self.sessions() as session:
+            deployment_ids = (await session.execute(
+                insert(Deployment).returning(Deployment.id, sort_by_parameter_order=True),
+                [values for _, values in accepted],
+            )).scalars().all()
+            await session.commit()
+
+        for (result, _), deployment_id in zip(accepted, deployment_ids):
+            result['deployment_id'] = deployment_id
+        await self.queue.enqueue([
+            (deployment_id, values['priority'], values['cluster_id'])
+            for (_, values), deployment_id in zip(accepted, deployment_ids)
+        ])
+        return json_response({'message': f'{len(accepted)} deployments created and queued!', 'results': results},
+                             201)
+
+    async def get_deployments(self, request, user):
+        query = deployments_query(user.id, request.args)
+        return await self.paginated_response(request, query, Deployment.id, serialize_deployment, 'deployments')
+
+    async def paginated_response(self, request, query, id_column, serialize, collection):
+        """The async counterpart of app.paginated_response, with the same query string."""
+        after_id = request.args.get('after_id', type=int)
+        if after_id is not None:
+            query = query.where(id_column > after_id)
+        query = query.order_by(id_column)
+
+        if request.args.get('format') == 'ndjson':
+            limit = stream_limit(request.args)
+            if limit is not None:
+                query = query.limit(limit)
+
+            async def generate():
+                async with self.sessions() as session:
+                    result = await session.stream(query.execution_options(yield_per=1000))
+                    async for row in result:
+                        yield (json.dumps(serialize(row)) + '\n').encode()
+            return Response(status=200, headers=[(b'content-type', b'application/x-ndjson')], chunks=generate())
+
+        limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        async with self.sessions() as session:
+            items = [serialize(row) for row in await session.execute(query.limit(limit))]
+        next_after_id = items[-1]['id'] if len(items) == limit else None
+        return json_response({collection: items, 'next_after_id': next_after_id})
+
+    async def deployment_events(self, request, user):
+        deployment_ids = request.args.getlist('deployment_id', type=int)
+        # Subscribe before reading the snapshot, so changes in between are not lost
+        subscription = self.scheduler.events.subscribe(user.id, deployment_ids, loop=asyncio.get_running_loop())
+        snapshot = []
+        try:
+            if deployment_ids:
+                async with self.sessions() as session:
+                    snapshot = [StatusEvent(*row) for row in
+                                await session.execute(status_snapshot_query(user.id, deployment_ids))]
+        except BaseException:
+            subscription.close()
+            raise
+
+        async def generate():
+            for event in snapshot:
+                yield format_sse('status', event._asdict()).encode()
+            while not subscription.overflowed:
+                event = await subscription.get_async(HEARTBEAT_SECONDS)
+                yield (format_sse('status', event._asdict()) if event is not None else KEEP_ALIVE).encode()
+            yield RESYNC.encode()
+        # Unsubscribes once the response is sent, even if the stream never started
+        return Response(status=200, headers=SSE_HEADERS, chunks=generate(), on_close=subscription.close)
+
+    # --- WSGI bridge ---
+    async def call_wsgi(self, scope, body, send):
+        """Runs the Flask app for one request on the thread pool, streaming its response."""
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        def call():
+            iterable = self.flask_app(environ, start_response)
+            return iterable, iter(iterable)
+
+        iterable, chunks = await loop.run_in_executor(self.executor, call)
+        try:
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def read_body(receive):
+    """Reads the whole request body, or returns None if the client disconnected."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def wsgi_environ(scope, body):
+    """Builds the WSGI environ for an ASGI HTTP scope (PEP 3333)."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+application = AsyncApp(flask_app, scheduler)
+
+
+def main(argv=None):
+    """Runs the ASGI app under uvicorn, e.g. `python -m asgi --port 8000`."""
+    parser = argparse.ArgumentParser(description='Serve the API over ASGI.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--limit-concurrency', type=int, default=None,
+                        help='Connections served at once before new ones get 503.')
+    args = parser.parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error('uvicorn is required: pip install uvicorn')
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    uvicorn.run(application, host=args.host, port=args.port, limit_concurrency=args.limit_concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+import argparse
+import heapq
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Named workloads; any parameter can be overridden on the command line with --set name=value.
+# Times are simulated seconds: arrivals follow a Poisson process at arrival_rate per second,
+# the scheduler runs a pass every pass_interval seconds, and deployments complete after an
+# exponentially distributed runtime with mean mean_runtime.
+SCENARIOS = {
+    'smoke': {
+        'seed': 1, 'clusters': 4, 'cluster_ram': 64, 'cluster_cpu': 32, 'cluster_gpu': 4,
+        'deployments': 200, 'arrival_rate': 20.0, 'pass_interval': 1.0, 'mean_runtime': 10.0,
+        'priority_weights': {1: 0.6, 2: 0.2, 3: 0.1, 5: 0.1},
+        'ram_weights': {1: 0.5, 2: 0.3, 8: 0.2}, 'cpu_weights': {1: 0.6, 2: 0.3, 4: 0.1},
+        'gpu_probability': 0.1, 'targeted_fraction': 0.5,
+        'strategy': 'first_fit', 'preemption': False, 'batch_size': 100, 'submit_batch': 100,
+    },
+    'steady': {
+        'seed': 1, 'clusters': 20, 'cluster_ram': 256, 'cluster_cpu': 64, 'cluster_gpu': 8,
+        'deployments': 5000, 'arrival_rate': 100.0, 'pass_interval': 1.0, 'mean_runtime': 30.0,
+        'priority_weights': {1: 0.6, 2: 0.2, 3: 0.1, 5: 0.1},
+        'ram_weights': {1: 0.4, 4: 0.3, 16: 0.2, 32: 0.1}, 'cpu_weights': {1: 0.5, 2: 0.3, 8: 0.2},
+        'gpu_probability': 0.05, 'targeted_fraction': 0.5,
+        'strategy': 'first_fit', 'preemption': False, 'batch_size': 100, 'submit_batch': 500,
+    },
+    'burst': {
+        'seed': 1, 'clusters': 20, 'cluster_ram': 256, 'cluster_cpu': 64, 'cluster_gpu': 8,
+        'deployments': 5000, 'arrival_rate': 2000.0, 'pass_interval': 1.0, 'mean_runtime': 20.0,
+        'priority_weights': {1: 0.7, 3: 0.2, 5: 0.1},
+        'ram_weights': {1: 0.4, 4: 0.3, 16: 0.2, 32: 0.1}, 'cpu_weights': {1: 0.5, 2: 0.3, 8: 0.2},
+        'gpu_probability': 0.05, 'targeted_fraction': 0.2,
+        'strategy': 'first_fit', 'preemption': True, 'batch_size': 100, 'submit_batch': 1000,
+    },
+    'gang': {
+        'seed': 1, 'clusters': 20, 'cluster_ram': 256, 'cluster_cpu': 64, 'cluster_gpu': 8,
+        'deployments': 1000, 'arrival_rate': 20.0, 'pass_interval': 1.0, 'mean_runtime': 30.0,
+        'priority_weights': {1: 0.6, 2: 0.2, 3: 0.1, 5: 0.1},
+        'ram_weights': {1: 0.5, 2: 0.3, 4: 0.2}, 'cpu_weights': {1: 0.7, 2: 0.3},
+        'gpu_probability': 0.0, 'targeted_fraction': 0.0,
+        'replica_weights': {1: 0.7, 4: 0.15, 16: 0.1, 64: 0.04, 256: 0.01},
+        'strategy': 'first_fit', 'preemption': False, 'batch_size': 100, 'submit_batch': 100,
+    },
+}
+
+# Result metrics compared between runs: name -> True if higher is better
+COMPARED_METRICS = {
+    'placements_per_sec': True,
+    'submissions_per_sec': True,
+    'latency_p50': False,
+    'latency_p99': False,
+    'utilization_ram': True,
+    'utilization_cpu': True,
+    'utilization_gpu': True,
+}
+
+# Give up on deployments still queued this long after the last arrival
+DRAIN_LIMIT = 3600
+
+
+def _weighted_choice(rng, weights):
+    values = list(weights)
+    return rng.choices(values, weights=[weights[value] for value in values])[0]
+
+
+def _percentile(values, fraction):
+    """Returns the nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def generate_workload(params, cluster_ids):
+    """
+    Returns the synthetic deployment stream for a scenario as (arrival_time, spec,
+    runtime) tuples in arrival order. A targeted_fraction of specs name one of
+    cluster_ids; the rest may run on any cluster in the organization. Scenarios with
+    replica_weights also draw a replica count (gang size) per deployment.
+    """
+    rng = random.Random(params['seed'])
+    arrivals = []
+    clock = 0.0
+    for index in range(params['deployments']):
+        clock += rng.expovariate(params['arrival_rate'])
+        spec = {
+            'name': f'bench-{index}',
+            'docker_image': 'bench:latest',
+            'required_ram': int(_weighted_choice(rng, params['ram_weights'])),
+            'required_cpu': int(_weighted_choice(rng, params['cpu_weights'])),
+            'required_gpu': 1 if rng.random() < params['gpu_probability'] else 0,
+            'priority': int(_weighted_choice(rng, params['priority_weights'])),
+        }
+        if rng.random() < params['targeted_fraction']:
+            spec['cluster_id'] = rng.choice(cluster_ids)
+        if 'replica_weights' in params:
+            spec['replicas'] = int(_weighted_choice(rng, params['replica_weights']))
+        arrivals.append((clock, spec, rng.expovariate(1 / params['mean_runtime'])))
+    return arrivals
+
+
+def _is_throwaway_database(uri):
+    """Returns whether uri names an in-memory SQLite database or a SQLite file in the temp directory."""
+    from sqlalchemy.engine import make_url
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        return False
+    if url.database in (None, '', ':memory:'):
+        return True
+    temp_dir = os.path.realpath(tempfile.gettempdir())
+    return os.path.commonpath([temp_dir, os.path.realpath(url.database)]) == temp_dir
+
+
+def run_benchmark(app, params):
+    """
+    Replays a scenario against the app on an empty database: clusters and deployments
+    are submitted through the API with the Flask test client, the app's scheduler runs
+    a pass every pass_interval simulated seconds on an in-process queue, and placed
+    deployments are completed through the API when their runtime ends.
+    Returns a dict of results; latencies are in simulated seconds, throughput in real time.
+    The run drops every table first, so it refuses to start unless the app is bound to a
+    throwaway SQLite database (in memory or under the temp directory).
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not _is_throwaway_database(uri):
+        raise ValueError(f"Refusing to benchmark against {uri}: it is not a throwaway SQLite database")
+
+    import app as app_module
+    from models import db, Organization, User, Deployment, Cluster
+    from placement import PlacementEngine
+    from queue_backends import InProcessQueue
+    from capacity import InProcessCapacityIndex
+    from sqlalchemy import func, select
+
+    scheduler = app_module.scheduler
+    saved = scheduler.queue, scheduler.capacity, scheduler.placement, scheduler.preemption, scheduler.batch_size
+    scheduler.queue = InProcessQueue()
+    scheduler.capacity = InProcessCapacityIndex()
+    scheduler.placement = PlacementEngine(params['strategy'])
+    scheduler.preemption = params['preemption']
+    scheduler.batch_size = params['batch_size']
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            organization = Organization(name='bench')
+            db.session.add(organization)
+            db.session.flush()
+            user = User(username='bench', organization_id=organization.id)
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.commit()
+
+        client = app.test_client()
+        token = client.post('/login', json={'username': 'bench', 'password': 'bench'}).get_json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+        cluster_ids = []
+        for index in range(params['clusters']):
+            response = client.post('/cluster', headers=headers, json={
+                'name': f'bench-cluster-{index}', 'total_ram': params['cluster_ram'],
+                'total_cpu': params['cluster_cpu'], 'total_gpu': params['cluster_gpu']})
+            assert response.status_code == 201, response.get_data(as_text=True)
+            cluster_ids.append(response.get_json()['cluster_id'])
+        capacity = [params['clusters'] * params[f'cluster_{resource}'] for resource in ('ram', 'cpu', 'gpu')]
+
+        arrivals = generate_workload(params, cluster_ids)
+        arrival_times = {}
+        runtimes = {}
+        pending = set()
+        completions = []  # heap of (completion_time, deployment_id)
+        latencies = []
+        utilization_samples = []
+        submit_seconds = scheduler_seconds = 0.0
+        submitted = placed = 0
+        next_arrival = 0
+        clock = 0.0
+        last_arrival = arrivals[-1][0] if arrivals else 0.0
+
+        while next_arrival < len(arrivals) or (pending and clock < last_arrival + DRAIN_LIMIT):
+            clock += params['pass_interval']
+
+            due = []
+            while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= clock:
+                due.append(arrivals[next_arrival])
+                next_arrival += 1
+            for start in range(0, len(due), params['submit_batch']):
+                chunk = due[start:start + params['submit_batch']]
+                started = time.perf_counter()
+                response = client.post('/deployments/batch', headers=headers,
+                                       json={'deployments': [spec for _, spec, _ in chunk]})
+                submit_seconds += time.perf_counter() - started
+                assert response.status_code == 201, response.get_data(as_text=True)
+                for (arrival, _, runtime), result in zip(chunk, response.get_json()['results']):
+                    arrival_times[result['deployment_id']] = arrival
+                    runtimes[result['deployment_id']] = runtime
+                    pending.add(result['deployment_id'])
+                submitted += len(chunk)
+
+            while completions and completions[0][0] <= clock:
+                _, deployment_id = heapq.heappop(completions)
+                client.put(f'/deployment/{deployment_id}/status', json={'status': 'completed'})
+
+            with app.app_context():
+                started = time.perf_counter()
+                placed += scheduler.schedule_deployments()
+                scheduler_seconds += time.perf_counter() - started
+
+                if pending:
+                    newly_placed = db.session.execute(
+                        select(Deployment.id).where(Deployment.id.in_(pending), Deployment.status == 'running')
+                    ).scalars().all()
+                    for deployment_id in newly_placed:
+                        pending.discard(deployment_id)
+                        latencies.append(clock - arrival_times[deployment_id])
+                        heapq.heappush(completions, (clock + runtimes[deployment_id], deployment_id))
+
+                if next_arrival < len(arrivals) or clock <= last_arrival:
+                    free = db.session.execute(select(func.sum(Cluster.available_ram),
+                                                     func.sum(Cluster.available_cpu),
+                                                     func.sum(Cluster.available_gpu))).one()
+                    utilization_samples.append([1 - (f or 0) / total if total else 0.0
+                                                for f, total in zip(free, capacity)])
+                db.session.remove()
+    finally:
+        scheduler.queue, scheduler.capacity, scheduler.placement, scheduler.preemption, scheduler.batch_size = saved
+
+    utilization = ([sum(column) / len(utilization_samples) for column in zip(*utilization_samples)]
+                   if utilization_samples else [0.0, 0.0, 0.0])
+    return {
+        'submitted': submitted,
+        'placed': len(latencies),
+        'unplaced': len(pending),
+        'simulated_seconds': clock,
+        'scheduler_seconds': scheduler_seconds,
+        'placements_per_sec': placed / scheduler_seconds if scheduler_seconds else 0.0,
+        'submissions_per_sec': submitted / submit_seconds if submit_seconds else 0.0,
+        'latency_p50': _percentile(latencies, 0.50),
+        'latency_p99': _percentile(latencies, 0.99),
+        'utilization_ram': utilization[0],
+        'utilization_cpu': utilization[1],
+        'utilization_gpu': utilization[2],
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares two saved result files scenario by scenario. Returns (rows, regressed):
+    rows of (scenario, metric, baseline, current, relative change) and whether any
+    metric got worse by more than threshold (a fraction, e.g. 0.1 for 10%).
+    """
+    rows = []
+    regressed = False
+    for scenario, results in current['scenarios'].items():
+        before = baseline['scenarios'].get(scenario)
+        if before is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before['results'].get(metric), results['results'].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / abs(old) if old else 0.0
+            if (-change if higher_is_better else change) > threshold:
+                regressed = True
+            rows.append((scenario, metric, old, new, change))
+    return rows, regressed
+
+
+def _parse_override(text):
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except json.JSONDecodeError:
+        return name, value
+
+
+def main(argv=None):
+    """Command-line entry point, e.g. `python -m benchmark run smoke steady -o results.json`."""
+    parser = argparse.ArgumentParser(description='Scheduler benchmark and load simulation.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run scenarios and save the results.')
+    run_parser.add_argument('scenarios', nargs='*', default=['smoke'], choices=sorted(SCENARIOS))
+    run_parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                            help='Override a scenario parameter (JSON value), e.g. --set strategy=best_fit.')
+    run_parser.add_argument('-o', '--output', help='Write the results to this JSON file.')
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative change that counts as a regression (default 0.1).')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows, regressed = compare(baseline, current, args.threshold)
+        for scenario, metric, old, new, change in rows:
+            print(f"{scenario:10} {metric:22} {old:14.4f} {new:14.4f} {change:+8.1%}")
+        if regressed:
+            print(f"Regression: at least one metric is more than {args.threshold:.0%} worse.")
+            return 1
+        return 0
+
+    # Always run on a throwaway database and the in-process queue
+    os.environ['DATABASE_URI'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    os.environ['QUEUE_BACKEND'] = 'memory'
+    from app import app
+    overrides = dict(_parse_override(text) for text in args.set)
+
+    report = {
+        'commit': _git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        params = dict(SCENARIOS[name], **overrides)
+        results = run_benchmark(app, params)
+        report['scenarios'][name] = {'params': params, 'results': results}
+        print(f"{name}: " + ' '.join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                                     for key, value in results.items() if value is not None))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
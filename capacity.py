@@ -0,0 +1,240 @@
+import logging
+import threading
+from collections import namedtuple
+import redis
+from queue_backends import get_connection_pool
+
+# Cached capacity of one cluster; attribute names match the Cluster model
+ClusterCapacity = namedtuple('ClusterCapacity', [
+    'id', 'name', 'organization_id',
+    'total_ram', 'total_cpu', 'total_gpu',
+    'available_ram', 'available_cpu', 'available_gpu',
+])
+
+# Fields compared when reconciling the index with the database
+RECONCILED_FIELDS = ClusterCapacity._fields[1:]
+
+logger = logging.getLogger(__name__)
+
+# Adds to a cluster's available capacity, unless the cluster is not indexed.
+# KEYS: cluster hash. ARGV: ram, cpu, gpu.
+ADJUST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+redis.call('HINCRBY', KEYS[1], 'available_ram', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'available_cpu', ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'available_gpu', ARGV[3])
+return 1
+"""
+
+
+def capacity_from_row(row):
+    """Builds a ClusterCapacity from a Cluster instance or a row with the same columns."""
+    return ClusterCapacity(*(getattr(row, field) for field in ClusterCapacity._fields))
+
+
+class CapacityIndex:
+    """
+    Cluster capacity kept outside the database, so placement checks and GET /clusters
+    do not read the clusters table. The database stays authoritative: reservations are
+    still conditional UPDATEs, the index is adjusted after they succeed, and
+    reconcile() rebuilds it from the database and reports any drift.
+    """
+
+    @property
+    def loaded(self):
+        """True once the index has been filled from the database."""
+        raise NotImplementedError
+
+    def load(self, capacities):
+        """Replaces the whole index with the given ClusterCapacity records."""
+        raise NotImplementedError
+
+    def put(self, capacity):
+        """Adds or overwrites one cluster."""
+        raise NotImplementedError
+
+    def adjust(self, cluster_id, ram, cpu, gpu):
+        """Adds the given amounts (negative to allocate) to a cluster's available capacity."""
+        raise NotImplementedError
+
+    def get_many(self, cluster_ids):
+        """Returns {cluster_id: ClusterCapacity} for the clusters that are indexed."""
+        raise NotImplementedError
+
+    def for_organizations(self, organization_ids):
+        """Returns the ClusterCapacity records of every cluster in the organizations, ordered by ID."""
+        raise NotImplementedError
+
+    def all(self):
+        """Returns every ClusterCapacity record, ordered by ID."""
+        raise NotImplementedError
+
+
+class InProcessCapacityIndex(CapacityIndex):
+    def __init__(self):
+        """Keeps the index in this process's memory, for the in-process queue backend and tests."""
+        self._lock = threading.Lock()
+        self._clusters = {}
+        self._organizations = {}
+        self._loaded = False
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, capacities):
+        with self._lock:
+            self._clusters = {}
+            self._organizations = {}
+            for capacity in capacities:
+                self._put(capacity)
+            self._loaded = True
+
+    def _put(self, capacity):
+        previous = self._clusters.get(capacity.id)
+        if previous is not None and previous.organization_id != capacity.organization_id:
+            self._organizations[previous.organization_id].discard(capacity.id)
+        self._clusters[capacity.id] = capacity
+        self._organizations.setdefault(capacity.organization_id, set()).add(capacity.id)
+
+    def put(self, capacity):
+        with self._lock:
+            self._put(capacity)
+
+    def adjust(self, cluster_id, ram, cpu, gpu):
+        with self._lock:
+            capacity = self._clusters.get(cluster_id)
+            if capacity is not None:
+                self._clusters[cluster_id] = capacity._replace(
+                    available_ram=capacity.available_ram + ram,
+                    available_cpu=capacity.available_cpu + cpu,
+                    available_gpu=capacity.available_gpu + gpu)
+
+    def get_many(self, cluster_ids):
+        with self._lock:
+            return {cluster_id: self._clusters[cluster_id] for cluster_id in cluster_ids
+                    if cluster_id in self._clusters}
+
+    def for_organizations(self, organization_ids):
+        with self._lock:
+            ids = set().union(*(self._organizations.get(organization_id, ()) for organization_id in organization_ids))
+            return [self._clusters[cluster_id] for cluster_id in sorted(ids)]
+
+    def all(self):
+        with self._lock:
+            return [self._clusters[cluster_id] for cluster_id in sorted(self._clusters)]
+
+
+class RedisCapacityIndex(CapacityIndex):
+    def __init__(self, host='localhost', port=6379, max_connections=None, name='capacity'):
+        """
+        Keeps the index in Redis, one hash per cluster plus a set of cluster IDs per
+        organization, so the API and every worker process share it. Adjustments are
+        HINCRBYs, so concurrent updates from several processes never lose each other.
+        """
+        self.redis = redis.Redis(connection_pool=get_connection_pool(host, port, 0, max_connections))
+        self._adjust_script = self.redis.register_script(ADJUST_SCRIPT)
+        self.name = name
+        self.clusters_name = f'{name}:clusters'
+        self.loaded_name = f'{name}:loaded'
+
+    def _cluster_key(self, cluster_id):
+        return f'{self.name}:cluster:{cluster_id}'
+
+    def _organization_key(self, organization_id):
+        return f'{self.name}:organization:{organization_id}'
+
+    @property
+    def loaded(self):
+        return bool(self.redis.exists(self.loaded_name))
+
+    def load(self, capacities):
+        stale = [self._cluster_key(int(cluster_id)) for cluster_id in self.redis.smembers(self.clusters_name)]
+        stale += [key.decode() for key in self.redis.scan_iter(match=f'{self.name}:organization:*')]
+        pipe = self.redis.pipeline()
+        if stale:
+            pipe.delete(*stale)
+        pipe.delete(self.clusters_name)
+        for capacity in capacities:
+            self._put(pipe, capacity)
+        pipe.set(self.loaded_name, 1)
+        pipe.execute()
+
+    def _put(self, pipe, capacity):
+        pipe.hset(self._cluster_key(capacity.id), mapping={
+            field: value for field, value in capacity._asdict().items() if value is not None})
+        pipe.sadd(self.clusters_name, capacity.id)
+        pipe.sadd(self._organization_key(capacity.organization_id), capacity.id)
+
+    def put(self, capacity):
+        pipe = self.redis.pipeline()
+        self._put(pipe, capacity)
+        pipe.execute()
+
+    def adjust(self, cluster_id, ram, cpu, gpu):
+        self._adjust_script(keys=[self._cluster_key(cluster_id)], args=[ram, cpu, gpu])
+
+    def _fetch(self, cluster_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for cluster_id in cluster_ids:
+            pipe.hgetall(self._cluster_key(cluster_id))
+        capacities = []
+        for values in pipe.execute():
+            if values:
+                values = {field.decode(): value.decode() for field, value in values.items()}
+                capacities.append(ClusterCapacity(**{
+                    field: values.get(field) if field == 'name' else int(values[field])
+                    for field in ClusterCapacity._fields}))
+        return capacities
+
+    def get_many(self, cluster_ids):
+        return {capacity.id: capacity for capacity in self._fetch(list(cluster_ids))}
+
+    def for_organizations(self, organization_ids):
+        organization_ids = list(organization_ids)
+        if not organization_ids:
+            return []
+        ids = self.redis.sunion([self._organization_key(organization_id) for organization_id in organization_ids])
+        return self._fetch(sorted(int(cluster_id) for cluster_id in ids))
+
+    def all(self):
+        return self._fetch(sorted(int(cluster_id) for cluster_id in self.redis.smembers(self.clusters_name)))
+
+
+def create_capacity_index(config):
+    """
+    Builds the capacity index matching config['QUEUE_BACKEND']: shared through Redis
+    for the Redis backend, in-process for the in-process queue.
+    """
+    if config.get('QUEUE_BACKEND', 'redis') == 'memory':
+        return InProcessCapacityIndex()
+    return RedisCapacityIndex(config.get('REDIS_HOST', 'localhost'), config.get('REDIS_PORT', 6379),
+                              config.get('REDIS_MAX_CONNECTIONS'))
+
+
+def reconcile(index, rows):
+    """
+    Rebuilds the index from the clusters table (rows are Cluster instances or rows with
+    the same columns) and returns the drift found, as a list of (cluster_id, field,
+    cached, actual) tuples; field is None for clusters missing from one side.
+    """
+    capacities = [capacity_from_row(row) for row in rows]
+    drift = []
+    if index.loaded:
+        cached = {capacity.id: capacity for capacity in index.all()}
+        for capacity in capacities:
+            previous = cached.pop(capacity.id, None)
+            if previous is None:
+                drift.append((capacity.id, None, None, capacity))
+                continue
+            for field in RECONCILED_FIELDS:
+                if getattr(previous, field) != getattr(capacity, field):
+                    drift.append((capacity.id, field, getattr(previous, field), getattr(capacity, field)))
+        drift.extend((cluster_id, None, previous, None) for cluster_id, previous in cached.items())
+    index.load(capacities)
+    for cluster_id, field, cached_value, actual in drift:
+        logger.warning("capacity_drift cluster_id=%s field=%s cached=%s actual=%s",
+                       cluster_id, field, cached_value, actual)
+    return drift
@@ -0,0 +1,115 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Values in a .env file are used for anything not already set in the environment
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+if load_dotenv:
+    load_dotenv()
+
+
+class Config:
+    """Service settings, read from environment variables with local-development defaults."""
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI', 'sqlite:///database.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+    REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+    REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+    # 'redis', or 'memory' for an in-process queue (optionally persisted to the QUEUE_PATH SQLite file)
+    QUEUE_BACKEND = os.environ.get('QUEUE_BACKEND', 'redis')
+    QUEUE_PATH = os.environ.get('QUEUE_PATH', '')
+    # Seconds a worker holds popped deployments before another may recover them; renewed while it runs
+    QUEUE_LEASE_SECONDS = int(os.environ.get('QUEUE_LEASE_SECONDS', 60))
+
+    # ASGI server (asgi.py): threads for the routes bridged to Flask, and whether it runs the scheduler
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+    ASGI_RUN_SCHEDULER = os.environ.get('ASGI_RUN_SCHEDULER', '1') != '0'
+
+    # Per-organization quotas and submission rates as JSON (see admission.parse_quotas); unset is unlimited
+    ORG_QUOTAS = os.environ.get('ORG_QUOTAS', '')
+
+    # Days raw allocation events are kept once rolled up for GET /clusters/<id>/utilization; 0 keeps them
+    UTILIZATION_EVENT_RETENTION_DAYS = int(os.environ.get('UTILIZATION_EVENT_RETENTION_DAYS', 7))
+
+    # Tokens signed with a per-process key stop working on restart and across workers; set SECRET_KEY
+    SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(32).hex()
+    AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 3600))
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """
+    Returns SQLALCHEMY_ENGINE_OPTIONS for the configured database. Pooled backends
+    (PostgreSQL, file-based SQLite) get a sized connection pool; SQLite also waits
+    up to SQLITE_BUSY_TIMEOUT_MS for the write lock instead of failing at once.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if _is_memory_sqlite(url):
+        return {}
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+    }
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+def init_db(app, db):
+    """
+    Binds the SQLAlchemy extension to the app using Config. On file-based SQLite,
+    every new connection switches to WAL journaling with synchronous=NORMAL, so
+    readers no longer block the writer, and sets the busy timeout.
+    """
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    db.init_app(app)
+
+    with app.app_context():
+        configure_sqlite(db.engine, app.config)
+
+
+def configure_sqlite(engine, config):
+    """
+    On file-based SQLite, makes every new connection of a (sync) engine use WAL
+    journaling with synchronous=NORMAL and the configured busy timeout.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite' or _is_memory_sqlite(url):
+        return
+    busy_timeout_ms = config['SQLITE_BUSY_TIMEOUT_MS']
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+        cursor.close()
+
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+
+# Async drivers used by the ASGI server for each database backend
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+
+
+def async_database_uri(uri):
+    """Returns the database URI with the backend's async driver, e.g. sqlite+aiosqlite://..."""
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend} databases")
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}').render_as_string(hide_password=False)
@@ -1,6 +1,13 @@
 -- deployment_schema.sql
+-- Full schema reset. Keep in sync with models.py and migrations.py;
+-- tests/test_migrations.py checks that all three produce the same schema.
 
 -- Drop existing tables if they exist
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS utilization_watermark;
+DROP TABLE IF EXISTS utilization_rollups;
+DROP TABLE IF EXISTS utilization_events;
+DROP TABLE IF EXISTS deployment_placements;
 DROP TABLE IF EXISTS deployments;
 DROP TABLE IF EXISTS organization_invites;
 DROP TABLE IF EXISTS clusters;
@@ -41,18 +48,64 @@ CREATE TABLE deployments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
     user_id INTEGER NOT NULL,
-    cluster_id INTEGER NOT NULL,
+    cluster_id INTEGER, -- NULL lets the scheduler pick any cluster in organization_id
+    organization_id INTEGER,
     docker_image TEXT NOT NULL,
     required_ram INTEGER NOT NULL,
     required_cpu INTEGER NOT NULL,
     required_gpu INTEGER NOT NULL,
     status TEXT NOT NULL DEFAULT 'queued',
     priority INTEGER NOT NULL DEFAULT 1,
+    replicas INTEGER NOT NULL DEFAULT 1, -- identical replicas placed all-or-nothing
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (cluster_id) REFERENCES clusters(id),
+    FOREIGN KEY (organization_id) REFERENCES organizations(id)
+);
+
+-- Create `deployment_placements` table: where each running gang's replicas are placed
+CREATE TABLE deployment_placements (
+    deployment_id INTEGER NOT NULL,
+    cluster_id INTEGER NOT NULL,
+    replicas INTEGER NOT NULL,
+    PRIMARY KEY (deployment_id, cluster_id),
+    FOREIGN KEY (deployment_id) REFERENCES deployments(id),
     FOREIGN KEY (cluster_id) REFERENCES clusters(id)
 );
 
+-- Create `utilization_events` table: append-only log of allocation changes (positive when reserved)
+CREATE TABLE utilization_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cluster_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL, -- epoch seconds
+    ram INTEGER NOT NULL,
+    cpu INTEGER NOT NULL,
+    gpu INTEGER NOT NULL,
+    FOREIGN KEY (cluster_id) REFERENCES clusters(id)
+);
+
+-- Create `utilization_rollups` table: allocation events folded into buckets of each resolution
+CREATE TABLE utilization_rollups (
+    cluster_id INTEGER NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    integral_ram BIGINT NOT NULL,
+    integral_cpu BIGINT NOT NULL,
+    integral_gpu BIGINT NOT NULL,
+    level_ram INTEGER NOT NULL,
+    level_cpu INTEGER NOT NULL,
+    level_gpu INTEGER NOT NULL,
+    last_ts INTEGER NOT NULL,
+    PRIMARY KEY (cluster_id, resolution, bucket),
+    FOREIGN KEY (cluster_id) REFERENCES clusters(id)
+);
+
+-- Create `utilization_watermark` table: events before rolled_up_to are in utilization_rollups
+CREATE TABLE utilization_watermark (
+    id INTEGER PRIMARY KEY,
+    rolled_up_to INTEGER NOT NULL
+);
+
 -- Create `organization_invites` table
 CREATE TABLE organization_invites (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -61,3 +114,12 @@ CREATE TABLE organization_invites (
     used BOOLEAN NOT NULL DEFAULT FALSE,
     FOREIGN KEY (organization_id) REFERENCES organizations(id)
 );
+
+-- Indexes for the hot query paths (GET /deployments, GET /clusters and the scheduler)
+CREATE INDEX ix_deployments_user_id ON deployments (user_id);
+CREATE INDEX ix_deployments_cluster_id_status ON deployments (cluster_id, status);
+CREATE INDEX ix_deployments_status_priority_created_at ON deployments (status, priority, created_at);
+CREATE INDEX ix_clusters_organization_id ON clusters (organization_id);
+
+-- Rolling up reads events by time
+CREATE INDEX ix_utilization_events_ts ON utilization_events (ts);
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+import redis
+from queue_backends import get_connection_pool
+
+# A deployment status change, published after the change is committed
+StatusEvent = namedtuple('StatusEvent', ['deployment_id', 'user_id', 'status', 'cluster_id'])
+
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT_SECONDS = 15
+
+# Events buffered per subscriber; a client that falls further behind is told to resync
+MAX_BUFFERED_EVENTS = 1000
+
+# Seconds the Redis listener waits before reconnecting after losing its connection
+RECONNECT_SECONDS = 1
+
+logger = logging.getLogger(__name__)
+
+
+def format_sse(event, data):
+    """Encodes one server-sent event with a JSON data payload."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+# Sent on idle streams so proxies keep the connection open
+KEEP_ALIVE = ': keep-alive\n\n'
+
+# Last event of a stream whose client fell more than MAX_BUFFERED_EVENTS behind
+RESYNC = format_sse('resync', {'message': 'Too many events buffered; reload the deployments and reconnect.'})
+
+
+class Subscription:
+    def __init__(self, broadcaster, user_id, deployment_ids=(), loop=None):
+        """
+        Buffers the status events of one user's deployments (only deployment_ids,
+        if given) for one client. Blocking clients call get(); clients on an event
+        loop pass it as loop and await get_async(). If more than
+        MAX_BUFFERED_EVENTS pile up, later events are dropped and overflowed is set.
+        """
+        self.user_id = user_id
+        self.deployment_ids = set(deployment_ids)
+        self.overflowed = False
+        self._broadcaster = broadcaster
+        self._loop = loop
+        self._events = (asyncio.Queue if loop is not None else queue.Queue)(MAX_BUFFERED_EVENTS)
+
+    def matches(self, event):
+        return not self.deployment_ids or event.deployment_id in self.deployment_ids
+
+    def deliver(self, event):
+        """Queues an event for the client; safe to call from any thread."""
+        if self._loop is None:
+            self._put(event)
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The client's event loop has closed
+            self.close()
+
+    def _put(self, event):
+        try:
+            self._events.put_nowait(event)
+        except (queue.Full, asyncio.QueueFull):
+            self.overflowed = True
+
+    def get(self, timeout=HEARTBEAT_SECONDS):
+        """Returns the next event, or None if none arrives within timeout seconds."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def get_async(self, timeout=HEARTBEAT_SECONDS):
+        """Awaitable get() for subscriptions made with a loop."""
+        try:
+            return await asyncio.wait_for(self._events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broadcaster:
+    """
+    Fans deployment status events out to the clients streaming them, so clients
+    learn about transitions without polling GET /deployments.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def publish(self, events):
+        """Sends StatusEvents to every subscriber of their users, in any process sharing the broadcaster."""
+        raise NotImplementedError
+
+    def subscribe(self, user_id, deployment_ids=(), loop=None):
+        """Returns a Subscription to a user's status events (see Subscription)."""
+        subscription = Subscription(self, user_id, deployment_ids, loop)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+    def subscriber_count(self):
+        """Returns the number of open subscriptions in this process."""
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def _fanout(self, events):
+        with self._lock:
+            subscribers = {event.user_id: list(self._subscribers.get(event.user_id, ())) for event in events}
+        for event in events:
+            for subscription in subscribers[event.user_id]:
+                if subscription.matches(event):
+                    subscription.deliver(event)
+
+
+class InProcessBroadcaster(Broadcaster):
+    """Delivers events to subscribers in this process only, for the in-process queue backend and tests."""
+
+    def publish(self, events):
+        if events:
+            self._fanout(events)
+
+
+class RedisBroadcaster(Broadcaster):
+    def __init__(self, host='localhost', port=6379, max_connections=None, channel='deployment_events'):
+        """
+        Publishes events on a Redis pub/sub channel, one message per batch, so
+        events from the scheduler worker reach the API processes. Each process
+        holds a single subscription to the channel, opened by a listener thread on
+        first subscribe, and fans the events out to its own clients.
+        """
+        super().__init__()
+        self.redis = redis.Redis(connection_pool=get_connection_pool(host, port, 0, max_connections))
+        self.channel = channel
+        self._listener = None
+
+    def publish(self, events):
+        if events:
+            self.redis.publish(self.channel, json.dumps([event._asdict() for event in events]))
+
+    def subscribe(self, user_id, deployment_ids=(), loop=None):
+        with self._lock:
+            if self._listener is None:
+                # Subscribed before returning, so the caller sees every event published from now on
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._listener = threading.Thread(target=self._listen, args=(pubsub,), name='event-listener',
+                                                  daemon=True)
+                self._listener.start()
+        return super().subscribe(user_id, deployment_ids, loop)
+
+    def _listen(self, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._fanout([StatusEvent(**event) for event in json.loads(message['data'])])
+            except redis.exceptions.ConnectionError:
+                # The PubSub resubscribes when it reconnects; events published meanwhile are lost
+                logger.warning("event_listener_disconnected channel=%s", self.channel)
+                time.sleep(RECONNECT_SECONDS)
+
+
+def create_broadcaster(config):
+    """
+    Builds the status event broadcaster matching config['QUEUE_BACKEND']: Redis
+    pub/sub for the Redis backend, in-process for the in-process queue.
+    """
+    if config.get('QUEUE_BACKEND', 'redis') == 'memory':
+        return InProcessBroadcaster()
+    return RedisBroadcaster(config.get('REDIS_HOST', 'localhost'), config.get('REDIS_PORT', 6379),
+                            config.get('REDIS_MAX_CONNECTIONS'))
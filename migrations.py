@@ -0,0 +1,267 @@
+import argparse
+import logging
+import time
+from sqlalchemy import (
+    MetaData, Table, Column, Index, Integer, BigInteger, String, Boolean, TIMESTAMP, ForeignKey,
+    func, inspect, literal, select, insert, text,
+)
+
+logger = logging.getLogger(__name__)
+
+# Each migration is applied once, in order, and recorded in this table
+VERSION_TABLE = 'schema_migrations'
+
+
+def _initial_schema(connection):
+    """
+    Creates the original tables as the first release's db.create_all did (skipping any
+    that exist). Later changes to them are made by the migrations that follow.
+    """
+    metadata = MetaData()
+    Table('organizations', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('name', String, unique=True, nullable=False))
+    Table('users', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('username', String, unique=True, nullable=False),
+          Column('password', String, nullable=False),
+          Column('organization_id', Integer, ForeignKey('organizations.id')))
+    Table('clusters', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('name', String, unique=True, nullable=False),
+          Column('total_ram', Integer, nullable=False),
+          Column('total_cpu', Integer, nullable=False),
+          Column('total_gpu', Integer, nullable=False),
+          Column('available_ram', Integer, nullable=False),
+          Column('available_cpu', Integer, nullable=False),
+          Column('available_gpu', Integer, nullable=False),
+          Column('organization_id', Integer, ForeignKey('organizations.id')))
+    Table('deployments', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('name', String, nullable=False),
+          Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('cluster_id', Integer, ForeignKey('clusters.id'), nullable=False),
+          Column('docker_image', String, nullable=False),
+          Column('required_ram', Integer, nullable=False),
+          Column('required_cpu', Integer, nullable=False),
+          Column('required_gpu', Integer, nullable=False),
+          Column('status', String, nullable=False, server_default='queued'),
+          Column('priority', Integer, nullable=False, server_default='1'),
+          Column('created_at', TIMESTAMP, server_default=func.current_timestamp()))
+    Table('organization_invites', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('organization_id', Integer, ForeignKey('organizations.id'), nullable=False),
+          Column('code', String, unique=True, nullable=False),
+          Column('used', Boolean, nullable=False, server_default='0'))
+    metadata.create_all(connection, checkfirst=True)
+
+
+def _hot_path_indexes(connection):
+    """Indexes the filters used by GET /deployments, GET /clusters and the scheduler."""
+    metadata = MetaData()
+    deployments = Table('deployments', metadata, autoload_with=connection)
+    clusters = Table('clusters', metadata, autoload_with=connection)
+    indexes = [
+        Index('ix_deployments_user_id', deployments.c.user_id),
+        Index('ix_deployments_cluster_id_status', deployments.c.cluster_id, deployments.c.status),
+        Index('ix_deployments_status_priority_created_at',
+              deployments.c.status, deployments.c.priority, deployments.c.created_at),
+        Index('ix_clusters_organization_id', clusters.c.organization_id),
+    ]
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _gang_deployments(connection):
+    """Adds deployments.replicas and the table recording where gang replicas were placed."""
+    columns = {column['name'] for column in inspect(connection).get_columns('deployments')}
+    if 'replicas' not in columns:
+        connection.execute(text("ALTER TABLE deployments ADD COLUMN replicas INTEGER NOT NULL DEFAULT 1"))
+    metadata = MetaData()
+    Table('deployments', metadata, autoload_with=connection)
+    Table('clusters', metadata, autoload_with=connection)
+    Table('deployment_placements', metadata,
+          Column('deployment_id', Integer, ForeignKey('deployments.id'), primary_key=True),
+          Column('cluster_id', Integer, ForeignKey('clusters.id'), primary_key=True),
+          Column('replicas', Integer, nullable=False))
+    metadata.create_all(connection, checkfirst=True)
+
+
+def _utilization_history(connection):
+    """
+    Adds the allocation event log, its rollups and the roll-up watermark. Allocations
+    already running are logged as one event per cluster, so history starts at their level.
+    """
+    metadata = MetaData()
+    clusters = Table('clusters', metadata, autoload_with=connection)
+    events = Table('utilization_events', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('cluster_id', Integer, ForeignKey('clusters.id'), nullable=False),
+                   Column('ts', Integer, nullable=False),
+                   Column('ram', Integer, nullable=False),
+                   Column('cpu', Integer, nullable=False),
+                   Column('gpu', Integer, nullable=False),
+                   Index('ix_utilization_events_ts', 'ts'))
+    Table('utilization_rollups', metadata,
+          Column('cluster_id', Integer, ForeignKey('clusters.id'), primary_key=True),
+          Column('resolution', Integer, primary_key=True),
+          Column('bucket', Integer, primary_key=True),
+          Column('integral_ram', BigInteger, nullable=False),
+          Column('integral_cpu', BigInteger, nullable=False),
+          Column('integral_gpu', BigInteger, nullable=False),
+          Column('level_ram', Integer, nullable=False),
+          Column('level_cpu', Integer, nullable=False),
+          Column('level_gpu', Integer, nullable=False),
+          Column('last_ts', Integer, nullable=False))
+    Table('utilization_watermark', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('rolled_up_to', Integer, nullable=False))
+    metadata.create_all(connection, checkfirst=True)
+    if connection.execute(select(func.count()).select_from(events)).scalar():
+        return
+    connection.execute(insert(events).from_select(
+        ['cluster_id', 'ts', 'ram', 'cpu', 'gpu'],
+        select(clusters.c.id, literal(int(time.time())), clusters.c.total_ram - clusters.c.available_ram,
+               clusters.c.total_cpu - clusters.c.available_cpu, clusters.c.total_gpu - clusters.c.available_gpu)
+        .where((clusters.c.total_ram != clusters.c.available_ram) | (clusters.c.total_cpu != clusters.c.available_cpu)
+               | (clusters.c.total_gpu != clusters.c.available_gpu))))
+
+
+def _rebuild_sqlite_table(connection, table, indexes):
+    """
+    Replaces a SQLite table with the given definition, which SQLite's ALTER TABLE cannot
+    reach (e.g. changing a column's nullability): the rows are copied into a new table
+    that then takes the old one's name, and the indexes ({name: column names}) are
+    created again.
+    """
+    name = table.name
+    existing = {column['name'] for column in inspect(connection).get_columns(name)}
+    copied = ', '.join(column.name for column in table.columns if column.name in existing)
+    rebuilt = table.to_metadata(table.metadata, name=f'{name}_rebuilt')
+    rebuilt.create(connection)
+    connection.execute(text(f"INSERT INTO {rebuilt.name} ({copied}) SELECT {copied} FROM {name}"))
+    connection.execute(text(f"DROP TABLE {name}"))
+    connection.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {name}"))
+    for index_name, column_names in indexes.items():
+        Index(index_name, *(table.c[column_name] for column_name in column_names)).create(connection)
+
+
+def _deployment_targets(connection):
+    """
+    Brings the first release's tables to what organization-wide deployments need:
+    adds deployments.organization_id, makes deployments.cluster_id optional and
+    requires clusters.organization_id. Fails if a cluster has no organization.
+    """
+    inspector = inspect(connection)
+    deployment_columns = {column['name']: column for column in inspector.get_columns('deployments')}
+    cluster_columns = {column['name']: column for column in inspector.get_columns('clusters')}
+    if ('organization_id' in deployment_columns and deployment_columns['cluster_id']['nullable']
+            and not cluster_columns['organization_id']['nullable']):
+        return
+    orphans = connection.execute(text("SELECT COUNT(*) FROM clusters WHERE organization_id IS NULL")).scalar()
+    if orphans:
+        raise RuntimeError(f"{orphans} clusters have no organization; assign them one before upgrading")
+
+    if connection.dialect.name != 'sqlite':
+        if 'organization_id' not in deployment_columns:
+            connection.execute(text(
+                "ALTER TABLE deployments ADD COLUMN organization_id INTEGER REFERENCES organizations(id)"))
+        connection.execute(text("ALTER TABLE deployments ALTER COLUMN cluster_id DROP NOT NULL"))
+        connection.execute(text("ALTER TABLE clusters ALTER COLUMN organization_id SET NOT NULL"))
+        return
+
+    metadata = MetaData()
+    Table('organizations', metadata, autoload_with=connection)
+    Table('users', metadata, autoload_with=connection)
+    clusters = Table('clusters', metadata,
+                     Column('id', Integer, primary_key=True),
+                     Column('name', String, unique=True, nullable=False),
+                     Column('total_ram', Integer, nullable=False),
+                     Column('total_cpu', Integer, nullable=False),
+                     Column('total_gpu', Integer, nullable=False),
+                     Column('available_ram', Integer, nullable=False),
+                     Column('available_cpu', Integer, nullable=False),
+                     Column('available_gpu', Integer, nullable=False),
+                     Column('organization_id', Integer, ForeignKey('organizations.id'), nullable=False))
+    deployments = Table('deployments', metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('name', String, nullable=False),
+                        Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+                        Column('cluster_id', Integer, ForeignKey('clusters.id')),
+                        Column('organization_id', Integer, ForeignKey('organizations.id')),
+                        Column('docker_image', String, nullable=False),
+                        Column('required_ram', Integer, nullable=False),
+                        Column('required_cpu', Integer, nullable=False),
+                        Column('required_gpu', Integer, nullable=False),
+                        Column('status', String, nullable=False, server_default='queued'),
+                        Column('priority', Integer, nullable=False, server_default='1'),
+                        Column('replicas', Integer, nullable=False, server_default='1'),
+                        Column('created_at', TIMESTAMP, server_default=func.current_timestamp()))
+    _rebuild_sqlite_table(connection, clusters, {
+        'ix_clusters_organization_id': ['organization_id'],
+    })
+    _rebuild_sqlite_table(connection, deployments, {
+        'ix_deployments_user_id': ['user_id'],
+        'ix_deployments_cluster_id_status': ['cluster_id', 'status'],
+        'ix_deployments_status_priority_created_at': ['status', 'priority', 'created_at'],
+    })
+
+
+# (version, description, function). Append new migrations; never edit applied ones.
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'hot path indexes', _hot_path_indexes),
+    (3, 'gang deployments', _gang_deployments),
+    (4, 'utilization history', _utilization_history),
+    (5, 'deployment targets', _deployment_targets),
+]
+
+
+def _version_table():
+    return Table(VERSION_TABLE, MetaData(),
+                 Column('version', Integer, primary_key=True),
+                 Column('description', String, nullable=False),
+                 Column('applied_at', TIMESTAMP, server_default=func.current_timestamp()))
+
+
+def current_version(engine):
+    """Returns the highest applied migration version, or 0 for an unmanaged database."""
+    if not inspect(engine).has_table(VERSION_TABLE):
+        return 0
+    with engine.connect() as connection:
+        return connection.execute(select(func.max(_version_table().c.version))).scalar() or 0
+
+
+def upgrade(engine):
+    """Applies pending migrations, each in its own transaction. Returns the versions applied."""
+    versions = _version_table()
+    versions.create(engine, checkfirst=True)
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version(engine):
+            continue
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(insert(versions).values(version=version, description=description))
+        logger.info("migration_applied version=%s description=%s", version, description)
+        applied.append(version)
+    return applied
+
+
+def main(argv=None):
+    """Command-line entry point, e.g. `python -m migrations upgrade`."""
+    parser = argparse.ArgumentParser(description='Database schema migrations.')
+    parser.add_argument('command', choices=['upgrade', 'version'])
+    args = parser.parse_args(argv)
+
+    from app import app
+    from models import db
+    with app.app_context():
+        if args.command == 'upgrade':
+            for version in upgrade(db.engine):
+                print(f"Applied migration {version}")
+        print(f"Schema version: {current_version(db.engine)}")
+
+
+if __name__ == '__main__':
+    main()
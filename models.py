@@ -1,6 +1,7 @@
 # models.py
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship
+from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
@@ -12,6 +13,16 @@ class User(db.Model):
   organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
   
   organization = relationship("Organization", back_populates="users")
+
+  def set_password(self, password):
+    """Stores a hash of the password and drops any cached credentials for the user."""
+    from utils import credential_cache
+    self.password = generate_password_hash(password)
+    credential_cache.invalidate(self.username)
+
+  def verify_password(self, password):
+    """Checks a password against the stored hash."""
+    return check_password_hash(self.password, password)
   
 class Organization(db.Model):
   __tablename__ = 'organizations'
@@ -32,26 +43,84 @@ class Cluster(db.Model):
   available_ram = db.Column(db.Integer, nullable=False)
   available_cpu = db.Column(db.Integer, nullable=False)
   available_gpu = db.Column(db.Integer, nullable=False)
-  organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
+  organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
   
   organization = relationship("Organization", back_populates="clusters")
+
+  __table_args__ = (
+    db.Index('ix_clusters_organization_id', 'organization_id'),
+  )
   
 class Deployment(db.Model):
   __tablename__ = 'deployments'
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String, nullable=False)
   user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-  cluster_id = db.Column(db.Integer, db.ForeignKey('clusters.id'), nullable=False)
+  # Left empty to let the scheduler pick any cluster in organization_id
+  cluster_id = db.Column(db.Integer, db.ForeignKey('clusters.id'))
+  organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
   docker_image = db.Column(db.String, nullable=False)
   required_ram = db.Column(db.Integer, nullable=False)
   required_cpu = db.Column(db.Integer, nullable=False)
   required_gpu = db.Column(db.Integer, nullable=False)
   status = db.Column(db.String, nullable=False, default='queued')
   priority = db.Column(db.Integer, nullable=False, default=1)
+  # Identical replicas placed all-or-nothing (a gang); each needs required_ram/cpu/gpu
+  replicas = db.Column(db.Integer, nullable=False, default=1)
   created_at = db.Column(db.TIMESTAMP, server_default=db.func.current_timestamp())
   
   user = relationship("User")
   cluster = relationship("Cluster")
+
+  # Schema changes go through migrations.py as well; tests/test_migrations.py checks they match
+  __table_args__ = (
+    db.Index('ix_deployments_user_id', 'user_id'),
+    db.Index('ix_deployments_cluster_id_status', 'cluster_id', 'status'),
+    db.Index('ix_deployments_status_priority_created_at', 'status', 'priority', 'created_at'),
+  )
+  
+class DeploymentPlacement(db.Model):
+  # Where the replicas of a running gang (replicas > 1) were placed; cluster_id on the
+  # deployment is the cluster holding most of them
+  __tablename__ = 'deployment_placements'
+  deployment_id = db.Column(db.Integer, db.ForeignKey('deployments.id'), primary_key=True)
+  cluster_id = db.Column(db.Integer, db.ForeignKey('clusters.id'), primary_key=True)
+  replicas = db.Column(db.Integer, nullable=False)
+  
+class UtilizationEvent(db.Model):
+  # Append-only log of allocation changes: ram/cpu/gpu are positive when resources are
+  # reserved on the cluster and negative when returned. ts is in epoch seconds.
+  __tablename__ = 'utilization_events'
+  id = db.Column(db.Integer, primary_key=True)
+  cluster_id = db.Column(db.Integer, db.ForeignKey('clusters.id'), nullable=False)
+  ts = db.Column(db.Integer, nullable=False)
+  ram = db.Column(db.Integer, nullable=False)
+  cpu = db.Column(db.Integer, nullable=False)
+  gpu = db.Column(db.Integer, nullable=False)
+
+  __table_args__ = (
+    db.Index('ix_utilization_events_ts', 'ts'),
+  )
+  
+class UtilizationRollup(db.Model):
+  # Allocation events folded into buckets of each resolution (see utilization.Rollup)
+  __tablename__ = 'utilization_rollups'
+  cluster_id = db.Column(db.Integer, db.ForeignKey('clusters.id'), primary_key=True)
+  resolution = db.Column(db.Integer, primary_key=True)
+  bucket = db.Column(db.Integer, primary_key=True)
+  integral_ram = db.Column(db.BigInteger, nullable=False)
+  integral_cpu = db.Column(db.BigInteger, nullable=False)
+  integral_gpu = db.Column(db.BigInteger, nullable=False)
+  level_ram = db.Column(db.Integer, nullable=False)
+  level_cpu = db.Column(db.Integer, nullable=False)
+  level_gpu = db.Column(db.Integer, nullable=False)
+  last_ts = db.Column(db.Integer, nullable=False)
+  
+class UtilizationWatermark(db.Model):
+  # A single row: events with ts before rolled_up_to are in utilization_rollups
+  __tablename__ = 'utilization_watermark'
+  id = db.Column(db.Integer, primary_key=True)
+  rolled_up_to = db.Column(db.Integer, nullable=False)
   
 class OrganizationInvite(db.Model):
   __tablename__ = 'organization_invites'
@@ -0,0 +1,223 @@
+import heapq
+from collections import deque
+import numpy as np
+
+# Available placement strategies, selected with Scheduler(strategy=...)
+STRATEGIES = ('first_fit', 'best_fit', 'drf', 'backfill')
+
+
+def replica_room(request, capacity, count):
+    """
+    Returns how many replicas of request (ram, cpu, gpu) fit in each row of
+    capacity (an m x 3 array), limited by each requested resource and capped at count.
+    """
+    room = np.where(request > 0, np.clip(capacity, 0, None) // np.maximum(request, 1), count)
+    return np.minimum(room.min(axis=1), count)
+
+
+class PlacementEngine:
+    def __init__(self, strategy='first_fit'):
+        """
+        Initializes the engine with one of STRATEGIES:
+            first_fit: place each deployment, in queue order, on the first cluster it fits.
+            best_fit: like first_fit, but pick the cluster left with the least spare capacity.
+            drf: serve users in order of their dominant resource share (Dominant Resource
+                 Fairness), so one user's large backlog cannot starve everyone else.
+            backfill: first_fit, but the first deployment that does not fit holds the
+                      capacity it needs on its closest cluster, and later deployments may
+                      only use what is left over.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown placement strategy: {strategy}")
+        self.strategy = strategy
+
+    def place(self, requests, allowed, free, totals, owners=None, usage=None, reserved=None,
+              replicas=None, splits=None):
+        """
+        Decides placements for a batch of deployments given in queue order.
+        A deployment with several replicas (a gang) is placed all-or-nothing: every
+        replica is placed, on one cluster if any has room for all of them and
+        otherwise spread over the fewest allowed clusters, or none is.
+        Expects:
+            requests (n x 3 array): required (ram, cpu, gpu) per deployment (per replica).
+            allowed (n x m bool array): True where deployment i may run on cluster j.
+            free (m x 3 array): available (ram, cpu, gpu) per cluster.
+            totals (m x 3 array): total (ram, cpu, gpu) per cluster.
+            owners (n array, optional): owning user per deployment, for drf.
+            usage (dict, optional): user -> (ram, cpu, gpu) already running, for drf.
+            reserved (m x 3 array, optional): capacity already held for a blocked deployment.
+            replicas (n array, optional): replicas per deployment, 1 if not given.
+            splits (dict, optional): filled with {i: {cluster index: replicas}} for the
+                placed deployments with more than one replica.
+        Returns:
+            (tuple): assignments, an n array with the chosen cluster index (for gangs, the
+                     one holding most replicas) or -1 for deployments that do not fit,
+                     and the updated reserved array.
+        """
+        requests = np.asarray(requests, dtype=np.int64).reshape(-1, 3)
+        allowed = np.asarray(allowed, dtype=bool).reshape(len(requests), -1)
+        totals = np.asarray(totals, dtype=np.int64).reshape(-1, 3)
+        reserved = (np.zeros_like(totals) if reserved is None
+                    else np.array(reserved, dtype=np.int64).reshape(-1, 3))
+        available = np.asarray(free, dtype=np.int64).reshape(-1, 3) - reserved
+        assignments = np.full(len(requests), -1, dtype=np.int64)
+        replicas = (np.ones(len(requests), dtype=np.int64) if replicas is None
+                    else np.asarray(replicas, dtype=np.int64).reshape(len(requests)))
+        splits = {} if splits is None else splits
+
+        # Free capacity only shrinks during a batch, so anything that fits nowhere
+        # now can be ruled out for the whole batch in one vectorized check.
+        fits_now = (allowed & (requests[:, None, :] <= available[None, :, :]).all(axis=2)).any(axis=1)
+
+        if self.strategy == 'drf':
+            order = self._drf_order(requests * replicas[:, None], fits_now, available, totals, owners, usage,
+                                    assignments)
+            for i in order:
+                self._assign(i, requests, replicas, allowed, available, totals, assignments, splits)
+            return assignments, reserved
+
+        for i in range(len(requests)):
+            if fits_now[i] and self._assign(i, requests, replicas, allowed, available, totals, assignments, splits):
+                continue
+            if self.strategy == 'backfill' and not reserved.any() and allowed[i].any():
+                # Head-of-line deployment: hold what it needs on its closest cluster
+                demand = requests[i] * replicas[i]
+                j = self._closest(demand, allowed[i], available, totals)
+                hold = np.clip(np.minimum(demand, available[j]), 0, None)
+                reserved[j] += hold
+                available[j] -= hold
+        return assignments, reserved
+
+    def _assign(self, i, requests, replicas, allowed, available, totals, assignments, splits):
+        """Places deployment i on a cluster chosen by the strategy. Returns True if it fit."""
+        if replicas[i] > 1:
+            return self._assign_gang(i, requests[i], replicas[i], allowed, available, totals, assignments, splits)
+        fit = allowed[i] & (available >= requests[i]).all(axis=1)
+        candidates = np.flatnonzero(fit)
+        if not len(candidates):
+            return False
+        j = self._pick(candidates, requests[i], available, totals)
+        available[j] -= requests[i]
+        assignments[i] = j
+        return True
+
+    def _pick(self, candidates, demand, available, totals):
+        """Chooses among clusters that fit a demand: the first, or the tightest for best_fit."""
+        if self.strategy == 'best_fit':
+            leftover = ((available[candidates] - demand) / np.maximum(totals[candidates], 1)).sum(axis=1)
+            return candidates[np.argmin(leftover)]
+        return candidates[0]
+
+    def _assign_gang(self, i, request, count, allowed, available, totals, assignments, splits):
+        """
+        Places all count replicas of deployment i, or none. The number of replicas each
+        allowed cluster can hold is computed in one vectorized step, so the cost does
+        not grow with the gang size. Returns True if the gang was placed.
+        """
+        candidates = np.flatnonzero(allowed[i])
+        if not len(candidates):
+            return False
+        room = replica_room(request, available[candidates], count)
+        if room.sum() < count:
+            return False
+
+        whole = candidates[room == count]
+        if len(whole):
+            split = {self._pick(whole, request * count, available, totals).item(): count.item()}
+        else:
+            # Spread over the fewest clusters: take the roomiest first
+            split = {}
+            remaining = count.item()
+            for k in np.argsort(-room, kind='stable'):
+                take = min(room[k].item(), remaining)
+                split[candidates[k].item()] = take
+                remaining -= take
+                if not remaining:
+                    break
+        for j, replicas in split.items():
+            available[j] -= request * replicas
+        assignments[i] = max(split, key=split.get)
+        splits[int(i)] = split
+        return True
+
+    @staticmethod
+    def _closest(request, allowed_row, available, totals):
+        """Returns the allowed cluster with the smallest normalized shortfall for a request."""
+        candidates = np.flatnonzero(allowed_row)
+        shortfall = (np.clip(request - available[candidates], 0, None)
+                     / np.maximum(totals[candidates], 1)).sum(axis=1)
+        return candidates[np.argmin(shortfall)]
+
+    def _drf_order(self, requests, fits_now, available, totals, owners, usage, assignments):
+        """
+        Yields deployment indices in Dominant Resource Fairness order: the user with the
+        lowest dominant share goes next, and shares are updated after every placement.
+        """
+        owners = np.zeros(len(requests), dtype=np.int64) if owners is None else np.asarray(owners)
+        usage = usage or {}
+        capacity = np.maximum(totals.sum(axis=0), 1)
+
+        pending = {}
+        for i in np.flatnonzero(fits_now):
+            pending.setdefault(owners[i].item(), deque()).append(i)
+        allocated = {owner: np.asarray(usage.get(owner, (0, 0, 0)), dtype=np.int64) for owner in pending}
+
+        # Ties go to the user whose next deployment has waited longest
+        heap = [((allocated[owner] / capacity).max(), indices[0], owner) for owner, indices in pending.items()]
+        heapq.heapify(heap)
+        while heap:
+            _, _, owner = heapq.heappop(heap)
+            indices = pending[owner]
+            i = indices.popleft()
+            yield i
+            if assignments[i] >= 0:
+                allocated[owner] = allocated[owner] + requests[i]
+            if indices:
+                heapq.heappush(heap, ((allocated[owner] / capacity).max(), indices[0], owner))
+
+
+def select_victims(shortfall, held, priorities):
+    """
+    Picks a small set of running deployments whose release covers a shortfall.
+    Candidates are widened one priority tier at a time, so nothing is evicted while
+    lower priorities alone would do. Within the tier, candidates are taken greedily
+    by how much of the remaining shortfall they cover, and any that turn out to be
+    redundant are dropped again. Ties go to the earlier candidate, so callers order
+    candidates by preference (e.g. lowest priority, most recently started first).
+    Expects:
+        shortfall (3 array): (ram, cpu, gpu) still missing on the cluster.
+        held (k x 3 array): resources held by each candidate.
+        priorities (k array): priority of each candidate.
+    Returns:
+        (list): indices of the chosen candidates, or None if evicting every
+                candidate would still not cover the shortfall.
+    """
+    shortfall = np.clip(np.asarray(shortfall, dtype=np.int64), 0, None)
+    if not shortfall.any():
+        return []
+    held = np.asarray(held, dtype=np.int64).reshape(-1, 3)
+    priorities = np.asarray(priorities)
+
+    for tier in np.unique(priorities):
+        pool = np.flatnonzero(priorities <= tier)
+        if (held[pool].sum(axis=0) >= shortfall).all():
+            break
+    else:
+        return None
+
+    scale = np.maximum(shortfall, 1)
+    remaining = shortfall.copy()
+    chosen = []
+    while remaining.any():
+        coverage = (np.minimum(held[pool], remaining) / scale).sum(axis=1)
+        best = np.argmax(coverage)
+        chosen.append(pool[best].item())
+        remaining = np.clip(remaining - held[pool[best]], 0, None)
+        pool = np.delete(pool, best)
+
+    # Later picks may have made earlier ones unnecessary
+    for victim in reversed(list(chosen)):
+        others = [c for c in chosen if c != victim]
+        if (held[others].sum(axis=0) >= shortfall).all():
+            chosen = others
+    return chosen
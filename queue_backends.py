@@ -0,0 +1,607 @@
+import asyncio
+import heapq
+import sqlite3
+import threading
+import time
+from collections import deque
+import redis
+import redis.asyncio
+
+# Available queue backends, selected with the QUEUE_BACKEND setting
+QUEUE_BACKENDS = ('redis', 'memory')
+
+# Scores order a queue by priority (highest first) and then by enqueue
+# sequence, so the lowest score is always the next deployment to schedule.
+PRIORITY_STRIDE = 2 ** 40
+
+# Returned by wait() when new deployments were enqueued anywhere
+ALL_QUEUES = 'all'
+
+# Bound on pending capacity-freed signals kept when no worker is consuming them
+MAX_FREED_SIGNALS = 1000
+
+# Seconds a popped deployment stays leased to the worker that popped it; recover()
+# puts it back in line if the lease is neither renewed nor ended by then
+LEASE_SECONDS = 60
+
+
+class QueueBackend:
+    """
+    Priority queues of deployment IDs, one per target cluster plus an unsharded
+    queue (cluster_id None) for deployments that may run on any cluster in their
+    organization. Every backend orders a queue by priority, highest first, and
+    then by enqueue order, and wakes a waiting worker when work arrives.
+    Popped deployments are leased rather than removed outright, so that a worker
+    dying mid-pass does not lose them.
+    """
+
+    def enqueue(self, entries):
+        """Adds (deployment_id, priority, cluster_id) entries to their queues, in order."""
+        raise NotImplementedError
+
+    def pop(self, cluster_id=None, count=1):
+        """
+        Removes and returns up to count (deployment_id, score) pairs from the front
+        of a queue. They stay in flight, leased for lease_seconds, until they are
+        acknowledged with ack() or put back with restore().
+        """
+        raise NotImplementedError
+
+    def restore(self, cluster_id, scores):
+        """
+        Puts popped deployments back into a queue at their original {deployment_id: score}
+        positions, ending their lease.
+        """
+        raise NotImplementedError
+
+    def ack(self, *deployment_ids):
+        """Ends the lease of popped deployments that are done with (placed, failed or dropped)."""
+        raise NotImplementedError
+
+    def renew(self, deployment_ids):
+        """Extends the lease of popped deployments still being worked on by lease_seconds."""
+        raise NotImplementedError
+
+    def recover(self):
+        """
+        Puts popped deployments whose lease expired, e.g. because the worker holding
+        them died, back at their original positions and wakes the worker. Returns
+        how many were recovered.
+        """
+        raise NotImplementedError
+
+    def queued_ids(self):
+        """Returns the set of deployment IDs waiting in any queue or in flight."""
+        raise NotImplementedError
+
+    def requeue(self, deployment_id, priority=None, cluster_id=None):
+        """
+        Moves a deployment behind the others of its priority, using the priority
+        recorded at enqueue time when none is given. Returns the priority, or None
+        if the deployment is unknown.
+        """
+        raise NotImplementedError
+
+    def length(self, cluster_id=None):
+        """Returns the number of deployments in a queue."""
+        raise NotImplementedError
+
+    def depth_by_priority(self, cluster_id=None):
+        """Returns {priority: number of deployments} for a queue."""
+        raise NotImplementedError
+
+    def forget(self, *deployment_ids):
+        """Drops the recorded priority of deployments that will not be queued again."""
+        raise NotImplementedError
+
+    def cluster_ids(self):
+        """Returns the sorted IDs of clusters that have had deployments queued for them."""
+        raise NotImplementedError
+
+    def notify_freed(self, cluster_id):
+        """Records that capacity was released on a cluster."""
+        raise NotImplementedError
+
+    def wait(self, timeout=5):
+        """
+        Blocks until capacity is freed or a deployment is enqueued. Returns the freed
+        cluster's ID, ALL_QUEUES for new deployments, or None if the timeout
+        (seconds) expires first. Freed capacity is reported first.
+        """
+        raise NotImplementedError
+
+
+# Adds deployments to their queues in one atomic round trip.
+# KEYS: sequence, priorities, clusters, wakeup, then the queue of each entry.
+# ARGV: PRIORITY_STRIDE, then deployment_id, priority, cluster_id ('' for none) per entry.
+ENQUEUE_SCRIPT = """
+local count = #KEYS - 4
+local last = redis.call('INCRBY', KEYS[1], count)
+for i = 1, count do
+  local base = 2 + (i - 1) * 3
+  local deployment_id, priority, cluster_id = ARGV[base], ARGV[base + 1], ARGV[base + 2]
+  redis.call('HSET', KEYS[2], deployment_id, priority)
+  redis.call('ZADD', KEYS[4 + i], -tonumber(priority) * tonumber(ARGV[1]) + last - count + i, deployment_id)
+  if cluster_id ~= '' then
+    redis.call('SADD', KEYS[3], cluster_id)
+  end
+end
+redis.call('RPUSH', KEYS[4], 1)
+redis.call('LTRIM', KEYS[4], 0, 0)
+return count
+"""
+
+# Moves a deployment to the back of its priority band, using the recorded priority if none is given.
+# KEYS: sequence, priorities, queue. ARGV: PRIORITY_STRIDE, deployment_id, priority ('' for recorded).
+REQUEUE_SCRIPT = """
+local priority = ARGV[3]
+if priority == '' then
+  priority = redis.call('HGET', KEYS[2], ARGV[2])
+  if not priority then
+    return false
+  end
+end
+local sequence = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[3], -tonumber(priority) * tonumber(ARGV[1]) + sequence, ARGV[2])
+return priority
+"""
+
+# Pops from a queue and leases the popped deployments in one step.
+# KEYS: queue, in-flight leases, in-flight entries. ARGV: count, lease deadline.
+POP_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1], ARGV[1])
+for i = 1, #popped, 2 do
+  redis.call('ZADD', KEYS[2], ARGV[2], popped[i])
+  redis.call('HSET', KEYS[3], popped[i], KEYS[1] .. ' ' .. popped[i + 1])
+end
+return popped
+"""
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host='localhost', port=6379, db=0, max_connections=None):
+    """Returns the process-wide Redis connection pool for a server, creating it on first use."""
+    key = (host, port, db)
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = redis.ConnectionPool(host=host, port=port, db=db,
+                                                          max_connections=max_connections)
+        return _connection_pools[key]
+
+
+class RedisQueue(QueueBackend):
+    def __init__(self, host='localhost', port=6379, max_connections=None, name='deployment_queue',
+                 lease_seconds=LEASE_SECONDS):
+        """
+        Keeps the queues in Redis sorted sets, so the API and any number of worker
+        processes share them. Connections come from a pool shared by every queue
+        in the process for the same server. Popped deployments are moved, in the
+        same script call, to a sorted set of leases scored by expiry, with their
+        queue and score kept in a hash so they can be put back where they were.
+        """
+        self.redis = redis.Redis(connection_pool=get_connection_pool(host, port, 0, max_connections))
+        self._enqueue_script = self.redis.register_script(ENQUEUE_SCRIPT)
+        self._requeue_script = self.redis.register_script(REQUEUE_SCRIPT)
+        self._pop_script = self.redis.register_script(POP_SCRIPT)
+        self.lease_seconds = lease_seconds
+        self.queue_name = name
+        self.sequence_name = f'{name}:seq'
+        self.priority_name = f'{name}:priority'
+        self.wakeup_name = f'{name}:wakeup'
+        self.clusters_name = f'{name}:clusters'
+        self.freed_name = f'{name}:freed'
+        self.inflight_name = f'{name}:inflight'
+        self.inflight_entries_name = f'{name}:inflight:entries'
+
+    def _queue_key(self, cluster_id=None):
+        """Returns the sorted set holding deployments for a cluster; None selects the unsharded queue."""
+        if cluster_id is None:
+            return self.queue_name
+        return f'{self.queue_name}:cluster:{cluster_id}'
+
+    def enqueue(self, entries):
+        """
+        Adds entries with one atomic script call however many there are. The worker
+        is woken through a wake-up list that never holds more than one token.
+        """
+        if entries:
+            self._enqueue_script(**self._enqueue_arguments(entries))
+
+    def _enqueue_arguments(self, entries):
+        """Returns the keys and args of ENQUEUE_SCRIPT for the given entries."""
+        keys = [self.sequence_name, self.priority_name, self.clusters_name, self.wakeup_name]
+        args = [PRIORITY_STRIDE]
+        for deployment_id, priority, cluster_id in entries:
+            keys.append(self._queue_key(cluster_id))
+            args.extend([deployment_id, priority, '' if cluster_id is None else cluster_id])
+        return {'keys': keys, 'args': args}
+
+    def pop(self, cluster_id=None, count=1):
+        popped = self._pop_script(keys=[self._queue_key(cluster_id), self.inflight_name, self.inflight_entries_name],
+                                  args=[count, time.time() + self.lease_seconds])
+        return [(int(popped[i]), float(popped[i + 1])) for i in range(0, len(popped), 2)]
+
+    def restore(self, cluster_id, scores):
+        if scores:
+            pipe = self.redis.pipeline()
+            pipe.zadd(self._queue_key(cluster_id), scores)
+            pipe.zrem(self.inflight_name, *scores)
+            pipe.hdel(self.inflight_entries_name, *scores)
+            pipe.execute()
+
+    def ack(self, *deployment_ids):
+        if deployment_ids:
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.inflight_name, *deployment_ids)
+            pipe.hdel(self.inflight_entries_name, *deployment_ids)
+            pipe.execute()
+
+    def renew(self, deployment_ids):
+        deadline = time.time() + self.lease_seconds
+        if deployment_ids:
+            self.redis.zadd(self.inflight_name, {deployment_id: deadline for deployment_id in deployment_ids}, xx=True)
+
+    def recover(self):
+        expired = self.redis.zrangebyscore(self.inflight_name, '-inf', time.time())
+        if not expired:
+            return 0
+        # Only the caller whose ZREM succeeds puts a deployment back, so concurrent
+        # recoveries and late acknowledgements never both act on it
+        pipe = self.redis.pipeline(transaction=False)
+        for deployment_id in expired:
+            pipe.zrem(self.inflight_name, deployment_id)
+        claimed = [deployment_id for deployment_id, removed in zip(expired, pipe.execute()) if removed]
+        if not claimed:
+            return 0
+        entries = self.redis.hmget(self.inflight_entries_name, claimed)
+        pipe = self.redis.pipeline()
+        for deployment_id, entry in zip(claimed, entries):
+            if entry is not None:
+                queue_key, score = entry.decode().rsplit(' ', 1)
+                pipe.zadd(queue_key, {deployment_id: float(score)})
+        pipe.hdel(self.inflight_entries_name, *claimed)
+        pipe.rpush(self.wakeup_name, 1)
+        pipe.ltrim(self.wakeup_name, 0, 0)
+        pipe.execute()
+        return len(claimed)
+
+    def queued_ids(self):
+        pipe = self.redis.pipeline(transaction=False)
+        for cluster_id in [None] + self.cluster_ids():
+            pipe.zrange(self._queue_key(cluster_id), 0, -1)
+        pipe.hkeys(self.inflight_entries_name)
+        return {int(deployment_id) for members in pipe.execute() for deployment_id in members}
+
+    def requeue(self, deployment_id, priority=None, cluster_id=None):
+        priority = self._requeue_script(
+            keys=[self.sequence_name, self.priority_name, self._queue_key(cluster_id)],
+            args=[PRIORITY_STRIDE, deployment_id, '' if priority is None else priority],
+        )
+        return None if priority is None else int(priority)
+
+    def length(self, cluster_id=None):
+        return self.redis.zcard(self._queue_key(cluster_id))
+
+    def depth_by_priority(self, cluster_id=None):
+        """Counts one priority band at a time, so a scrape costs O(priorities * log n), not O(n)."""
+        key = self._queue_key(cluster_id)
+        depths = {}
+        start = '-inf'
+        while True:
+            head = self.redis.zrangebyscore(key, start, '+inf', start=0, num=1, withscores=True)
+            if not head:
+                return depths
+            priority = -int(head[0][1] // PRIORITY_STRIDE)
+            band_end = -(priority - 1) * PRIORITY_STRIDE
+            depths[priority] = self.redis.zcount(key, -priority * PRIORITY_STRIDE, f'({band_end}')
+            start = band_end
+
+    def forget(self, *deployment_ids):
+        if deployment_ids:
+            self.redis.hdel(self.priority_name, *deployment_ids)
+
+    def cluster_ids(self):
+        return sorted(int(cluster_id) for cluster_id in self.redis.smembers(self.clusters_name))
+
+    def notify_freed(self, cluster_id):
+        pipe = self.redis.pipeline()
+        pipe.rpush(self.freed_name, cluster_id)
+        pipe.ltrim(self.freed_name, -MAX_FREED_SIGNALS, -1)
+        pipe.execute()
+
+    def wait(self, timeout=5):
+        return self._decode_wakeup(self.redis.blpop([self.freed_name, self.wakeup_name], timeout=timeout))
+
+    def _decode_wakeup(self, popped):
+        """Turns a BLPOP result on the freed and wake-up lists into a wait() result."""
+        if popped is None:
+            return None
+        key, value = popped
+        if key.decode() == self.freed_name:
+            return int(value)
+        return ALL_QUEUES
+
+
+class InProcessQueue(QueueBackend):
+    def __init__(self, path=None, lease_seconds=LEASE_SECONDS):
+        """
+        Keeps the queues in heaps inside this process, for single-node installs and
+        tests: no network round trips, but the API and the scheduler worker must run
+        in the same process. Safe to use from several threads. With a path, queued
+        deployments are also written to that SQLite file and reloaded on start-up;
+        popped deployments stay in the file until acknowledged, so those in flight
+        when the process died are back in line after a restart. Wake-ups and
+        capacity-freed signals are not persisted.
+        """
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        # Heaps hold (score, deployment_id); entries whose score no longer matches
+        # _scores are stale (popped or moved) and are skipped when they surface.
+        self._heaps = {}
+        self._scores = {}
+        self._priorities = {}
+        self._clusters = set()
+        self._sequence = 0
+        self._woken = False
+        self._freed = deque(maxlen=MAX_FREED_SIGNALS)
+        # Popped deployments: deployment_id -> (cluster_id, score, lease deadline)
+        self._inflight = {}
+        self.lease_seconds = lease_seconds
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._load()
+
+    def _load(self):
+        """Creates the persistence tables if needed and reloads the saved queues."""
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS queue_entries (
+                queue TEXT NOT NULL,
+                deployment_id INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (queue, deployment_id)
+            );
+            CREATE TABLE IF NOT EXISTS queue_priorities (
+                deployment_id INTEGER PRIMARY KEY,
+                priority INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue_state (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        for queue, deployment_id, score in self._db.execute('SELECT queue, deployment_id, score FROM queue_entries'):
+            cluster_id = int(queue) if queue else None
+            self._add(cluster_id, deployment_id, score)
+            if cluster_id is not None:
+                self._clusters.add(cluster_id)
+        self._priorities = dict(self._db.execute('SELECT deployment_id, priority FROM queue_priorities'))
+        row = self._db.execute("SELECT value FROM queue_state WHERE name = 'sequence'").fetchone()
+        self._sequence = row[0] if row else 0
+
+    def _persist(self, cluster_id=None, scores=(), removed=(), priorities=(), forgotten=()):
+        """Writes queue changes through to SQLite in one transaction, if persistence is enabled."""
+        if self._db is None:
+            return
+        queue = '' if cluster_id is None else str(cluster_id)
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.executemany('INSERT OR REPLACE INTO queue_entries VALUES (?, ?, ?)',
+                                 [(queue, deployment_id, score) for deployment_id, score in scores])
+            self._db.executemany('DELETE FROM queue_entries WHERE queue = ? AND deployment_id = ?',
+                                 [(queue, deployment_id) for deployment_id in removed])
+            self._db.executemany('INSERT OR REPLACE INTO queue_priorities VALUES (?, ?)', priorities)
+            self._db.executemany('DELETE FROM queue_priorities WHERE deployment_id = ?',
+                                 [(deployment_id,) for deployment_id in forgotten])
+            self._db.execute("INSERT OR REPLACE INTO queue_state VALUES ('sequence', ?)", (self._sequence,))
+
+    def _add(self, cluster_id, deployment_id, score):
+        """Places a deployment in a queue, moving it if it is already there. Caller holds the lock."""
+        self._scores.setdefault(cluster_id, {})[deployment_id] = score
+        heapq.heappush(self._heaps.setdefault(cluster_id, []), (score, deployment_id))
+
+    def enqueue(self, entries):
+        if not entries:
+            return
+        queues = {}
+        with self._work:
+            for deployment_id, priority, cluster_id in entries:
+                deployment_id, priority = int(deployment_id), int(priority)
+                self._sequence += 1
+                score = -priority * PRIORITY_STRIDE + self._sequence
+                self._add(cluster_id, deployment_id, score)
+                self._priorities[deployment_id] = priority
+                queues.setdefault(cluster_id, []).append((deployment_id, score))
+                if cluster_id is not None:
+                    self._clusters.add(cluster_id)
+            for cluster_id, scores in queues.items():
+                self._persist(cluster_id, scores=scores,
+                              priorities=[(deployment_id, self._priorities[deployment_id])
+                                          for deployment_id, _ in scores])
+            self._woken = True
+            self._work.notify_all()
+
+    def pop(self, cluster_id=None, count=1):
+        with self._lock:
+            heap = self._heaps.get(cluster_id, [])
+            scores = self._scores.get(cluster_id, {})
+            popped = []
+            while heap and len(popped) < count:
+                score, deployment_id = heapq.heappop(heap)
+                if scores.get(deployment_id) == score:
+                    del scores[deployment_id]
+                    popped.append((deployment_id, score))
+            deadline = time.monotonic() + self.lease_seconds
+            for deployment_id, score in popped:
+                self._inflight[deployment_id] = (cluster_id, score, deadline)
+            return popped
+
+    def restore(self, cluster_id, scores):
+        if not scores:
+            return
+        with self._lock:
+            for deployment_id, score in scores.items():
+                self._add(cluster_id, int(deployment_id), int(score))
+                self._inflight.pop(int(deployment_id), None)
+            self._persist(cluster_id, scores=[(int(deployment_id), int(score))
+                                              for deployment_id, score in scores.items()])
+
+    def ack(self, *deployment_ids):
+        removed = {}
+        with self._lock:
+            for deployment_id in deployment_ids:
+                entry = self._inflight.pop(int(deployment_id), None)
+                if entry is not None:
+                    removed.setdefault(entry[0], []).append(int(deployment_id))
+            for cluster_id, queue_removed in removed.items():
+                self._persist(cluster_id, removed=queue_removed)
+
+    def renew(self, deployment_ids):
+        deadline = time.monotonic() + self.lease_seconds
+        with self._lock:
+            for deployment_id in deployment_ids:
+                entry = self._inflight.get(int(deployment_id))
+                if entry is not None:
+                    self._inflight[int(deployment_id)] = entry[:2] + (deadline,)
+
+    def recover(self):
+        now = time.monotonic()
+        with self._work:
+            expired = [deployment_id for deployment_id, (_, _, deadline) in self._inflight.items() if deadline <= now]
+            for deployment_id in expired:
+                cluster_id, score, _ = self._inflight.pop(deployment_id)
+                self._add(cluster_id, deployment_id, score)
+            if expired:
+                self._woken = True
+                self._work.notify_all()
+            return len(expired)
+
+    def queued_ids(self):
+        with self._lock:
+            return set(self._inflight).union(*self._scores.values())
+
+    def requeue(self, deployment_id, priority=None, cluster_id=None):
+        deployment_id = int(deployment_id)
+        with self._lock:
+            if priority is None:
+                priority = self._priorities.get(deployment_id)
+                if priority is None:
+                    return None
+            self._sequence += 1
+            score = -int(priority) * PRIORITY_STRIDE + self._sequence
+            self._add(cluster_id, deployment_id, score)
+            self._persist(cluster_id, scores=[(deployment_id, score)])
+            return int(priority)
+
+    def length(self, cluster_id=None):
+        with self._lock:
+            return len(self._scores.get(cluster_id, {}))
+
+    def depth_by_priority(self, cluster_id=None):
+        depths = {}
+        with self._lock:
+            for score in self._scores.get(cluster_id, {}).values():
+                priority = -(score // PRIORITY_STRIDE)
+                depths[priority] = depths.get(priority, 0) + 1
+        return depths
+
+    def forget(self, *deployment_ids):
+        if not deployment_ids:
+            return
+        with self._lock:
+            for deployment_id in deployment_ids:
+                self._priorities.pop(int(deployment_id), None)
+            self._persist(forgotten=[int(deployment_id) for deployment_id in deployment_ids])
+
+    def cluster_ids(self):
+        with self._lock:
+            return sorted(self._clusters)
+
+    def notify_freed(self, cluster_id):
+        with self._work:
+            self._freed.append(int(cluster_id))
+            self._work.notify_all()
+
+    def wait(self, timeout=5):
+        with self._work:
+            self._work.wait_for(lambda: self._freed or self._woken, timeout or None)
+            if self._freed:
+                return self._freed.popleft()
+            if self._woken:
+                self._woken = False
+                return ALL_QUEUES
+            return None
+
+
+class AsyncQueue:
+    def __init__(self, backend):
+        """
+        Awaitable versions of the operations the ASGI server needs from a backend.
+        This generic version runs them on a worker thread; RedisQueue gets a native
+        redis.asyncio implementation from create_async_queue.
+        """
+        self.backend = backend
+
+    async def enqueue(self, entries):
+        await asyncio.to_thread(self.backend.enqueue, entries)
+
+    async def notify_freed(self, cluster_id):
+        await asyncio.to_thread(self.backend.notify_freed, cluster_id)
+
+    async def wait(self, timeout=5):
+        return await asyncio.to_thread(self.backend.wait, timeout)
+
+    async def close(self):
+        pass
+
+
+class AsyncRedisQueue(AsyncQueue):
+    def __init__(self, backend):
+        """Runs a RedisQueue's enqueue, notify and wait on redis.asyncio, over the same keys."""
+        super().__init__(backend)
+        kwargs = backend.redis.connection_pool.connection_kwargs
+        self.redis = redis.asyncio.Redis(host=kwargs.get('host', 'localhost'), port=kwargs.get('port', 6379),
+                                         db=kwargs.get('db', 0),
+                                         max_connections=backend.redis.connection_pool.max_connections)
+        self._enqueue_script = self.redis.register_script(ENQUEUE_SCRIPT)
+
+    async def enqueue(self, entries):
+        if entries:
+            await self._enqueue_script(**self.backend._enqueue_arguments(entries))
+
+    async def notify_freed(self, cluster_id):
+        pipe = self.redis.pipeline()
+        pipe.rpush(self.backend.freed_name, cluster_id)
+        pipe.ltrim(self.backend.freed_name, -MAX_FREED_SIGNALS, -1)
+        await pipe.execute()
+
+    async def wait(self, timeout=5):
+        return self.backend._decode_wakeup(
+            await self.redis.blpop([self.backend.freed_name, self.backend.wakeup_name], timeout=timeout))
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_async_queue(backend):
+    """Returns an AsyncQueue for a backend, native for Redis and thread-backed otherwise."""
+    if isinstance(backend, RedisQueue):
+        return AsyncRedisQueue(backend)
+    return AsyncQueue(backend)
+
+
+def create_queue_backend(config):
+    """
+    Builds the queue backend named by config['QUEUE_BACKEND'] (see QUEUE_BACKENDS)
+    from the service settings.
+    """
+    backend = config.get('QUEUE_BACKEND', 'redis')
+    lease_seconds = config.get('QUEUE_LEASE_SECONDS', LEASE_SECONDS)
+    if backend == 'redis':
+        return RedisQueue(config.get('REDIS_HOST', 'localhost'), config.get('REDIS_PORT', 6379),
+                          config.get('REDIS_MAX_CONNECTIONS'), lease_seconds=lease_seconds)
+    if backend == 'memory':
+        return InProcessQueue(config.get('QUEUE_PATH') or None, lease_seconds)
+    raise ValueError(f"Unknown queue backend: {backend}")
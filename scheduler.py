@@ -1,103 +1,1031 @@
-import redis
-from models import db, Deployment, Cluster
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from datetime import datetime, timezone
+from flask import current_app
+import numpy as np
+from sqlalchemy import and_, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import (
+    db, Deployment, DeploymentPlacement, Cluster, UtilizationEvent, UtilizationRollup, UtilizationWatermark,
+)
+from placement import PlacementEngine, select_victims
+from queue_backends import ALL_QUEUES, RedisQueue
+from metrics import REGISTRY
+from capacity import InProcessCapacityIndex, capacity_from_row, reconcile
+from events import InProcessBroadcaster, StatusEvent
+from admission import Admission, InProcessUsageTable, estimate_start_seconds, fits, quota_for
+from utilization import (
+    RESOLUTIONS, ROLLUP_DELAY_SECONDS, allocated_seconds, resolution_for, roll_up, rollup_from_row, rollup_values,
+)
+
+# Statuses after which a deployment no longer holds or waits for resources
+TERMINAL_STATUSES = ('completed', 'failed', 'stopped')
+
+# Statuses of deployments waiting in the queue for resources
+QUEUEABLE_STATUSES = ('queued', 'preempted')
+
+# Statuses of deployments counted against their organization's quota
+OUTSTANDING_STATUSES = QUEUEABLE_STATUSES + ('running',)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_PASS_SECONDS = REGISTRY.histogram(
+    'scheduler_pass_seconds', 'Duration of full scheduling passes.')
+PLACEMENTS = REGISTRY.counter(
+    'scheduler_placements_total', 'Deployments placed on a cluster.')
+PLACEMENT_RATE = REGISTRY.gauge(
+    'scheduler_last_pass_placements_per_second', 'Placement throughput of the last full pass.')
+TIME_TO_PLACEMENT_SECONDS = REGISTRY.histogram(
+    'scheduler_time_to_placement_seconds', 'Time from submission to placement.',
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600))
+REQUEUES = REGISTRY.counter(
+    'scheduler_requeues_total', 'Deployments put back in the queue, by reason.', ['reason'])
+QUEUE_OPERATION_SECONDS = REGISTRY.histogram(
+    'scheduler_queue_operation_seconds', 'Queue backend call latency by operation.', ['operation'])
+CAPACITY_DRIFT = REGISTRY.counter(
+    'scheduler_capacity_drift_total', 'Cluster fields found out of date when reconciling the capacity index.')
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    'scheduler_admission_rejections_total', 'Deployments rejected at submission, by reason.', ['reason'])
+UTILIZATION_EVENTS_ROLLED_UP = REGISTRY.counter(
+    'scheduler_utilization_events_rolled_up_total', 'Allocation events folded into utilization rollups.')
+
+
+def capacity_query():
+    """Selects the Cluster columns held in the capacity index."""
+    return select(Cluster.id, Cluster.name, Cluster.organization_id,
+                  Cluster.total_ram, Cluster.total_cpu, Cluster.total_gpu,
+                  Cluster.available_ram, Cluster.available_cpu, Cluster.available_gpu)
+
+def usage_query():
+    """
+    Selects (organization_id, ram, cpu, gpu, deployments) queued or running per
+    organization, for the usage table. Deployments targeting a cluster count
+    against the cluster's organization.
+    """
+    organization_id = func.coalesce(Deployment.organization_id, Cluster.organization_id)
+    return (select(organization_id, func.sum(Deployment.required_ram * Deployment.replicas),
+                   func.sum(Deployment.required_cpu * Deployment.replicas),
+                   func.sum(Deployment.required_gpu * Deployment.replicas), func.count())
+            .select_from(Deployment).outerjoin(Cluster, Deployment.cluster_id == Cluster.id)
+            .where(Deployment.status.in_(OUTSTANDING_STATUSES), organization_id.is_not(None))
+            .group_by(organization_id))
+
+def rollup_query():
+    """Selects the UtilizationRollup columns a Rollup is built from, with the cluster and resolution."""
+    return select(UtilizationRollup.cluster_id, UtilizationRollup.resolution, UtilizationRollup.bucket,
+                  UtilizationRollup.integral_ram, UtilizationRollup.integral_cpu, UtilizationRollup.integral_gpu,
+                  UtilizationRollup.level_ram, UtilizationRollup.level_cpu, UtilizationRollup.level_gpu,
+                  UtilizationRollup.last_ts)
 
 class Scheduler:
-    def __init__(self, redis_host='localhost', redis_port=6379):
-        """Initializes the scheduler with a connection to Redis."""
-        self.queue = redis.Redis(host=redis_host, port=redis_port, db=0)
-        self.queue_name = 'deployment_queue'
-
-    def enqueue_deployment(self, deployment_id):
-        """Adds a deployment ID to the right end of the queue."""
-        self.queue.rpush(self.queue_name, deployment_id)
-        print(f"Deployment {deployment_id} added to the queue.")
-
-    def dequeue_deployment(self):
-        """Removes and returns the deployment ID from the left end of the queue (FIFO)."""
-        deployment_id = self.queue.lpop(self.queue_name)
-        if deployment_id:
-            print(f"Deployment {deployment_id.decode()} removed from the queue.")
-            return int(deployment_id)
+    def __init__(self, redis_host='localhost', redis_port=6379, max_workers=8, batch_size=100,
+                 strategy='first_fit', preemption=False, redis_max_connections=None, queue=None,
+                 capacity=None, events=None, usage=None, quotas=None, event_retention_seconds=7 * 24 * 3600):
+        """
+        Initializes the scheduler with a queue backend (see queue_backends), by
+        default Redis at redis_host:redis_port with a connection pool shared by
+        every Scheduler in the process for the same server, and a cluster
+        capacity index (see capacity), by default in-process. Status changes are
+        published to events (see events), by default an in-process broadcaster.
+        Submissions are checked by admit() against quotas ({organization_id or
+        'default': Quota}, see admission.parse_quotas; unlimited by default) using
+        the usage table usage, by default in-process. Every reservation and release
+        is logged as an allocation event for utilization history (see
+        roll_up_utilization); events are kept event_retention_seconds after being
+        rolled up, or forever if None.
+        Deployments are queued per target cluster; max_workers bounds how many
+        cluster queues are scheduled concurrently, and batch_size how many
+        deployments are popped and committed together. strategy selects the
+        placement strategy (see placement.STRATEGIES). With preemption enabled,
+        a deployment that does not fit may evict lower-priority running
+        deployments on its cluster.
+        """
+        self.queue = queue if queue is not None else RedisQueue(redis_host, redis_port, redis_max_connections)
+        self.capacity = capacity if capacity is not None else InProcessCapacityIndex()
+        self.events = events if events is not None else InProcessBroadcaster()
+        self.usage = usage if usage is not None else InProcessUsageTable()
+        self.quotas = quotas if quotas is not None else {}
+        self.event_retention_seconds = event_retention_seconds
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.placement = PlacementEngine(strategy)
+        self.preemption = preemption
+        self.last_pass = None
+
+    def enqueue_deployment(self, deployment_id, priority=1, cluster_id=None):
+        """Adds a deployment ID to its cluster's queue behind all deployments of equal or higher priority."""
+        self.enqueue_deployments([(deployment_id, priority, cluster_id)])
+        logger.debug("deployment_enqueued deployment_id=%s priority=%s cluster_id=%s",
+                     deployment_id, priority, cluster_id)
+
+    def enqueue_deployments(self, entries):
+        """Adds (deployment_id, priority, cluster_id) entries to their queues, in order, and wakes the worker."""
+        with QUEUE_OPERATION_SECONDS.time(operation='enqueue'):
+            self.queue.enqueue(entries)
+
+    def dequeue_deployment(self, cluster_id=None):
+        """
+        Removes and returns the highest-priority, oldest deployment ID from a cluster's
+        queue. The caller takes it over, so it is acknowledged at once rather than leased.
+        """
+        with QUEUE_OPERATION_SECONDS.time(operation='pop'):
+            popped = self.queue.pop(cluster_id)
+        if popped:
+            deployment_id = popped[0][0]
+            self.ack_deployments(deployment_id)
+            logger.debug("deployment_dequeued deployment_id=%s cluster_id=%s", deployment_id, cluster_id)
+            return deployment_id
         return None
 
-    def get_queue_length(self):
-        """Returns the current number of deployments in the queue."""
-        length = self.queue.llen(self.queue_name)
-        print(f"Current queue length: {length}")
-        return length
+    def get_queue_length(self, cluster_id=None):
+        """Returns the current number of deployments in a cluster's queue."""
+        return self.queue.length(cluster_id)
+
+    def queue_depth_by_priority(self):
+        """Returns {priority: number of queued deployments} summed over every queue."""
+        depths = {}
+        for cluster_id in self.queued_cluster_ids() + [None]:
+            for priority, depth in self.queue.depth_by_priority(cluster_id).items():
+                depths[priority] = depths.get(priority, 0) + depth
+        return depths
+
+    def forget_deployment(self, *deployment_ids):
+        """Drops the stored priority of deployments that will not be queued again."""
+        with QUEUE_OPERATION_SECONDS.time(operation='forget'):
+            self.queue.forget(*deployment_ids)
+
+    def ack_deployments(self, *deployment_ids):
+        """Ends the queue leases of popped deployments once their outcome is committed."""
+        with QUEUE_OPERATION_SECONDS.time(operation='ack'):
+            self.queue.ack(*deployment_ids)
+
+    def recover_queue(self):
+        """
+        Puts popped deployments whose lease expired, because the worker holding them
+        died or stalled mid-pass, back in line. Returns how many were recovered.
+        """
+        with QUEUE_OPERATION_SECONDS.time(operation='recover'):
+            recovered = self.queue.recover()
+        if recovered:
+            REQUEUES.inc(recovered, reason='lease_expired')
+            logger.warning("queue_leases_expired recovered=%d", recovered)
+        return recovered
+
+    def reconcile_queue(self, chunk_size=10000):
+        """
+        Rebuilds the queue from the database: deployments queued or preempted in SQL
+        but neither waiting in a queue nor in flight (lost with a Redis restart, or
+        with a memory queue that was not persisted) are enqueued again, by priority
+        and then submission order. The deployments table is read once, streamed
+        through its status index, and missing deployments are enqueued chunk_size
+        per call, so even a large backlog is back in line in a few round trips.
+        Returns the number enqueued.
+        """
+        present = self.queue.queued_ids()
+        rows = db.session.execute(
+            select(Deployment.id, Deployment.priority, Deployment.cluster_id, Deployment.organization_id)
+            .where(Deployment.status.in_(QUEUEABLE_STATUSES))
+            .order_by(Deployment.priority.desc(), Deployment.created_at, Deployment.id)
+            .execution_options(yield_per=chunk_size))
+        missing = []
+        enqueued = 0
+        for deployment_id, priority, cluster_id, organization_id in rows:
+            if deployment_id in present:
+                continue
+            # Organization-wide deployments wait in the unsharded queue
+            missing.append((deployment_id, priority, None if organization_id is not None else cluster_id))
+            if len(missing) == chunk_size:
+                self.enqueue_deployments(missing)
+                enqueued += len(missing)
+                missing = []
+        if missing:
+            self.enqueue_deployments(missing)
+            enqueued += len(missing)
+        if enqueued:
+            REQUEUES.inc(enqueued, reason='reconciled')
+            logger.warning("queue_reconciled enqueued=%d", enqueued)
+        return enqueued
+
+    def reconcile_state(self, rebuild_queue=False):
+        """
+        The worker's periodic upkeep: rebuilds the capacity index and usage table from
+        the database, recovers expired queue leases and rolls up utilization history.
+        With rebuild_queue, done once at start-up, the queue is also rebuilt from the
+        database (see reconcile_queue).
+        """
+        self.reconcile_capacity()
+        self.reconcile_usage()
+        if rebuild_queue:
+            self.reconcile_queue()
+        self.recover_queue()
+        self.roll_up_utilization()
+
+    def queued_cluster_ids(self):
+        """Returns the IDs of clusters that have had deployments queued for them."""
+        return self.queue.cluster_ids()
+
+    def reconcile_capacity(self):
+        """
+        Rebuilds the capacity index from the clusters table. Returns the drift found,
+        as (cluster_id, field, cached, actual) tuples, which is also logged and counted.
+        """
+        drift = reconcile(self.capacity, db.session.execute(capacity_query()))
+        if drift:
+            CAPACITY_DRIFT.inc(len(drift))
+        return drift
+
+    def cluster_capacities(self, cluster_ids=(), organization_ids=()):
+        """
+        Returns the cached capacity of the given clusters and of every cluster in the
+        given organizations, ordered by ID. The index is loaded on first use, and
+        clusters it does not know yet are read from the database and added.
+        """
+        if not self.capacity.loaded:
+            self.reconcile_capacity()
+        capacities = self.capacity.get_many(cluster_ids)
+        missing = set(cluster_ids) - set(capacities)
+        if missing:
+            for row in db.session.execute(capacity_query().where(Cluster.id.in_(missing))):
+                capacity = capacity_from_row(row)
+                self.capacity.put(capacity)
+                capacities[capacity.id] = capacity
+        if organization_ids:
+            capacities.update((capacity.id, capacity) for capacity in self.capacity.for_organizations(organization_ids))
+        return [capacities[cluster_id] for cluster_id in sorted(capacities)]
+
+    def reconcile_usage(self):
+        """Rebuilds the usage table from the deployments queued or running."""
+        self.usage.load(db.session.execute(usage_query()).all())
+
+    def admit(self, specs):
+        """
+        Admission control for new deployments, given as column values (see
+        app.parse_deployment_spec). A deployment asking for more than its clusters
+        hold in total can never be placed, so it is rejected at once instead of
+        being rescanned by every pass. The rest are checked against their
+        organization's quota and submission rate in the usage table, and those
+        admitted are added to its usage. Returns an Admission per spec; admitted
+        ones carry the estimated wait before they start, from the queue ahead of
+        them, the capacity the running deployments leave free and the recent
+        placement rate.
+        """
+        if not self.usage.loaded:
+            self.reconcile_usage()
+        clusters = self.cluster_capacities(
+            {spec['cluster_id'] for spec in specs if spec['cluster_id'] is not None},
+            {spec['organization_id'] for spec in specs if spec['cluster_id'] is None})
+        clusters_by_id = {c.id: c for c in clusters}
+
+        admissions = [None] * len(specs)
+        candidates = []
+        by_organization = {}
+        for i, spec in enumerate(specs):
+            if spec['cluster_id'] is not None:
+                allowed = [clusters_by_id[spec['cluster_id']]] if spec['cluster_id'] in clusters_by_id else []
+            else:
+                allowed = [c for c in clusters if c.organization_id == spec['organization_id']]
+            candidates.append(allowed)
+            if not fits(self._request(spec), spec['replicas'],
+                        [(c.total_ram, c.total_cpu, c.total_gpu) for c in allowed]):
+                admissions[i] = Admission(None, 'infeasible', self._infeasible_message(spec, allowed))
+            else:
+                by_organization.setdefault(allowed[0].organization_id, []).append(i)
+
+        for organization_id, indices in by_organization.items():
+            demands = [tuple(amount * specs[i]['replicas'] for amount in self._request(specs[i])) for i in indices]
+            exceeded = self.usage.admit(organization_id, demands, quota_for(self.quotas, organization_id))
+            for i, field in zip(indices, exceeded):
+                if field == 'submissions_per_minute':
+                    admissions[i] = Admission(None, 'rate_limited', 'Organization submission rate limit exceeded!')
+                elif field is not None:
+                    admissions[i] = Admission(None, 'quota', f'Organization {field} quota exceeded!')
+
+        placement_rate = self.usage.placement_rate()
+        depths = {}
+        for i, spec in enumerate(specs):
+            if admissions[i] is not None:
+                continue
+            if spec['cluster_id'] not in depths:
+                depths[spec['cluster_id']] = self.queue.depth_by_priority(spec['cluster_id'])
+            depth = depths[spec['cluster_id']]
+            ahead = sum(count for priority, count in depth.items() if priority >= spec['priority'])
+            # Later specs in the same submission queue behind this one
+            depth[spec['priority']] = depth.get(spec['priority'], 0) + 1
+            fits_now = fits(self._request(spec), spec['replicas'],
+                            [(c.available_ram, c.available_cpu, c.available_gpu) for c in candidates[i]])
+            admissions[i] = Admission(estimate_start_seconds(ahead, fits_now, placement_rate), None, None)
+
+        for admission in admissions:
+            if admission.reason is not None:
+                ADMISSION_REJECTIONS.inc(reason=admission.reason)
+                logger.info("deployment_rejected reason=%s message=%r", admission.reason, admission.message)
+        return admissions
+
+    @staticmethod
+    def _request(spec):
+        return spec['required_ram'], spec['required_cpu'], spec['required_gpu']
+
+    @staticmethod
+    def _infeasible_message(spec, allowed):
+        if spec['cluster_id'] is not None:
+            return "Requested resources exceed the cluster's total capacity!" if allowed else 'Cluster not found!'
+        if not allowed:
+            return 'No clusters in the organization!'
+        return "Requested resources exceed the total capacity of the organization's clusters!"
+
+    def release_usage(self, deployments):
+        """Removes deployments that have finished, or will never run, from their organizations' usage."""
+        clusters = {c.id: c for c in self.cluster_capacities(
+            {d.cluster_id for d in deployments if d.organization_id is None and d.cluster_id is not None})}
+        for deployment in deployments:
+            organization_id = deployment.organization_id
+            if organization_id is None and deployment.cluster_id in clusters:
+                organization_id = clusters[deployment.cluster_id].organization_id
+            if organization_id is not None:
+                self.usage.release(organization_id, *(amount * deployment.replicas for amount in (
+                    deployment.required_ram, deployment.required_cpu, deployment.required_gpu)))
 
     def schedule_deployments(self):
         """
-        Implements the main scheduling logic. It checks for available resources
-        and updates deployment status accordingly.
+        Implements the main scheduling logic. Each cluster's queue is scheduled
+        independently on a thread pool, so a saturated cluster does not hold up
+        placement on the others. Resources are reserved with conditional UPDATEs,
+        so concurrent passes, threads or processes never over-commit a cluster.
+        Returns the number of deployments placed; throughput is kept in last_pass.
+        """
+        started = time.perf_counter()
+        cluster_ids = self.queued_cluster_ids()
+        placed = 0
+        if len(cluster_ids) == 1:
+            placed += self.schedule_queue(cluster_ids[0])
+        elif cluster_ids:
+            app = current_app._get_current_object()
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(cluster_ids))) as pool:
+                placed += sum(pool.map(lambda cluster_id: self._schedule_queue_in_app(app, cluster_id),
+                                       cluster_ids))
+        # Deployments targeting any cluster in their organization share the unsharded queue
+        placed += self.schedule_queue()
+
+        elapsed = time.perf_counter() - started
+        rate = placed / elapsed if elapsed > 0 else 0.0
+        SCHEDULE_PASS_SECONDS.observe(elapsed)
+        PLACEMENT_RATE.set(rate)
+        self.last_pass = {'placed': placed, 'seconds': elapsed, 'deployments_per_sec': rate}
+        logger.info("scheduling_pass placed=%d clusters=%d seconds=%.3f deployments_per_sec=%.1f",
+                    placed, len(cluster_ids), elapsed, rate)
+        return placed
+
+    def _schedule_queue_in_app(self, app, cluster_id):
+        """Runs schedule_queue on a worker thread with its own app context and DB session."""
+        with app.app_context():
+            return self.schedule_queue(cluster_id)
+
+    def schedule_queue(self, cluster_id=None, organization_id=None):
+        """
+        Schedules the deployments in one cluster's queue, batch_size at a time.
+        With organization_id, only that organization's deployments are considered;
+        the others are passed over and keep their place.
+        Deployments that do not fit are held back until the queue is drained and
+        then restored at their original positions, so a pass always terminates.
+        If the pass fails, the deployments it still holds (those deferred and the
+        batch in progress) are restored at once rather than when their lease
+        expires, and the error is raised. Returns the number of deployments placed.
+        """
+        placed = 0
+        deferred = {}
+        reservations = {}
+        renewed = time.monotonic()
+        while True:
+            popped = []
+            try:
+                with QUEUE_OPERATION_SECONDS.time(operation='pop'):
+                    popped = self.queue.pop(cluster_id, self.batch_size)
+                if not popped:
+                    break
+                placed += self._schedule_batch(popped, deferred, reservations, organization_id)
+                # Deferred deployments stay leased until the pass ends; keep the lease alive on long passes
+                if time.monotonic() - renewed > self.queue.lease_seconds / 3:
+                    self.queue.renew(deferred)
+                    renewed = time.monotonic()
+            except Exception:
+                db.session.rollback()
+                self._restore_after_failure(cluster_id, {**deferred, **dict(popped)})
+                raise
+
+        # Put them back in a single call, keeping their place in line
+        with QUEUE_OPERATION_SECONDS.time(operation='restore'):
+            self.queue.restore(cluster_id, deferred)
+        logger.debug("queue_pass cluster_id=%s placed=%d deferred=%d", cluster_id, placed, len(deferred))
+        return placed
+
+    def _restore_after_failure(self, cluster_id, scores):
+        """
+        Puts the {deployment_id: score} deployments held by a failed pass back in line.
+        Any already placed are dropped when popped again, since only queued deployments
+        are moved to running. If the queue is unreachable too, they are left to lease expiry.
+        """
+        if not scores:
+            return
+        try:
+            with QUEUE_OPERATION_SECONDS.time(operation='restore'):
+                self.queue.restore(cluster_id, scores)
+        except Exception:
+            logger.exception("pass_restore_failed cluster_id=%s deployments=%d", cluster_id, len(scores))
+            return
+        REQUEUES.inc(len(scores), reason='pass_failed')
+        logger.warning("pass_failed_restored cluster_id=%s deployments=%d", cluster_id, len(scores))
+
+    def _schedule_batch(self, popped, deferred, reservations, organization_id=None):
         """
-        print("Scheduler is running...")
-        while self.get_queue_length() > 0:
-            deployment_id = self.dequeue_deployment()
-            if deployment_id is None:
+        Places a batch of popped (deployment_id, score) pairs. Deployments are loaded
+        with one query and their candidate clusters come from the capacity index; the
+        placement engine decides in memory, and all status and counter changes are
+        written in a single commit. Gangs (deployments with several replicas) are
+        reserved on every cluster they span or on none.
+        Deployments that do not fit, or belong to an organization other than
+        organization_id when one is given, are added to deferred; capacity held for a blocked
+        deployment (backfill strategy) is carried between batches in reservations.
+        A deployment is only moved to running from a queueable status, so one
+        delivered twice (e.g. recovered after its lease expired while the first
+        worker still had it) is placed once; the loser hands its reservation back.
+        Popped deployments are acknowledged once the outcome is committed.
+        Returns the number placed.
+        """
+        deployment_ids = [deployment_id for deployment_id, _ in popped]
+        deployments = {d.id: d for d in Deployment.query.filter(Deployment.id.in_(deployment_ids))}
+
+        pending = []
+        dropped = []
+        for deployment_id, score in popped:
+            deployment = deployments.get(deployment_id)
+            if not deployment:
+                logger.warning("deployment_missing deployment_id=%s", deployment_id)
+                dropped.append(deployment_id)
+            elif deployment.status not in QUEUEABLE_STATUSES:
+                logger.info("deployment_dropped deployment_id=%s status=%s", deployment_id, deployment.status)
+                dropped.append(deployment_id)
+            elif organization_id is not None and deployment.organization_id != organization_id:
+                deferred[deployment_id] = score
+            else:
+                pending.append((deployment, score))
+
+        cluster_ids = {d.cluster_id for d, _ in pending if d.cluster_id is not None}
+        organization_ids = {d.organization_id for d, _ in pending if d.cluster_id is None}
+        clusters = self.cluster_capacities(cluster_ids, organization_ids)
+        cluster_index = {c.id: j for j, c in enumerate(clusters)}
+        cluster_organizations = np.array([c.organization_id for c in clusters])
+
+        allowed = np.zeros((len(pending), len(clusters)), dtype=bool)
+        for i, (deployment, _) in enumerate(pending):
+            if deployment.cluster_id is None:
+                allowed[i] = cluster_organizations == deployment.organization_id
+            elif deployment.cluster_id in cluster_index:
+                allowed[i, cluster_index[deployment.cluster_id]] = True
+
+        owners = [d.user_id for d, _ in pending]
+        splits = {}
+        assignments, reserved = self.placement.place(
+            requests=[(d.required_ram, d.required_cpu, d.required_gpu) for d, _ in pending],
+            allowed=allowed,
+            free=[(c.available_ram, c.available_cpu, c.available_gpu) for c in clusters],
+            totals=[(c.total_ram, c.total_cpu, c.total_gpu) for c in clusters],
+            owners=owners,
+            usage=self._running_usage(owners) if self.placement.strategy == 'drf' else None,
+            reserved=[reservations.get(c.id, (0, 0, 0)) for c in clusters],
+            replicas=[d.replicas for d, _ in pending],
+            splits=splits,
+        )
+        reservations.update({c.id: tuple(reserved[j]) for j, c in enumerate(clusters) if reserved[j].any()})
+
+        placements = {}
+        gangs = []
+        failed = []
+        for i, (deployment, score) in enumerate(pending):
+            if i in splits:
+                gangs.append((deployment, score, {clusters[j].id: count for j, count in splits[i].items()}))
+            elif assignments[i] >= 0:
+                placements.setdefault(clusters[assignments[i]].id, []).append((deployment, score))
+            elif not allowed[i].any():
+                logger.warning("cluster_missing deployment_id=%s cluster_id=%s", deployment.id, deployment.cluster_id)
+                failed.append(deployment.id)
+            else:
+                logger.debug("deployment_deferred deployment_id=%s", deployment.id)
+                deferred[deployment.id] = score
+
+        running = []
+        events = []
+        for placement_cluster_id, group in placements.items():
+            totals = [sum(column) for column in zip(*((d.required_ram, d.required_cpu, d.required_gpu)
+                                                      for d, _ in group))]
+            if not self._reserve(placement_cluster_id, *totals):
+                # The cached capacity was out of date (e.g. another scheduler took it); retry next pass
+                logger.info("reservation_conflict cluster_id=%s deployments=%d", placement_cluster_id, len(group))
+                deferred.update({d.id: score for d, score in group})
+                continue
+            group_ids = set(db.session.execute(
+                update(Deployment)
+                .where(Deployment.id.in_([d.id for d, _ in group]), Deployment.status.in_(QUEUEABLE_STATUSES))
+                .values(status='running', cluster_id=placement_cluster_id)
+                .returning(Deployment.id)
+                .execution_options(synchronize_session=False)
+            ).scalars())
+            if len(group_ids) < len(group):
+                handled = [d for d, _ in group if d.id not in group_ids]
+                logger.info("deployments_already_handled deployment_ids=%s", [d.id for d in handled])
+                self._return_capacity(placement_cluster_id, *(sum(column) for column in zip(
+                    *((d.required_ram, d.required_cpu, d.required_gpu) for d in handled))))
+                dropped.extend(d.id for d in handled)
+                group = [(d, score) for d, score in group if d.id in group_ids]
+            running.extend(d.id for d, _ in group)
+            events.extend(StatusEvent(d.id, d.user_id, 'running', placement_cluster_id) for d, _ in group)
+            self._observe_placements(d for d, _ in group)
+
+        for deployment, score, split in gangs:
+            if not self._reserve_gang(deployment, split):
+                logger.info("gang_reservation_conflict deployment_id=%s clusters=%s", deployment.id, sorted(split))
+                deferred[deployment.id] = score
+                continue
+            main_cluster_id = max(split, key=split.get)
+            result = db.session.execute(
+                update(Deployment)
+                .where(Deployment.id == deployment.id, Deployment.status.in_(QUEUEABLE_STATUSES))
+                .values(status='running', cluster_id=main_cluster_id)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                logger.info("deployments_already_handled deployment_ids=%s", [deployment.id])
+                self._return_replicas(deployment, split)
+                dropped.append(deployment.id)
                 continue
+            db.session.execute(insert(DeploymentPlacement), [
+                {'deployment_id': deployment.id, 'cluster_id': cluster_id, 'replicas': count}
+                for cluster_id, count in split.items()
+            ])
+            running.append(deployment.id)
+            events.append(StatusEvent(deployment.id, deployment.user_id, 'running', main_cluster_id))
+            self._observe_placements([deployment])
+            logger.debug("gang_placed deployment_id=%s split=%s", deployment.id, split)
+
+        preempted = []
+        if self.preemption:
+            for deployment, _ in pending:
+                if deployment.id in deferred and self._preempt_for(deployment, preempted, events):
+                    del deferred[deployment.id]
+                    running.append(deployment.id)
+                    events.append(StatusEvent(deployment.id, deployment.user_id, 'running', deployment.cluster_id))
+                    self._observe_placements([deployment])
+
+        if failed:
+            db.session.execute(
+                update(Deployment).where(Deployment.id.in_(failed)).values(status='failed')
+                .execution_options(synchronize_session=False)
+            )
+            events.extend(StatusEvent(deployment_id, deployments[deployment_id].user_id, 'failed',
+                                      deployments[deployment_id].cluster_id) for deployment_id in failed)
+        db.session.commit()
+        self.ack_deployments(*running, *failed, *dropped)
+        self.publish_status_changes(events)
+        if failed:
+            self.release_usage([deployments[deployment_id] for deployment_id in failed])
+        self.forget_deployment(*running, *failed, *dropped)
+        if preempted:
+            self.enqueue_deployments(preempted)
+            REQUEUES.inc(len(preempted), reason='preempted')
+        return len(running)
+
+    def _observe_placements(self, deployments):
+        """Counts placed deployments and records how long each waited since submission."""
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        placed = 0
+        for deployment in deployments:
+            placed += 1
+            if deployment.created_at is not None:
+                TIME_TO_PLACEMENT_SECONDS.observe(max((now - deployment.created_at).total_seconds(), 0))
+        PLACEMENTS.inc(placed)
+        self.usage.record_placements(placed)
+
+    def _preempt_for(self, deployment, preempted, events):
+        """
+        Evicts a minimal set of lower-priority running deployments from a deployment's
+        cluster so that it fits, then places it. Victims are marked 'preempted', their
+        resources released, and (victim_id, priority, cluster_id) tuples for requeueing
+        after the commit are appended to preempted, and their StatusEvents to events.
+        Returns True if the deployment was placed.
+        """
+        if deployment.cluster_id is None or deployment.replicas > 1:
+            return False
+        available = (db.session.query(Cluster.available_ram, Cluster.available_cpu, Cluster.available_gpu)
+                     .filter(Cluster.id == deployment.cluster_id).one())
+        required = (deployment.required_ram, deployment.required_cpu, deployment.required_gpu)
+        shortfall = [need - have for need, have in zip(required, available)]
+
+        candidates = (Deployment.query
+                      .filter(Deployment.cluster_id == deployment.cluster_id,
+                              Deployment.status == 'running',
+                              Deployment.replicas == 1,
+                              Deployment.priority < deployment.priority)
+                      .order_by(Deployment.priority, Deployment.created_at.desc(), Deployment.id.desc())
+                      .all())
+        victims = select_victims(
+            shortfall,
+            [(c.required_ram, c.required_cpu, c.required_gpu) for c in candidates],
+            [c.priority for c in candidates],
+        )
+        if not victims:
+            return False
+
+        for victim in (candidates[i] for i in victims):
+            logger.info("deployment_preempted deployment_id=%s for_deployment_id=%s cluster_id=%s",
+                        victim.id, deployment.id, victim.cluster_id)
+            if self.release_resources(victim, 'preempted'):
+                # Organization-wide deployments go back to choosing their cluster
+                if victim.organization_id is not None:
+                    db.session.execute(
+                        update(Deployment).where(Deployment.id == victim.id).values(cluster_id=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                preempted.append((victim.id, victim.priority,
+                                  None if victim.organization_id is not None else victim.cluster_id))
+                events.append(StatusEvent(victim.id, victim.user_id, 'preempted', victim.cluster_id))
+
+        if not self.reserve_resources(deployment):
+            return False
+        result = db.session.execute(
+            update(Deployment)
+            .where(Deployment.id == deployment.id, Deployment.status.in_(QUEUEABLE_STATUSES))
+            .values(status='running')
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            self._return_capacity(deployment.cluster_id, deployment.required_ram, deployment.required_cpu,
+                                  deployment.required_gpu)
+            return False
+        return True
+
+    def _running_usage(self, user_ids):
+        """Returns {user_id: (ram, cpu, gpu)} held by the users' running deployments, in one query."""
+        rows = (db.session.query(Deployment.user_id, func.sum(Deployment.required_ram * Deployment.replicas),
+                                 func.sum(Deployment.required_cpu * Deployment.replicas),
+                                 func.sum(Deployment.required_gpu * Deployment.replicas))
+                .filter(Deployment.status == 'running', Deployment.user_id.in_(set(user_ids)))
+                .group_by(Deployment.user_id))
+        return {user_id: (ram, cpu, gpu) for user_id, ram, cpu, gpu in rows}
+
+    def reserve_resources(self, deployment):
+        """
+        Atomically takes a deployment's required resources from its cluster with a
+        single conditional UPDATE, so concurrent schedulers can never over-commit.
+        Returns True if the resources were reserved. The caller commits.
+        """
+        return self._reserve(deployment.cluster_id, deployment.required_ram,
+                             deployment.required_cpu, deployment.required_gpu)
+
+    def _reserve(self, cluster_id, ram, cpu, gpu):
+        """
+        Conditionally subtracts the given amounts from a cluster and from the capacity
+        index. Returns True if they were available; otherwise the cluster's cached
+        capacity is refreshed from the database.
+        """
+        result = db.session.execute(
+            update(Cluster)
+            .where(Cluster.id == cluster_id,
+                   Cluster.available_ram >= ram,
+                   Cluster.available_cpu >= cpu,
+                   Cluster.available_gpu >= gpu)
+            .values(available_ram=Cluster.available_ram - ram,
+                    available_cpu=Cluster.available_cpu - cpu,
+                    available_gpu=Cluster.available_gpu - gpu)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            row = db.session.execute(capacity_query().where(Cluster.id == cluster_id)).one_or_none()
+            if row is not None:
+                self.capacity.put(capacity_from_row(row))
+            return False
+        self.capacity.adjust(cluster_id, -ram, -cpu, -gpu)
+        self._record_allocation(cluster_id, ram, cpu, gpu)
+        return True
+
+    def _reserve_gang(self, deployment, split):
+        """
+        Reserves a gang's replicas on every cluster in split ({cluster_id: replicas}),
+        or on none: reservations already made are handed back if a later cluster
+        turns out to be full. Returns True if all were reserved. The caller commits.
+        """
+        required = (deployment.required_ram, deployment.required_cpu, deployment.required_gpu)
+        reserved = {}
+        for cluster_id, count in split.items():
+            if not self._reserve(cluster_id, *(amount * count for amount in required)):
+                self._return_replicas(deployment, reserved)
+                return False
+            reserved[cluster_id] = count
+        return True
 
-            with db.session.no_autoflush:
-                deployment = Deployment.query.get(deployment_id)
-                if not deployment:
-                    print(f"Deployment {deployment_id} not found.")
-                    continue
-
-                cluster = Cluster.query.get(deployment.cluster_id)
-                if not cluster:
-                    print(f"Cluster for deployment {deployment_id} not found.")
-                    deployment.status = 'failed'
-                    db.session.commit()
-                    continue
-
-                if (cluster.available_ram >= deployment.required_ram and
-                    cluster.available_cpu >= deployment.required_cpu and
-                    cluster.available_gpu >= deployment.required_gpu):
-                    # Allocate resources
-                    print(f"Allocating resources for deployment {deployment_id} on cluster {cluster.id}")
-                    cluster.available_ram -= deployment.required_ram
-                    cluster.available_cpu -= deployment.required_cpu
-                    cluster.available_gpu -= deployment.required_gpu
-                    deployment.status = 'running'
-                    db.session.commit()
-                else:
-                    print(f"Not enough resources for deployment {deployment_id} on cluster {cluster.id}. Requeueing...")
-                    # Put it back based on priority
-                    self.requeue_deployment_by_priority(deployment_id)
-
-    def requeue_deployment_by_priority(self, deployment_id):
+    def _return_replicas(self, deployment, split):
+        """Hands back the capacity of a deployment's replicas on every cluster in split ({cluster_id: replicas})."""
+        for cluster_id, count in split.items():
+            self._return_capacity(cluster_id, deployment.required_ram * count,
+                                  deployment.required_cpu * count, deployment.required_gpu * count)
+
+    def _return_capacity(self, cluster_id, ram, cpu, gpu):
+        """Adds the given amounts back to a cluster and to the capacity index."""
+        db.session.execute(
+            update(Cluster)
+            .where(Cluster.id == cluster_id)
+            .values(available_ram=Cluster.available_ram + ram,
+                    available_cpu=Cluster.available_cpu + cpu,
+                    available_gpu=Cluster.available_gpu + gpu)
+            .execution_options(synchronize_session=False)
+        )
+        self.capacity.adjust(cluster_id, ram, cpu, gpu)
+        self._record_allocation(cluster_id, -ram, -cpu, -gpu)
+
+    def _record_allocation(self, cluster_id, ram, cpu, gpu):
+        """Appends an allocation event (negative for a release) to the utilization history. The caller commits."""
+        db.session.execute(insert(UtilizationEvent).values(
+            cluster_id=cluster_id, ts=int(time.time()), ram=ram, cpu=cpu, gpu=gpu))
+
+    def roll_up_utilization(self, now=None):
+        """
+        Folds the allocation events not rolled up yet, up to ROLLUP_DELAY_SECONDS before
+        now (epoch seconds, default the current time), into utilization_rollups at
+        every resolution, and deletes events older than the retention period. The
+        watermark is advanced with a conditional UPDATE, so if another worker rolled
+        up the same events first, nothing is written. Commits; returns the number of
+        events rolled up.
+        """
+        now = int(time.time()) if now is None else now
+        cutoff = now - ROLLUP_DELAY_SECONDS
+        watermark = db.session.execute(select(UtilizationWatermark.rolled_up_to)).scalar()
+        if watermark is not None and watermark >= cutoff:
+            return 0
+        events = db.session.execute(
+            select(UtilizationEvent.cluster_id, UtilizationEvent.ts,
+                   UtilizationEvent.ram, UtilizationEvent.cpu, UtilizationEvent.gpu)
+            .where(UtilizationEvent.ts >= (watermark or 0), UtilizationEvent.ts < cutoff)
+            .order_by(UtilizationEvent.cluster_id, UtilizationEvent.ts, UtilizationEvent.id)).all()
+        try:
+            if events:
+                self._write_rollups(events)
+            if watermark is None:
+                db.session.execute(insert(UtilizationWatermark).values(id=1, rolled_up_to=cutoff))
+            elif db.session.execute(
+                    update(UtilizationWatermark)
+                    .where(UtilizationWatermark.rolled_up_to == watermark)
+                    .values(rolled_up_to=cutoff)).rowcount != 1:
+                db.session.rollback()
+                return 0
+            if self.event_retention_seconds is not None:
+                db.session.execute(delete(UtilizationEvent).where(
+                    UtilizationEvent.ts < min(watermark or 0, cutoff - self.event_retention_seconds)))
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created the watermark first
+            db.session.rollback()
+            return 0
+        UTILIZATION_EVENTS_ROLLED_UP.inc(len(events))
+        logger.info("utilization_rolled_up events=%d rolled_up_to=%d", len(events), cutoff)
+        return len(events)
+
+    def _write_rollups(self, events):
+        """
+        Folds (cluster_id, ts, ram, cpu, gpu) events, sorted by cluster and time, into
+        each cluster's latest rollups, updating those and inserting the new buckets.
+        The caller commits.
+        """
+        latest = self._latest_rollups({event.cluster_id for event in events})
+        new_rollups = []
+        for cluster_id, cluster_events in groupby(events, key=lambda event: event.cluster_id):
+            changes = [event[1:] for event in cluster_events]
+            for resolution in RESOLUTIONS:
+                previous = latest.get((cluster_id, resolution))
+                for rollup in roll_up(changes, previous, resolution):
+                    values = rollup_values(cluster_id, resolution, rollup)
+                    if previous is not None and rollup.bucket == previous.bucket:
+                        db.session.execute(
+                            update(UtilizationRollup)
+                            .where(UtilizationRollup.cluster_id == cluster_id,
+                                   UtilizationRollup.resolution == resolution,
+                                   UtilizationRollup.bucket == rollup.bucket)
+                            .values(values)
+                            .execution_options(synchronize_session=False))
+                    else:
+                        new_rollups.append(values)
+        if new_rollups:
+            db.session.execute(insert(UtilizationRollup), new_rollups)
+
+    def _latest_rollups(self, cluster_ids, resolution=None):
+        """Returns {(cluster_id, resolution): Rollup} for the latest bucket of each cluster and resolution."""
+        newest = (select(UtilizationRollup.cluster_id, UtilizationRollup.resolution,
+                         func.max(UtilizationRollup.bucket).label('bucket'))
+                  .where(UtilizationRollup.cluster_id.in_(cluster_ids))
+                  .group_by(UtilizationRollup.cluster_id, UtilizationRollup.resolution))
+        if resolution is not None:
+            newest = newest.where(UtilizationRollup.resolution == resolution)
+        newest = newest.subquery()
+        rows = db.session.execute(rollup_query().join(newest, and_(
+            UtilizationRollup.cluster_id == newest.c.cluster_id,
+            UtilizationRollup.resolution == newest.c.resolution,
+            UtilizationRollup.bucket == newest.c.bucket)))
+        return {(row.cluster_id, row.resolution): rollup_from_row(row) for row in rows}
+
+    def cluster_utilization(self, cluster_id, start, end, step, now=None):
+        """
+        Integrates what was allocated on a cluster over [start, end) (epoch seconds,
+        multiples of step, which must be a multiple of a resolution) from the rollups
+        of the widest resolution dividing step, plus the events not rolled up yet.
+        Time after now (default the current time) is not counted. Returns an array
+        of (ram, cpu, gpu) resource-seconds per step and an array of the seconds each covers.
+        """
+        now = int(time.time()) if now is None else now
+        resolution = resolution_for(step)
+        in_cluster = (UtilizationRollup.cluster_id == cluster_id, UtilizationRollup.resolution == resolution)
+        rollups = {rollup.bucket: rollup for rollup in map(rollup_from_row, db.session.execute(
+            rollup_query().where(*in_cluster, UtilizationRollup.bucket >= start, UtilizationRollup.bucket < end)))}
+        before = db.session.execute(
+            rollup_query().where(*in_cluster, UtilizationRollup.bucket < start)
+            .order_by(UtilizationRollup.bucket.desc()).limit(1)).one_or_none()
+        start_level = rollup_from_row(before).level if before is not None else (0, 0, 0)
+
+        watermark = db.session.execute(select(UtilizationWatermark.rolled_up_to)).scalar() or 0
+        if watermark < end:
+            recent = db.session.execute(
+                select(UtilizationEvent.ts, UtilizationEvent.ram, UtilizationEvent.cpu, UtilizationEvent.gpu)
+                .where(UtilizationEvent.cluster_id == cluster_id,
+                       UtilizationEvent.ts >= watermark, UtilizationEvent.ts < end)
+                .order_by(UtilizationEvent.ts, UtilizationEvent.id)).all()
+            if recent:
+                latest = self._latest_rollups([cluster_id], resolution).get((cluster_id, resolution))
+                for rollup in roll_up(recent, latest, resolution):
+                    if rollup.bucket < start:
+                        start_level = rollup.level
+                    else:
+                        rollups[rollup.bucket] = rollup
+        return allocated_seconds([rollups[bucket] for bucket in sorted(rollups)], start_level,
+                                 start, end, resolution, step, now)
+
+    def placement_split(self, deployment):
+        """Returns {cluster_id: replicas} for where a running deployment's replicas are placed."""
+        if deployment.replicas == 1:
+            return {deployment.cluster_id: 1}
+        return dict(db.session.execute(
+            select(DeploymentPlacement.cluster_id, DeploymentPlacement.replicas)
+            .where(DeploymentPlacement.deployment_id == deployment.id)).all())
+
+    def release_resources(self, deployment, status):
+        """
+        Moves a running deployment to the given status and returns its resources to
+        the cluster (every cluster its replicas are on, for a gang), and to its
+        organization's quota if the status is terminal. The status change is
+        conditional on the deployment still running, so resources are released at
+        most once. Returns the IDs of the clusters resources were returned to, empty
+        if nothing was released. The caller commits.
+        """
+        result = db.session.execute(
+            update(Deployment)
+            .where(Deployment.id == deployment.id, Deployment.status == 'running')
+            .values(status=status)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return []
+        split = self.placement_split(deployment)
+        self._return_replicas(deployment, split)
+        if deployment.replicas > 1:
+            db.session.execute(delete(DeploymentPlacement).where(DeploymentPlacement.deployment_id == deployment.id))
+        if status in TERMINAL_STATUSES:
+            self.release_usage([deployment])
+        logger.info("resources_released deployment_id=%s cluster_ids=%s status=%s",
+                    deployment.id, sorted(split), status)
+        return list(split)
+
+    def publish_status_changes(self, events):
+        """Publishes committed StatusEvents to the clients streaming them."""
+        if events:
+            self.events.publish(events)
+            logger.debug("status_changes_published count=%d", len(events))
+
+    def notify_capacity_freed(self, cluster_id):
+        """Tells the worker that resources were released on a cluster, so its queue can be backfilled."""
+        with QUEUE_OPERATION_SECONDS.time(operation='notify_freed'):
+            self.queue.notify_freed(cluster_id)
+
+    def wait_for_work(self, timeout=5):
+        """
+        Blocks until capacity is freed on a cluster or a deployment is enqueued.
+        Returns the freed cluster's ID, ALL_QUEUES for new deployments, or None
+        if the timeout (seconds) expires first. Freed capacity is reported first.
+        """
+        return self.queue.wait(timeout)
+
+    def run_worker(self, poll_timeout=5, reconcile_interval=60):
+        """
+        Runs scheduling passes forever. Between passes the worker blocks until new work
+        arrives. Freed capacity triggers a pass over only that cluster's queue; new
+        deployments, and every poll_timeout seconds without events, trigger a full pass.
+        Every reconcile_interval seconds the capacity index and usage table are
+        reconciled with the database, expired queue leases recovered and utilization
+        history rolled up; on start-up the queue is also rebuilt from the database (see
+        reconcile_state). A failed iteration (e.g. the database locked past its busy
+        timeout, or a dropped Redis connection) is logged, its transaction rolled back,
+        and the worker retries with a full pass after poll_timeout seconds.
+        """
+        logger.info("worker_started poll_timeout=%s reconcile_interval=%s", poll_timeout, reconcile_interval)
+        woken = ALL_QUEUES
+        next_reconcile = time.monotonic()
+        started = True
+        while True:
+            try:
+                if time.monotonic() >= next_reconcile:
+                    self.reconcile_state(rebuild_queue=started)
+                    started = False
+                    next_reconcile = time.monotonic() + reconcile_interval
+                self.handle_wakeup(woken)
+                db.session.remove()
+                woken = self.wait_for_work(poll_timeout)
+            except Exception:
+                logger.exception("worker_iteration_failed woken=%s", woken)
+                db.session.rollback()
+                db.session.remove()
+                time.sleep(poll_timeout)
+                woken = ALL_QUEUES
+
+    def handle_wakeup(self, woken):
+        """
+        Runs the pass a wait_for_work result calls for: a full pass for new deployments
+        and timeouts, or for freed capacity the freed cluster's queue and then the
+        organization-wide deployments of the cluster's organization, which may use it
+        too. Returns the number placed.
+        """
+        if woken is None or woken == ALL_QUEUES:
+            return self.schedule_deployments()
+        placed = self.schedule_queue(woken)
+        freed = self.cluster_capacities([woken])
+        if freed:
+            placed += self.schedule_queue(None, organization_id=freed[0].organization_id)
+        return placed
+
+    def requeue_deployment_by_priority(self, deployment_id, priority=None, cluster_id=None):
         """
         Re-inserts a deployment into the queue based on its priority.
-        Higher priority deployments are placed ahead of lower priority ones.
+        Higher priority deployments are placed ahead of lower priority ones; within
+        a priority the requeued deployment goes behind those already waiting.
+        The priority recorded at enqueue time is used when none is given.
         """
-        deployment = Deployment.query.get(deployment_id)
-        if not deployment:
-            print(f"Deployment {deployment_id} not found for requeueing.")
+        with QUEUE_OPERATION_SECONDS.time(operation='requeue'):
+            priority = self.queue.requeue(deployment_id, priority, cluster_id)
+        if priority is None:
+            logger.warning("requeue_unknown_deployment deployment_id=%s", deployment_id)
             return
+        REQUEUES.inc(reason='requeue')
+        logger.debug("deployment_requeued deployment_id=%s priority=%s", deployment_id, int(priority))
 
-        queue_length = self.queue.llen(self.queue_name)
-        print(f"Requeueing deployment {deployment_id} with priority {deployment.priority}.")
-
-        # Temporarily store lower priority deployments
-        lower_priority_deployments = []
-        for _ in range(queue_length):
-            queued_deployment_id = self.queue.lpop(self.queue_name)
-            if queued_deployment_id is None:
-                break
-            queued_deployment_id = int(queued_deployment_id)
-            queued_deployment = Deployment.query.get(queued_deployment_id)
-            if queued_deployment and queued_deployment.priority <= deployment.priority:
-                lower_priority_deployments.append(queued_deployment_id)
-            else:
-                # Put back higher priority deployments
-                self.queue.lpush(self.queue_name, queued_deployment_id)
 
-        # Add the current deployment
-        self.queue.lpush(self.queue_name, deployment_id)
+def main(argv=None):
+    """Command-line entry point, e.g. `python -m scheduler worker`."""
+    parser = argparse.ArgumentParser(description='Deployment scheduler.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='Run scheduling passes in a loop.')
+    worker_parser.add_argument('--poll-timeout', type=int, default=5,
+                               help='Seconds to wait for new work before rescanning the queue.')
+    worker_parser.add_argument('--metrics-port', type=int,
+                               help='Serve Prometheus metrics at /metrics on this port.')
+    worker_parser.add_argument('--reconcile-interval', type=int, default=60,
+                               help='Seconds between rebuilds of the cluster capacity index.')
+    subparsers.add_parser('reconcile', help='Rebuild the capacity index, usage table and queue, roll up '
+                                           'utilization history, and report drift.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    # Imported here so the app (which imports this module) is fully initialized first
+    from app import app, scheduler
+    if app.config['QUEUE_BACKEND'] == 'memory':
+        parser.error('the memory queue backend is private to the API process; run `python app.py` instead')
+    if args.command == 'reconcile':
+        with app.app_context():
+            drift = scheduler.reconcile_capacity()
+            scheduler.reconcile_usage()
+            enqueued = scheduler.reconcile_queue()
+            recovered = scheduler.recover_queue()
+            rolled_up = scheduler.roll_up_utilization()
+        for cluster_id, field, cached, actual in drift:
+            print(f"Cluster {cluster_id}: {field or 'record'} was {cached}, database has {actual}")
+        print(f"Capacity index rebuilt; {len(drift)} differences found. Usage table rebuilt.")
+        print(f"Queue rebuilt; {enqueued} deployments re-enqueued, {recovered} expired leases recovered.")
+        print(f"Utilization history rolled up; {rolled_up} events added.")
+        return
+    if args.metrics_port:
+        from metrics import start_http_server
+        # Scrapes run collect_state, which reads the database
+        start_http_server(args.metrics_port, context=app.app_context)
+    with app.app_context():
+        scheduler.run_worker(poll_timeout=args.poll_timeout, reconcile_interval=args.reconcile_interval)
 
-        # Add back the lower priority deployments
-        for dep_id in reversed(lower_priority_deployments):
-            self.queue.lpush(self.queue_name, dep_id)
 
-        print(f"Deployment {deployment_id} requeued. Current queue: "
-              f"{[self.queue.lindex(self.queue_name, i).decode() for i in range(self.queue.llen(self.queue_name))]}")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import os
+import tempfile
+import pytest
+
+# Run against a throwaway database and an in-process queue, so the suite needs
+# no Redis server. The database is a file rather than in-memory SQLite, whose
+# single shared connection would let the scheduler's worker threads interleave
+# their transactions.
+os.environ.setdefault('DATABASE_URI', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault('QUEUE_BACKEND', 'memory')
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """
+    Gives every test empty tables, and an empty queue, capacity index, broadcaster
+    and usage table, with no quotas, for the app's scheduler.
+    """
+    from app import app, scheduler
+    from models import db
+    from queue_backends import InProcessQueue
+    from capacity import InProcessCapacityIndex
+    from events import InProcessBroadcaster
+    from admission import InProcessUsageTable
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    scheduler.queue = InProcessQueue()
+    scheduler.capacity = InProcessCapacityIndex()
+    scheduler.events = InProcessBroadcaster()
+    scheduler.usage = InProcessUsageTable()
+    scheduler.quotas = {}
+    yield
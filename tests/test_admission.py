@@ -0,0 +1,99 @@
+import pytest
+from admission import (
+    PLACEMENT_RATE_WINDOWS, RATE_WINDOW_SECONDS, InProcessUsageTable, Quota, RedisUsageTable,
+    estimate_start_seconds, fits, parse_quotas, quota_for,
+)
+from test_queue_backends import redis_available
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def usage(request):
+    """Fixture yielding an empty usage table of each kind; Redis is skipped without a server."""
+    if request.param == 'memory':
+        yield InProcessUsageTable()
+        return
+    if not redis_available():
+        pytest.skip('no Redis server')
+    usage = RedisUsageTable(name='test_usage')
+    keys = usage.redis.keys('test_usage*')
+    if keys:
+        usage.redis.delete(*keys)
+    yield usage
+    keys = usage.redis.keys('test_usage*')
+    if keys:
+        usage.redis.delete(*keys)
+
+
+def test_parse_quotas_merges_defaults():
+    """
+    Test that organization quotas override the default field by field.
+    """
+    quotas = parse_quotas('{"default": {"gpu": 16, "submissions_per_minute": 100}, "3": {"gpu": 64}}')
+
+    assert quota_for(quotas, 3) == Quota(gpu=64, submissions_per_minute=100)
+    assert quota_for(quotas, 4) == Quota(gpu=16, submissions_per_minute=100)
+    assert quota_for(parse_quotas(''), 4) == Quota()
+    with pytest.raises(ValueError):
+        parse_quotas('{"default": {"disk": 1}}')
+
+
+def test_fits_checks_every_resource_and_replica():
+    """
+    Test feasibility against cluster capacities, with replicas spread over clusters.
+    """
+    assert fits((4, 2, 0), 1, [(8, 4, 0)])
+    assert not fits((4, 2, 1), 1, [(8, 4, 0)])
+    assert not fits((4, 2, 0), 1, [])
+    # Three replicas fit over two clusters, but not on either alone
+    assert fits((4, 2, 0), 3, [(8, 4, 0), (4, 2, 0)])
+    assert not fits((4, 2, 0), 3, [(8, 4, 0)])
+
+
+def test_estimate_start_seconds():
+    """
+    Test that the estimate is zero when nothing blocks and scales with the queue ahead otherwise.
+    """
+    assert estimate_start_seconds(0, True, 0) == 0.0
+    assert estimate_start_seconds(3, True, 2.0) == 2.0
+    assert estimate_start_seconds(0, False, 0.5) == 2.0
+    assert estimate_start_seconds(3, False, 0) is None
+
+
+def test_admit_enforces_quota_and_release(usage):
+    """
+    Test that demands are admitted in order until a quota is reached and that releases make room again.
+    """
+    usage.load([(1, 10, 4, 0, 2)])
+    assert usage.loaded
+    quota = Quota(ram=20, deployments=4)
+
+    assert usage.admit(1, [(6, 1, 0), (6, 1, 0), (2, 1, 0), (1, 1, 0)], quota) == [
+        None, 'ram', None, 'deployments']
+    assert usage.usage(1) == (18, 6, 0, 4)
+
+    usage.release(1, 6, 1, 0)
+    assert usage.admit(1, [(1, 1, 0)], quota) == [None]
+    assert usage.usage(2) == (0, 0, 0, 0)
+
+
+def test_admit_enforces_submission_rate(usage):
+    """
+    Test that only submissions_per_minute deployments are admitted per window, rejected ones not counted.
+    """
+    quota = Quota(gpu=1, submissions_per_minute=2)
+
+    assert usage.admit(1, [(1, 1, 0), (1, 1, 2)], quota) == [None, 'gpu']
+    assert usage.admit(1, [(1, 1, 0), (1, 1, 0)], quota) == [None, 'submissions_per_minute']
+    # Other organizations have their own rate
+    assert usage.admit(2, [(1, 1, 0)], quota) == [None]
+
+
+def test_placement_rate(usage):
+    """
+    Test that recorded placements are averaged over the rate windows.
+    """
+    assert usage.placement_rate() == 0
+    usage.record_placements(30)
+    usage.record_placements(0)
+
+    assert usage.placement_rate() == pytest.approx(30 / (PLACEMENT_RATE_WINDOWS * RATE_WINDOW_SECONDS))
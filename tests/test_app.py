@@ -27,6 +27,33 @@ def authenticate_user(username, password):
     return {'Authorization': 'Basic ' + auth_str.encode('utf-8').decode('utf-8')}
 
 
+def add_user(username, password, organization_id=None):
+    """Helper function to create a user directly in the database."""
+    with app.app_context():
+        user = User(username=username, organization_id=organization_id)
+        user.set_password(password)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def add_cluster(name, organization_id, total_ram=64, total_cpu=32, total_gpu=4):
+    """Helper function to create an idle cluster directly in the database."""
+    with app.app_context():
+        cluster = Cluster(name=name, organization_id=organization_id, total_ram=total_ram, total_cpu=total_cpu,
+                          total_gpu=total_gpu, available_ram=total_ram, available_cpu=total_cpu,
+                          available_gpu=total_gpu)
+        db.session.add(cluster)
+        db.session.commit()
+        return cluster.id
+
+
+def bearer_headers(client, username, password):
+    """Helper function to log in and build a bearer token header."""
+    response = client.post('/login', json={'username': username, 'password': password})
+    return {'Authorization': 'Bearer ' + json.loads(response.data)['token']}
+
+
 def test_register_and_login(client):
     # Test user registration
     register_data = {'username': 'testuser', 'password': 'testpassword'}
@@ -121,3 +148,288 @@ def test_get_clusters(client):
     clusters = json.loads(response.data)['clusters']
     assert len(clusters) == 1
     assert clusters[0]['name'] == 'TestCluster'
+
+
+def test_terminal_status_releases_resources(client):
+    # Setup: a running deployment holding part of a cluster
+    with app.app_context():
+        cluster = Cluster(name='ReleaseCluster', total_ram=16, total_cpu=4, total_gpu=1,
+                          available_ram=12, available_cpu=3, available_gpu=1, organization_id=1)
+        db.session.add(cluster)
+        db.session.commit()
+        deployment = Deployment(name='Running', user_id=1, cluster_id=cluster.id, docker_image='nginx:latest',
+                                required_ram=4, required_cpu=1, required_gpu=0, status='running')
+        db.session.add(deployment)
+        db.session.commit()
+        cluster_id, deployment_id = cluster.id, deployment.id
+
+    # Completing the deployment returns its resources exactly once
+    for _ in range(2):
+        response = client.put(f'/deployment/{deployment_id}/status', json={'status': 'completed'})
+        assert response.status_code == 200
+
+    with app.app_context():
+        cluster = db.session.get(Cluster, cluster_id)
+        assert cluster.available_ram == 16
+        assert cluster.available_cpu == 4
+
+
+def test_repeat_requests_use_credential_cache(client):
+    from base64 import b64encode
+    from utils import credential_cache
+
+    add_user('cacheuser', 'testpassword')
+
+    def headers(password):
+        token = b64encode(f'cacheuser:{password}'.encode()).decode()
+        return {'Authorization': f'Basic {token}'}
+
+    before = credential_cache.stats()
+    for _ in range(3):
+        assert client.get('/deployments', headers=headers('testpassword')).status_code == 200
+    assert client.get('/deployments', headers=headers('wrongpassword')).status_code == 401
+    after = credential_cache.stats()
+    assert after['hits'] - before['hits'] == 2
+    assert after['misses'] - before['misses'] == 2
+
+    # Changing the password invalidates the cached credentials
+    with app.app_context():
+        user = User.query.filter_by(username='cacheuser').first()
+        user.set_password('newpassword')
+        db.session.commit()
+    assert client.get('/deployments', headers=headers('testpassword')).status_code == 401
+    assert client.get('/deployments', headers=headers('newpassword')).status_code == 200
+
+
+def test_login_token_authenticates_requests(client):
+    add_user('tokenuser', 'testpassword')
+
+    response = client.post('/login', json={'username': 'tokenuser', 'password': 'testpassword'})
+    assert response.status_code == 200
+    token = json.loads(response.data)['token']
+
+    response = client.get('/deployments', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+
+    response = client.get('/deployments', headers={'Authorization': f'Bearer {token[:-2]}xx'})
+    assert response.status_code == 401
+    response = client.post('/login', json={'username': 'tokenuser', 'password': 'wrongpassword'})
+    assert response.status_code == 401
+
+
+def test_get_deployments_paginated_and_filtered(client):
+    user_id = add_user('pageuser', 'testpassword')
+    with app.app_context():
+        db.session.add_all([
+            Deployment(name=f'Page{i}', user_id=user_id, cluster_id=1, docker_image='nginx:latest',
+                       required_ram=1, required_cpu=1, required_gpu=0, priority=1 + i % 2,
+                       status='running' if i == 0 else 'queued')
+            for i in range(3)
+        ])
+        db.session.commit()
+    headers = bearer_headers(client, 'pageuser', 'testpassword')
+
+    page = json.loads(client.get('/deployments?limit=2', headers=headers).data)
+    assert [d['name'] for d in page['deployments']] == ['Page0', 'Page1']
+    page = json.loads(client.get(f"/deployments?limit=2&after_id={page['next_after_id']}", headers=headers).data)
+    assert [d['name'] for d in page['deployments']] == ['Page2']
+    assert page['next_after_id'] is None
+
+    page = json.loads(client.get('/deployments?status=queued&priority=1', headers=headers).data)
+    assert [d['name'] for d in page['deployments']] == ['Page2']
+
+    response = client.get('/deployments?format=ndjson', headers=headers)
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['name'] for line in response.data.splitlines()] == ['Page0', 'Page1', 'Page2']
+    # Non-positive limits are clamped to one row, as for pages
+    response = client.get('/deployments?format=ndjson&limit=-1', headers=headers)
+    assert [json.loads(line)['name'] for line in response.data.splitlines()] == ['Page0']
+
+
+def test_create_deployments_batch(client):
+    add_user('batchuser', 'testpassword', organization_id=1)
+    add_cluster('BatchCluster', organization_id=1)
+    headers = bearer_headers(client, 'batchuser', 'testpassword')
+    spec = {'name': 'Sweep', 'cluster_id': 1, 'docker_image': 'nginx:latest',
+            'required_ram': 2, 'required_cpu': 1, 'required_gpu': 0}
+
+    response = client.post('/deployments/batch', headers=headers, json={'deployments': [
+        dict(spec, priority=2),
+        dict(spec, required_ram=-1),
+        dict(spec, cluster_id=None),
+    ]})
+    assert response.status_code == 201
+    results = json.loads(response.data)['results']
+    assert [r['index'] for r in results] == [0, 1, 2]
+    assert 'error' in results[1]
+    assert results[0]['deployment_id'] < results[2]['deployment_id']
+
+    with app.app_context():
+        created = db.session.get(Deployment, results[2]['deployment_id'])
+        assert created.status == 'queued'
+        assert created.organization_id == 1
+    from app import scheduler
+    assert scheduler.get_queue_length(1) == 1
+    assert scheduler.get_queue_length() == 1
+
+    response = client.post('/deployments/batch', headers=headers, json={'deployments': [dict(spec, name='')]})
+    assert response.status_code == 400
+
+
+def test_metrics_endpoint(client):
+    add_user('metricsuser', 'testpassword', organization_id=1)
+    headers = bearer_headers(client, 'metricsuser', 'testpassword')
+    with app.app_context():
+        db.session.add(Cluster(name='MetricsCluster', total_ram=8, total_cpu=4, total_gpu=0,
+                               available_ram=2, available_cpu=4, available_gpu=0, organization_id=1))
+        db.session.commit()
+    spec = {'name': 'Measured', 'cluster_id': 1, 'docker_image': 'nginx:latest',
+            'required_ram': 1, 'required_cpu': 1, 'required_gpu': 0}
+    client.post('/deployments/batch', headers=headers, json={'deployments': [dict(spec, priority=3)] * 2})
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.data.decode().splitlines()
+    assert 'scheduler_queue_depth{priority="3"} 2' in lines
+    assert 'cluster_utilization_ratio{cluster_id="1",resource="ram"} 0.75' in lines
+    assert 'cluster_utilization_ratio{cluster_id="1",resource="gpu"}' not in ' '.join(lines)
+    assert any(line.startswith('credential_cache{stat="hits"}') for line in lines)
+    assert any(line.startswith('http_request_seconds_count{route="/deployments/batch",method="POST",status="201"}')
+               for line in lines)
+    assert any(line.startswith('scheduler_db_query_seconds_count{statement="INSERT"}') for line in lines)
+
+
+def test_clusters_served_from_capacity_index(client):
+    add_user('indexuser', 'testpassword', organization_id=1)
+    headers = bearer_headers(client, 'indexuser', 'testpassword')
+    for name in ('First', 'Second', 'Third'):
+        response = client.post('/cluster', headers=headers,
+                               json={'name': name, 'total_ram': 8, 'total_cpu': 4, 'total_gpu': 0})
+        assert response.status_code == 201
+    from app import scheduler
+    assert [c.name for c in scheduler.capacity.all()] == ['First', 'Second', 'Third']
+
+    response = client.get('/clusters?limit=2', headers=headers)
+    page = json.loads(response.data)
+    assert [c['name'] for c in page['clusters']] == ['First', 'Second']
+    assert set(page['clusters'][0]) == {'id', 'name', 'total_ram', 'total_cpu', 'total_gpu',
+                                        'available_ram', 'available_cpu', 'available_gpu'}
+    response = client.get(f"/clusters?after_id={page['next_after_id']}", headers=headers)
+    assert [c['name'] for c in json.loads(response.data)['clusters']] == ['Third']
+    assert json.loads(response.data)['next_after_id'] is None
+
+    response = client.get('/clusters?format=ndjson', headers=headers)
+    assert [json.loads(line)['name'] for line in response.data.decode().splitlines()] == ['First', 'Second', 'Third']
+    response = client.get('/clusters?format=ndjson&limit=-1', headers=headers)
+    assert [json.loads(line)['name'] for line in response.data.decode().splitlines()] == ['First']
+
+
+def test_deployment_events_stream(client):
+    from app import scheduler
+    user_id = add_user('streamuser', 'testpassword', organization_id=1)
+    headers = bearer_headers(client, 'streamuser', 'testpassword')
+    with app.app_context():
+        deployment = Deployment(name='Watched', user_id=user_id, cluster_id=None, organization_id=1,
+                                docker_image='nginx:latest', required_ram=1, required_cpu=1, required_gpu=0)
+        db.session.add(deployment)
+        db.session.commit()
+        deployment_id = deployment.id
+
+    response = client.get(f'/deployments/events?deployment_id={deployment_id}', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert scheduler.events.subscriber_count() == 1
+    stream = response.response
+
+    # The stream opens with the current status, then pushes changes as they are made
+    def next_event():
+        event, data = next(stream).decode().split('\n', 1)
+        return event, json.loads(data.removeprefix('data: '))
+
+    assert next_event() == ('event: status', {'deployment_id': deployment_id, 'user_id': user_id,
+                                              'status': 'queued', 'cluster_id': None})
+    client.put(f'/deployment/{deployment_id}/status', json={'status': 'stopped'})
+    assert next_event()[1]['status'] == 'stopped'
+
+    response.close()
+    assert scheduler.events.subscriber_count() == 0
+
+    # A client gone before the first chunk still unsubscribes when the server closes the response
+    from werkzeug.test import EnvironBuilder
+    environ = EnvironBuilder(path='/deployments/events', headers=headers).get_environ()
+    body = app.wsgi_app(environ, lambda status, response_headers: None)
+    assert scheduler.events.subscriber_count() == 1
+    body.close()
+    assert scheduler.events.subscriber_count() == 0
+
+
+def test_create_gang_deployment(client):
+    add_user('gangowner', 'testpassword', organization_id=1)
+    for name in ('GangA', 'GangB'):
+        add_cluster(name, organization_id=1, total_ram=128, total_cpu=64, total_gpu=8)
+    headers = bearer_headers(client, 'gangowner', 'testpassword')
+    spec = {'name': 'trainer', 'docker_image': 'trainer:latest', 'required_ram': 8, 'required_cpu': 4,
+            'required_gpu': 1}
+
+    response = client.post('/deployment', headers=headers, json={**spec, 'replicas': 0})
+    assert response.status_code == 400
+    response = client.post('/deployment', headers=headers, json={**spec, 'replicas': 16})
+    assert response.status_code == 201
+
+    response = client.get('/deployments', headers=headers)
+    assert [d['replicas'] for d in json.loads(response.data)['deployments']] == [16]
+
+
+def test_create_deployment_admission_control(client):
+    from app import scheduler
+    from admission import Quota
+    add_user('admitted', 'testpassword', organization_id=1)
+    headers = bearer_headers(client, 'admitted', 'testpassword')
+    cluster_id = add_cluster('Small', organization_id=1, total_ram=8, total_cpu=4, total_gpu=0)
+    spec = {'name': 'job', 'cluster_id': cluster_id, 'docker_image': 'nginx:latest',
+            'required_ram': 2, 'required_cpu': 1, 'required_gpu': 0}
+
+    response = client.post('/deployment', headers=headers, json={**spec, 'required_gpu': 1})
+    assert response.status_code == 400
+    assert json.loads(response.data)['message'] == "Requested resources exceed the cluster's total capacity!"
+    response = client.post('/deployment', headers=headers, json=spec)
+    assert response.status_code == 201
+    assert json.loads(response.data)['estimated_start_seconds'] == 0.0
+
+    scheduler.quotas = {1: Quota(cpu=4, submissions_per_minute=2)}
+    response = client.post('/deployment', headers=headers, json={**spec, 'required_cpu': 4})
+    assert response.status_code == 403
+    response = client.post('/deployments/batch', headers=headers, json={'deployments': [spec, spec]})
+    results = json.loads(response.data)['results']
+    assert response.status_code == 201
+    assert 'estimated_start_seconds' in results[0]
+    assert results[1]['error'] == 'Organization submission rate limit exceeded!'
+    response = client.post('/deployment', headers=headers, json={**spec, 'required_cpu': 0})
+    assert response.status_code == 429
+    assert scheduler.get_queue_length(cluster_id) == 2
+
+
+def test_cluster_utilization(client):
+    from models import UtilizationEvent
+    add_user('analyst', 'testpassword', organization_id=1)
+    headers = bearer_headers(client, 'analyst', 'testpassword')
+    cluster_id = add_cluster('Tracked', organization_id=1, total_ram=8, total_cpu=4, total_gpu=2)
+    other_cluster_id = add_cluster('Elsewhere', organization_id=2)
+    with app.app_context():
+        # Half the GPUs allocated for the first half hour
+        db.session.add_all([UtilizationEvent(cluster_id=cluster_id, ts=ts, ram=0, cpu=0, gpu=gpu)
+                            for ts, gpu in ((0, 1), (1800, -1))])
+        db.session.commit()
+
+    response = client.get(f'/clusters/{cluster_id}/utilization?from=0&to=7200&step=3600', headers=headers)
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['totals'] == {'ram': 8, 'cpu': 4, 'gpu': 2}
+    assert data['points'] == [{'start': 0, 'ram': 0.0, 'cpu': 0.0, 'gpu': 0.25},
+                              {'start': 3600, 'ram': 0.0, 'cpu': 0.0, 'gpu': 0.0}]
+
+    response = client.get(f'/clusters/{cluster_id}/utilization?from=0&to=7200&step=90', headers=headers)
+    assert response.status_code == 400
+    response = client.get(f'/clusters/{other_cluster_id}/utilization', headers=headers)
+    assert response.status_code == 404
@@ -0,0 +1,305 @@
+import asyncio
+import base64
+import json
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+from app import app, db, scheduler
+from asgi import AsyncApp, wsgi_environ
+from events import StatusEvent
+from models import User, Organization, Cluster, Deployment
+
+
+def call(asgi_app, method, path, body=None, headers=(), query_string=b''):
+    """Helper coroutine sending one HTTP request to an ASGI app; returns (status, headers, body)."""
+    body = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+        'headers': [(b'content-type', b'application/json')] + [
+            (name.lower().encode(), value.encode()) for name, value in headers],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+    }
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if received:
+            return received.pop(0)
+        # The client stays connected until the response is complete
+        await asyncio.Future()
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await asgi_app(scope, receive, send)
+        start = sent[0]
+        return (start['status'], dict(start['headers']),
+                b''.join(message.get('body', b'') for message in sent[1:]))
+    return run()
+
+
+def basic_auth(username, password):
+    return [('Authorization', 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode())]
+
+
+@pytest.fixture
+def user():
+    """Fixture creating an organization member with a cluster; yields the user's auth headers."""
+    with app.app_context():
+        organization = Organization(name='asgi-org')
+        db.session.add(organization)
+        db.session.flush()
+        user = User(username='asgi-user', organization_id=organization.id)
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.add(Cluster(name='asgi-cluster', organization_id=organization.id, total_ram=64, total_cpu=32,
+                               total_gpu=4, available_ram=64, available_cpu=32, available_gpu=4))
+        db.session.commit()
+    return basic_auth('asgi-user', 'secret')
+
+
+def run_app(test):
+    """Runs test(asgi_app) in a fresh event loop against an app without the scheduler loop."""
+    async def main():
+        asgi_app = AsyncApp(app, scheduler, threads=4, run_scheduler=False)
+        try:
+            return await test(asgi_app)
+        finally:
+            await asgi_app.shutdown()
+    return asyncio.run(main())
+
+
+def test_native_create_deployment_enqueues(user):
+    """
+    Test that POST /deployment is served natively and enqueues the new deployment.
+    """
+    spec = {'name': 'web', 'docker_image': 'nginx', 'required_ram': 4, 'required_cpu': 2, 'required_gpu': 0,
+            'priority': 3}
+    status, _, body = run_app(lambda asgi_app: call(asgi_app, 'POST', '/deployment', spec, user))
+
+    assert status == 201
+    deployment_id = json.loads(body)['deployment_id']
+    with app.app_context():
+        assert db.session.get(Deployment, deployment_id).status == 'queued'
+    assert [queued_id for queued_id, _ in scheduler.queue.pop(count=5)] == [deployment_id]
+
+
+def test_native_batch_and_listing(user):
+    """
+    Test that batch submission reports per-spec results and GET /deployments pages them.
+    """
+    spec = {'name': 'job', 'docker_image': 'busybox', 'required_ram': 1, 'required_cpu': 1, 'required_gpu': 0}
+
+    async def test(asgi_app):
+        batch = await call(asgi_app, 'POST', '/deployments/batch',
+                           {'deployments': [spec, {'name': 'bad'}, spec, spec]}, user)
+        page = await call(asgi_app, 'GET', '/deployments', headers=user, query_string=b'limit=2')
+        stream = await call(asgi_app, 'GET', '/deployments', headers=user, query_string=b'format=ndjson')
+        clamped = await call(asgi_app, 'GET', '/deployments', headers=user, query_string=b'format=ndjson&limit=-1')
+        return batch, page, stream, clamped
+
+    batch, page, stream, clamped = run_app(test)
+
+    assert batch[0] == 201
+    results = json.loads(batch[2])['results']
+    assert [('deployment_id' in result, 'error' in result) for result in results] == [
+        (True, False), (False, True), (True, False), (True, False)]
+    assert scheduler.get_queue_length() == 3
+
+    page_body = json.loads(page[2])
+    assert page[0] == 200
+    assert [deployment['id'] for deployment in page_body['deployments']] == [
+        results[0]['deployment_id'], results[2]['deployment_id']]
+    assert page_body['next_after_id'] == results[2]['deployment_id']
+
+    assert stream[1][b'content-type'] == b'application/x-ndjson'
+    assert len(stream[2].decode().splitlines()) == 3
+    assert len(clamped[2].decode().splitlines()) == 1
+
+
+def test_native_routes_reject_bad_credentials(user):
+    """
+    Test that native routes answer 401 without valid credentials and 400 for invalid specs.
+    """
+    async def test(asgi_app):
+        return (await call(asgi_app, 'GET', '/deployments'),
+                await call(asgi_app, 'GET', '/deployments', headers=basic_auth('asgi-user', 'wrong')),
+                await call(asgi_app, 'POST', '/deployment', {'name': 'x'}, user))
+
+    anonymous, wrong_password, invalid = run_app(test)
+
+    assert anonymous[0] == 401
+    assert wrong_password[0] == 401
+    assert invalid[0] == 400
+    assert json.loads(invalid[2]) == {'message': 'docker_image is required!'}
+
+
+def test_other_routes_go_through_flask(user):
+    """
+    Test that routes without a native handler are served by the Flask app, with bearer tokens.
+    """
+    async def test(asgi_app):
+        login = await call(asgi_app, 'POST', '/login', {'username': 'asgi-user', 'password': 'secret'})
+        token = json.loads(login[2])['token']
+        clusters = await call(asgi_app, 'GET', '/clusters', headers=[('Authorization', f'Bearer {token}')])
+        listed = await call(asgi_app, 'GET', '/deployments', headers=[('Authorization', f'Bearer {token}')])
+        return login, clusters, listed
+
+    login, clusters, listed = run_app(test)
+
+    assert login[0] == 200
+    assert clusters[0] == 200
+    assert [cluster['name'] for cluster in json.loads(clusters[2])['clusters']] == ['asgi-cluster']
+    assert listed[0] == 200
+
+
+def test_scheduler_task_places_deployments(user):
+    """
+    Test that the scheduler loop started with the app places a submitted deployment.
+    """
+    spec = {'name': 'web', 'docker_image': 'nginx', 'required_ram': 4, 'required_cpu': 2, 'required_gpu': 0}
+
+    async def main():
+        asgi_app = AsyncApp(app, scheduler, threads=4, run_scheduler=True, poll_timeout=1)
+        try:
+            _, _, body = await call(asgi_app, 'POST', '/deployment', spec, user)
+            deployment_id = json.loads(body)['deployment_id']
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                with app.app_context():
+                    status = db.session.get(Deployment, deployment_id).status
+                    db.session.remove()
+                if status != 'queued':
+                    return status
+            return status
+        finally:
+            await asgi_app.shutdown()
+
+    assert asyncio.run(main()) == 'running'
+
+
+def test_scheduler_task_survives_failed_wait(user, monkeypatch):
+    """
+    Test that the scheduler loop keeps scheduling after waiting for queue events fails once.
+    """
+    passes = []
+    monkeypatch.setattr(scheduler, 'handle_wakeup', passes.append)
+
+    async def main():
+        asgi_app = AsyncApp(app, scheduler, threads=4, run_scheduler=False, poll_timeout=0.1)
+        await asgi_app.startup()
+        wait = asgi_app.queue.wait
+
+        async def wait_once_broken(timeout):
+            if not hasattr(wait_once_broken, 'failed'):
+                wait_once_broken.failed = True
+                raise ConnectionError('Connection reset by peer')
+            return await wait(timeout)
+        asgi_app.queue.wait = wait_once_broken
+        task = asyncio.create_task(asgi_app.schedule_forever())
+        try:
+            for _ in range(50):
+                await asyncio.sleep(0.05)
+                if len(passes) >= 2:
+                    break
+            assert not task.done()
+        finally:
+            task.cancel()
+            await asgi_app.shutdown()
+
+    asyncio.run(main())
+    assert len(passes) >= 2
+
+
+def test_wsgi_environ_maps_headers():
+    """
+    Test that the WSGI environ carries the path, query string and headers of the ASGI scope.
+    """
+    environ = wsgi_environ({
+        'type': 'http', 'method': 'GET', 'path': '/clusters', 'query_string': b'limit=5',
+        'headers': [(b'content-type', b'application/json'), (b'x-trace', b'a'), (b'x-trace', b'b')],
+    }, b'{}')
+
+    assert environ['PATH_INFO'] == '/clusters'
+    assert environ['QUERY_STRING'] == 'limit=5'
+    assert environ['CONTENT_TYPE'] == 'application/json'
+    assert environ['CONTENT_LENGTH'] == '2'
+    assert environ['HTTP_X_TRACE'] == 'a,b'
+    assert environ['wsgi.input'].read() == b'{}'
+
+
+def test_native_status_event_stream(user):
+    """
+    Test that the native event stream sends the snapshot, pushes published changes and stops on disconnect.
+    """
+    async def main():
+        asgi_app = AsyncApp(app, scheduler, threads=4, run_scheduler=False)
+        try:
+            _, _, body = await call(asgi_app, 'POST', '/deployment', {
+                'name': 'web', 'docker_image': 'nginx', 'required_ram': 4, 'required_cpu': 2, 'required_gpu': 0,
+            }, user)
+            deployment_id = json.loads(body)['deployment_id']
+            with app.app_context():
+                user_id = db.session.get(Deployment, deployment_id).user_id
+
+            chunks = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                if not chunks:
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                chunks.append(message)
+                if len(chunks) == 2:
+                    # Published from another thread, as the scheduler worker does
+                    await asyncio.to_thread(scheduler.events.publish,
+                                            [StatusEvent(deployment_id, user_id, 'running', 1)])
+                elif len(chunks) == 3:
+                    disconnect.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/deployments/events',
+                     'query_string': f'deployment_id={deployment_id}'.encode(),
+                     'headers': [(b'authorization', user[0][1].encode())]}
+            await asyncio.wait_for(asgi_app(scope, receive, send), 5)
+            return deployment_id, chunks
+        finally:
+            await asgi_app.shutdown()
+
+    deployment_id, chunks = asyncio.run(main())
+
+    assert chunks[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in chunks[0]['headers']
+    statuses = [json.loads(chunk['body'].decode().split('data: ', 1)[1]) for chunk in chunks[1:]]
+    assert [(event['deployment_id'], event['status']) for event in statuses] == [
+        (deployment_id, 'queued'), (deployment_id, 'running')]
+    assert scheduler.events.subscriber_count() == 0
+
+
+def test_native_status_event_stream_unsubscribes_if_never_started(user):
+    """
+    Test that the subscription is closed when sending the response start fails.
+    """
+    async def main():
+        asgi_app = AsyncApp(app, scheduler, threads=4, run_scheduler=False)
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            raise ConnectionResetError('client went away')
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/deployments/events', 'query_string': b'',
+                 'headers': [(b'authorization', user[0][1].encode())]}
+        try:
+            with pytest.raises(ConnectionResetError):
+                await asgi_app(scope, receive, send)
+        finally:
+            await asgi_app.shutdown()
+
+    asyncio.run(main())
+    assert scheduler.events.subscriber_count() == 0
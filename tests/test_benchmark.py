@@ -0,0 +1,57 @@
+import pytest
+from benchmark import SCENARIOS, compare, generate_workload, run_benchmark
+from app import app
+
+
+def test_generate_workload_is_reproducible():
+    """
+    Test that a scenario's seed fixes the deployment stream.
+    """
+    params = dict(SCENARIOS['smoke'], deployments=50)
+    first = generate_workload(params, [1, 2])
+    assert first == generate_workload(params, [1, 2])
+    assert [arrival for arrival, _, _ in first] == sorted(arrival for arrival, _, _ in first)
+    assert {spec.get('cluster_id') for _, spec, _ in first} <= {None, 1, 2}
+    assert {spec['priority'] for _, spec, _ in first} <= set(params['priority_weights'])
+
+
+def test_run_benchmark_places_every_deployment():
+    """
+    Test that a small scenario runs end to end through the API and the scheduler.
+    """
+    results = run_benchmark(app, dict(SCENARIOS['smoke'], deployments=40))
+
+    assert results['submitted'] == 40
+    assert results['placed'] == 40
+    assert results['unplaced'] == 0
+    assert results['placements_per_sec'] > 0
+    assert 0 <= results['latency_p50'] <= results['latency_p99']
+    assert 0 < results['utilization_ram'] <= 1
+
+
+def test_compare_flags_regressions():
+    """
+    Test that comparing result files flags metrics that got worse beyond the threshold.
+    """
+    baseline = {'scenarios': {'smoke': {'results': {'placements_per_sec': 100.0, 'latency_p99': 10.0}}}}
+    faster = {'scenarios': {'smoke': {'results': {'placements_per_sec': 150.0, 'latency_p99': 10.5}}}}
+    slower = {'scenarios': {'smoke': {'results': {'placements_per_sec': 80.0, 'latency_p99': 10.0}}}}
+
+    rows, regressed = compare(baseline, faster)
+    assert not regressed
+    assert ('smoke', 'placements_per_sec', 100.0, 150.0, 0.5) in rows
+    assert compare(baseline, slower)[1]
+    assert not compare(baseline, slower, threshold=0.25)[1]
+
+
+def test_run_benchmark_refuses_non_throwaway_database(monkeypatch):
+    """
+    Test that the benchmark, which drops every table, will not run on a configured database.
+    """
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///database.db')
+    with pytest.raises(ValueError):
+        run_benchmark(app, dict(SCENARIOS['smoke'], deployments=1))
+
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI', 'postgresql://localhost/deployments')
+    with pytest.raises(ValueError):
+        run_benchmark(app, dict(SCENARIOS['smoke'], deployments=1))
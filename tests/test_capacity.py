@@ -0,0 +1,76 @@
+import pytest
+from capacity import ClusterCapacity, InProcessCapacityIndex, RedisCapacityIndex, reconcile
+from test_queue_backends import redis_available
+
+
+def capacity(cluster_id, organization_id=1, available_ram=8, **fields):
+    values = dict(id=cluster_id, name=f'cluster-{cluster_id}', organization_id=organization_id,
+                  total_ram=8, total_cpu=4, total_gpu=1,
+                  available_ram=available_ram, available_cpu=4, available_gpu=1)
+    values.update(fields)
+    return ClusterCapacity(**values)
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def index(request):
+    """Fixture yielding an empty capacity index of each kind; Redis is skipped without a server."""
+    if request.param == 'memory':
+        yield InProcessCapacityIndex()
+        return
+    if not redis_available():
+        pytest.skip('no Redis server')
+    index = RedisCapacityIndex(name='test_capacity')
+    keys = index.redis.keys('test_capacity*')
+    if keys:
+        index.redis.delete(*keys)
+    yield index
+    keys = index.redis.keys('test_capacity*')
+    if keys:
+        index.redis.delete(*keys)
+
+
+def test_index_lookups_and_adjustments(index):
+    """
+    Test lookups by cluster and organization and incremental adjustments.
+    """
+    assert not index.loaded
+    index.load([capacity(1), capacity(2, organization_id=2), capacity(3)])
+    assert index.loaded
+
+    index.adjust(1, -3, -1, 0)
+    index.adjust(99, -3, -1, 0)
+    index.put(capacity(4, organization_id=2))
+
+    assert index.get_many([1, 99]) == {1: capacity(1, available_ram=5, available_cpu=3)}
+    assert [c.id for c in index.for_organizations([2])] == [2, 4]
+    assert [c.id for c in index.for_organizations([1, 2])] == [1, 2, 3, 4]
+    assert [c.id for c in index.all()] == [1, 2, 3, 4]
+
+
+def test_load_replaces_index(index):
+    """
+    Test that loading drops clusters that are no longer present.
+    """
+    index.load([capacity(1), capacity(2, organization_id=2)])
+    index.load([capacity(1, available_ram=2)])
+
+    assert index.all() == [capacity(1, available_ram=2)]
+    assert index.for_organizations([2]) == []
+
+
+def test_reconcile_reports_drift(index):
+    """
+    Test that reconciling rebuilds the index and reports every difference from the database.
+    """
+    assert reconcile(index, [capacity(1), capacity(2)]) == []
+
+    index.adjust(1, -2, 0, 0)
+    index.put(capacity(3))
+    drift = reconcile(index, [capacity(1), capacity(2, available_gpu=0), capacity(4)])
+
+    assert (1, 'available_ram', 6, 8) in drift
+    assert (2, 'available_gpu', 1, 0) in drift
+    assert (4, None, None, capacity(4)) in drift
+    assert (3, None, capacity(3), None) in drift
+    assert len(drift) == 4
+    assert index.all() == [capacity(1), capacity(2, available_gpu=0), capacity(4)]
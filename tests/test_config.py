@@ -0,0 +1,35 @@
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from config import Config, engine_options, init_db
+
+
+def make_config(uri):
+    config = {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+    config['SQLALCHEMY_DATABASE_URI'] = uri
+    return config
+
+
+def test_engine_options_per_backend():
+    assert engine_options(make_config('sqlite:///:memory:')) == {}
+
+    sqlite_options = engine_options(make_config('sqlite:///database.db'))
+    assert sqlite_options['pool_size'] == Config.DB_POOL_SIZE
+    assert sqlite_options['connect_args'] == {'timeout': Config.SQLITE_BUSY_TIMEOUT_MS / 1000}
+
+    postgres_options = engine_options(make_config('postgresql://user@localhost/mlops'))
+    assert postgres_options['pool_pre_ping'] is True
+    assert 'connect_args' not in postgres_options
+
+
+def test_sqlite_connections_use_wal(tmp_path):
+    app = Flask(__name__)
+    app.config.update(make_config(f"sqlite:///{tmp_path / 'wal.db'}"))
+    db = SQLAlchemy()
+    init_db(app, db)
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+            assert connection.execute(text('PRAGMA busy_timeout')).scalar() == Config.SQLITE_BUSY_TIMEOUT_MS
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import pytest
+from events import (
+    MAX_BUFFERED_EVENTS, InProcessBroadcaster, RedisBroadcaster, StatusEvent, create_broadcaster, format_sse,
+)
+from test_queue_backends import redis_available
+
+
+def test_subscribers_only_receive_their_deployments():
+    """
+    Test that events reach the subscriptions of their user, filtered by deployment when asked.
+    """
+    broadcaster = InProcessBroadcaster()
+    everything = broadcaster.subscribe(1)
+    only_two = broadcaster.subscribe(1, [2])
+    other_user = broadcaster.subscribe(9)
+
+    broadcaster.publish([StatusEvent(1, 1, 'running', 4), StatusEvent(2, 1, 'failed', None)])
+
+    assert [everything.get(0.1).deployment_id, everything.get(0.1).deployment_id] == [1, 2]
+    assert only_two.get(0.1) == StatusEvent(2, 1, 'failed', None)
+    assert only_two.get(0.01) is None
+    assert other_user.get(0.01) is None
+    assert broadcaster.subscriber_count() == 3
+
+    for subscription in (everything, only_two, other_user):
+        subscription.close()
+    assert broadcaster.subscriber_count() == 0
+
+
+def test_subscription_wakes_blocked_reader():
+    """
+    Test that get() returns as soon as an event is published from another thread.
+    """
+    broadcaster = InProcessBroadcaster()
+    received = []
+    with broadcaster.subscribe(1) as subscription:
+        reader = threading.Thread(target=lambda: received.append(subscription.get(5)))
+        reader.start()
+        broadcaster.publish([StatusEvent(3, 1, 'running', 1)])
+        reader.join(timeout=5)
+
+    assert received == [StatusEvent(3, 1, 'running', 1)]
+
+
+def test_slow_subscriber_overflows():
+    """
+    Test that a subscriber falling more than MAX_BUFFERED_EVENTS behind is marked overflowed.
+    """
+    broadcaster = InProcessBroadcaster()
+    subscription = broadcaster.subscribe(1)
+    broadcaster.publish([StatusEvent(i, 1, 'running', 1) for i in range(MAX_BUFFERED_EVENTS)])
+    assert not subscription.overflowed
+    broadcaster.publish([StatusEvent(MAX_BUFFERED_EVENTS, 1, 'running', 1)])
+    assert subscription.overflowed
+
+
+def test_async_subscription_receives_events_from_threads():
+    """
+    Test that a subscription bound to an event loop is fed from a publishing thread.
+    """
+    broadcaster = InProcessBroadcaster()
+
+    async def main():
+        subscription = broadcaster.subscribe(1, loop=asyncio.get_running_loop())
+        threading.Thread(target=broadcaster.publish, args=([StatusEvent(5, 1, 'completed', 2)],)).start()
+        event = await subscription.get_async(5)
+        idle = await subscription.get_async(0.01)
+        subscription.close()
+        return event, idle
+
+    assert asyncio.run(main()) == (StatusEvent(5, 1, 'completed', 2), None)
+
+
+def test_format_sse():
+    assert format_sse('status', {'deployment_id': 1}) == 'event: status\ndata: {"deployment_id": 1}\n\n'
+
+
+def test_create_broadcaster_from_config():
+    assert isinstance(create_broadcaster({'QUEUE_BACKEND': 'memory'}), InProcessBroadcaster)
+    assert isinstance(create_broadcaster({'QUEUE_BACKEND': 'redis'}), RedisBroadcaster)
+
+
+def test_redis_broadcaster_delivers_across_instances():
+    """
+    Test that events published by one process's broadcaster reach another's subscribers.
+    """
+    if not redis_available():
+        pytest.skip('no Redis server')
+    publisher = RedisBroadcaster(channel='test_deployment_events')
+    listener = RedisBroadcaster(channel='test_deployment_events')
+    with listener.subscribe(7) as subscription:
+        publisher.publish([StatusEvent(1, 7, 'running', 3), StatusEvent(2, 8, 'running', 3)])
+        assert subscription.get(5) == StatusEvent(1, 7, 'running', 3)
+        assert subscription.get(0.2) is None
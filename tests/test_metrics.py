@@ -0,0 +1,120 @@
+import pytest
+from metrics import Registry
+
+
+def test_counter_and_gauge_render():
+    """
+    Test that counters and gauges render in Prometheus text format.
+    """
+    registry = Registry()
+    requeues = registry.counter('requeues_total', 'Requeues.', ['reason'])
+    depth = registry.gauge('queue_depth', 'Depth.', ['priority'])
+    requeues.inc(reason='requeue')
+    requeues.inc(2, reason='preempted')
+    depth.replace({(5,): 3})
+
+    lines = registry.render().splitlines()
+    assert '# TYPE requeues_total counter' in lines
+    assert 'requeues_total{reason="preempted"} 2' in lines
+    assert 'requeues_total{reason="requeue"} 1' in lines
+    assert 'queue_depth{priority="5"} 3' in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    """
+    Test that histogram buckets accumulate and include count and sum.
+    """
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        latency.observe(value)
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'latency_seconds_count 4' in lines
+    assert 'latency_seconds_sum 4.25' in lines
+
+
+def test_labels_are_checked_and_escaped():
+    """
+    Test that wrong label names are rejected and label values are escaped.
+    """
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Calls.', ['route'])
+    with pytest.raises(ValueError):
+        counter.inc(path='/x')
+    counter.inc(route='say "hi"')
+
+    assert 'calls_total{route="say \\"hi\\""} 1' in registry.render().splitlines()
+
+
+def test_registering_twice_returns_same_metric():
+    """
+    Test that re-registering a metric returns the existing one and conflicts are rejected.
+    """
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Calls.')
+    assert registry.counter('calls_total', 'Calls.') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('calls_total', 'Calls.')
+
+
+def test_http_server_serves_metrics():
+    """
+    Test that the standalone server exposes the registry at /metrics.
+    """
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from metrics import start_http_server
+    registry = Registry()
+    registry.counter('calls_total', 'Calls.').inc()
+    server = start_http_server(0, '127.0.0.1', registry)
+    try:
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        with urlopen(f'{base}/metrics') as response:
+            assert 'calls_total 1' in response.read().decode().splitlines()
+        with pytest.raises(HTTPError):
+            urlopen(f'{base}/other')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_failing_collector_does_not_break_render():
+    """
+    Test that a collector raising is skipped and the other metrics still render.
+    """
+    registry = Registry()
+    registry.counter('calls_total', 'Calls.').inc()
+
+    def broken():
+        raise RuntimeError('database is gone')
+    registry.add_collector(broken)
+
+    assert 'calls_total 1' in registry.render().splitlines()
+
+
+def test_http_server_runs_app_collectors_in_app_context():
+    """
+    Test that scraping the worker's server runs the app's database-backed collectors.
+    """
+    from urllib.request import urlopen
+    from metrics import REGISTRY, start_http_server
+    from app import app
+    from models import db, Cluster
+    with app.app_context():
+        cluster = Cluster(name='Scraped', total_ram=8, total_cpu=4, total_gpu=0, available_ram=2,
+                          available_cpu=4, available_gpu=0, organization_id=1)
+        db.session.add(cluster)
+        db.session.commit()
+        cluster_id = cluster.id
+    server = start_http_server(0, '127.0.0.1', REGISTRY, context=app.app_context)
+    try:
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            lines = response.read().decode().splitlines()
+        assert f'cluster_utilization_ratio{{cluster_id="{cluster_id}",resource="ram"}} 0.75' in lines
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,151 @@
+import os
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from migrations import MIGRATIONS, VERSION_TABLE, current_version, upgrade
+from models import db
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'deployment_schema.sql')
+
+# The tables as the first release's db.create_all made them, before any migration
+FIRST_RELEASE_SCHEMA = """
+CREATE TABLE organizations (
+    id INTEGER NOT NULL PRIMARY KEY,
+    name VARCHAR NOT NULL UNIQUE
+);
+CREATE TABLE users (
+    id INTEGER NOT NULL PRIMARY KEY,
+    username VARCHAR NOT NULL UNIQUE,
+    password VARCHAR NOT NULL,
+    organization_id INTEGER REFERENCES organizations (id)
+);
+CREATE TABLE clusters (
+    id INTEGER NOT NULL PRIMARY KEY,
+    name VARCHAR NOT NULL UNIQUE,
+    total_ram INTEGER NOT NULL,
+    total_cpu INTEGER NOT NULL,
+    total_gpu INTEGER NOT NULL,
+    available_ram INTEGER NOT NULL,
+    available_cpu INTEGER NOT NULL,
+    available_gpu INTEGER NOT NULL,
+    organization_id INTEGER REFERENCES organizations (id)
+);
+CREATE TABLE deployments (
+    id INTEGER NOT NULL PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    cluster_id INTEGER NOT NULL REFERENCES clusters (id),
+    docker_image VARCHAR NOT NULL,
+    required_ram INTEGER NOT NULL,
+    required_cpu INTEGER NOT NULL,
+    required_gpu INTEGER NOT NULL,
+    status VARCHAR NOT NULL,
+    priority INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT (CURRENT_TIMESTAMP)
+);
+CREATE TABLE organization_invites (
+    id INTEGER NOT NULL PRIMARY KEY,
+    organization_id INTEGER NOT NULL REFERENCES organizations (id),
+    code VARCHAR NOT NULL UNIQUE,
+    used BOOLEAN NOT NULL
+);
+INSERT INTO organizations (id, name) VALUES (1, 'acme');
+INSERT INTO users (id, username, password, organization_id) VALUES (1, 'alice', 'hash', 1);
+INSERT INTO clusters VALUES (1, 'main', 16, 8, 2, 12, 6, 2, 1);
+INSERT INTO deployments (id, name, user_id, cluster_id, docker_image, required_ram, required_cpu,
+                         required_gpu, status, priority)
+VALUES (1, 'web', 1, 1, 'nginx', 4, 2, 0, 'running', 3);
+"""
+
+
+def describe_schema(engine):
+    """Summarizes tables, columns, keys and indexes in a form that ignores dialect spelling."""
+    inspector = inspect(engine)
+    schema = {}
+    for table in inspector.get_table_names():
+        if table == VERSION_TABLE:
+            continue
+        primary_key = inspector.get_pk_constraint(table)['constrained_columns']
+        schema[table] = {
+            'columns': {c['name']: c['nullable'] and c['name'] not in primary_key
+                        for c in inspector.get_columns(table)},
+            'primary_key': primary_key,
+            'unique': sorted(tuple(u['column_names']) for u in inspector.get_unique_constraints(table)),
+            'foreign_keys': sorted((tuple(fk['constrained_columns']), fk['referred_table'])
+                                   for fk in inspector.get_foreign_keys(table)),
+            'indexes': sorted((i['name'], tuple(i['column_names'])) for i in inspector.get_indexes(table)
+                              if not i['name'].startswith('sqlite_autoindex')),
+        }
+    return schema
+
+
+@pytest.fixture
+def engine():
+    return create_engine('sqlite://')
+
+
+def test_migrations_match_models_and_schema_file(engine):
+    upgrade(engine)
+
+    models_engine = create_engine('sqlite://')
+    db.metadata.create_all(models_engine)
+
+    schema_file_engine = create_engine('sqlite://')
+    with open(SCHEMA_FILE) as schema_file:
+        schema_file_engine.raw_connection().executescript(schema_file.read())
+
+    migrated = describe_schema(engine)
+    assert migrated == describe_schema(models_engine)
+    assert migrated == describe_schema(schema_file_engine)
+
+
+def test_upgrade_is_idempotent(engine, caplog, capsys):
+    with caplog.at_level('INFO', logger='migrations'):
+        assert upgrade(engine) == [version for version, _, _ in MIGRATIONS]
+    assert len([record for record in caplog.records if record.name == 'migrations']) == len(MIGRATIONS)
+    assert capsys.readouterr().out == ''
+    assert upgrade(engine) == []
+    assert current_version(engine) == MIGRATIONS[-1][0]
+
+
+def test_upgrade_brings_first_release_database_to_models(engine):
+    engine.raw_connection().executescript(FIRST_RELEASE_SCHEMA)
+    upgrade(engine)
+
+    models_engine = create_engine('sqlite://')
+    db.metadata.create_all(models_engine)
+    assert describe_schema(engine) == describe_schema(models_engine)
+    assert current_version(engine) == MIGRATIONS[-1][0]
+    with engine.connect() as connection:
+        assert connection.execute(text(
+            "SELECT name, cluster_id, organization_id, priority, replicas FROM deployments")).all() == [
+            ('web', 1, None, 3, 1)]
+        # Allocations running at upgrade time start the utilization history
+        assert connection.execute(text("SELECT cluster_id, ram, cpu, gpu FROM utilization_events")).all() == [
+            (1, 4, 2, 0)]
+
+
+def test_upgrade_adopts_database_created_by_models(engine):
+    db.metadata.create_all(engine)
+    upgrade(engine)
+    assert current_version(engine) == MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize('query, index', [
+    # GET /deployments
+    ("SELECT id, name FROM deployments WHERE user_id = 1 AND id > 0 ORDER BY id LIMIT 100",
+     'ix_deployments_user_id'),
+    # GET /clusters
+    ("SELECT id, name FROM clusters WHERE organization_id = 1 ORDER BY id LIMIT 100",
+     'ix_clusters_organization_id'),
+    # Running deployments on a cluster (scheduler preemption)
+    ("SELECT id, priority FROM deployments WHERE cluster_id = 1 AND status = 'running'",
+     'ix_deployments_cluster_id_status'),
+    # Queued deployments in scheduling order
+    ("SELECT id FROM deployments WHERE status = 'queued' ORDER BY priority DESC, created_at",
+     'ix_deployments_status_priority_created_at'),
+])
+def test_hot_queries_use_indexes(engine, query, index):
+    upgrade(engine)
+    with engine.connect() as connection:
+        plan = ' '.join(row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {query}')))
+    assert index in plan
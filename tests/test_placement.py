@@ -0,0 +1,120 @@
+import pytest
+import numpy as np
+from placement import PlacementEngine, select_victims
+
+# Two clusters: a small CPU-only one and a larger one with GPUs
+TOTALS = [(16, 8, 0), (64, 32, 8)]
+
+
+def test_first_fit_uses_first_cluster_that_fits():
+    engine = PlacementEngine('first_fit')
+    assignments, _ = engine.place(
+        requests=[(8, 2, 0), (8, 2, 0), (8, 2, 0)],
+        allowed=np.ones((3, 2), dtype=bool),
+        free=TOTALS,
+        totals=TOTALS,
+    )
+    assert assignments.tolist() == [0, 0, 1]
+
+
+def test_best_fit_prefers_tightest_cluster():
+    engine = PlacementEngine('best_fit')
+    assignments, _ = engine.place(
+        requests=[(8, 2, 0)],
+        allowed=np.ones((1, 2), dtype=bool),
+        free=[(16, 8, 0), (10, 3, 0)],
+        totals=TOTALS,
+    )
+    assert assignments.tolist() == [1]
+
+
+def test_unfittable_and_disallowed_deployments_are_not_placed():
+    engine = PlacementEngine('first_fit')
+    assignments, _ = engine.place(
+        requests=[(8, 2, 16), (8, 2, 4)],
+        allowed=[[True, True], [True, False]],
+        free=TOTALS,
+        totals=TOTALS,
+    )
+    assert assignments.tolist() == [-1, -1]
+
+
+def test_drf_serves_user_with_lowest_dominant_share_first():
+    engine = PlacementEngine('drf')
+    # User 1 already holds half of all GPUs; user 2 holds nothing
+    assignments, _ = engine.place(
+        requests=[(8, 2, 4), (8, 2, 4)],
+        allowed=[[False, True], [False, True]],
+        free=[(16, 8, 0), (64, 32, 4)],
+        totals=TOTALS,
+        owners=[1, 2],
+        usage={1: (0, 0, 4)},
+    )
+    assert assignments.tolist() == [-1, 1]
+
+
+def test_backfill_holds_capacity_for_head_of_line():
+    engine = PlacementEngine('backfill')
+    assignments, reserved = engine.place(
+        requests=[(8, 2, 6), (4, 1, 2), (4, 1, 0)],
+        allowed=[[False, True]] * 3,
+        free=[(16, 8, 0), (64, 32, 4)],
+        totals=TOTALS,
+    )
+    # The 6-GPU job holds the 4 free GPUs, so the 2-GPU job cannot jump ahead
+    assert assignments.tolist() == [-1, -1, 1]
+    assert reserved[1].tolist() == [8, 2, 4]
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        PlacementEngine('random')
+
+
+def test_select_victims_prefers_lowest_priority_and_fewest_evictions():
+    victims = select_victims(
+        shortfall=(8, 2, 1),
+        held=[(4, 1, 0), (4, 1, 0), (8, 2, 1), (16, 4, 2)],
+        priorities=[1, 1, 2, 3],
+    )
+    # Priority 1 alone cannot cover the GPU, and one priority-2 deployment covers everything
+    assert victims == [2]
+
+
+def test_select_victims_when_shortfall_cannot_be_covered():
+    assert select_victims((0, 0, 0), [(4, 1, 0)], [1]) == []
+    assert select_victims((8, 2, 4), [(4, 1, 1)], [1]) is None
+
+
+def test_gang_prefers_one_cluster_and_spreads_all_or_nothing():
+    engine = PlacementEngine('first_fit')
+    splits = {}
+    assignments, _ = engine.place(
+        requests=[(8, 2, 1), (8, 2, 1), (8, 2, 1)],
+        allowed=np.ones((3, 2), dtype=bool),
+        free=[(64, 32, 4), (64, 32, 6)],
+        totals=[(64, 32, 4), (64, 32, 8)],
+        replicas=[5, 5, 2],
+        splits=splits,
+    )
+    # The first gang fits whole only on the second cluster; the second has to be spread over
+    # both, roomiest first; no GPUs are left for any replica of the last one
+    assert assignments.tolist() == [1, 0, -1]
+    assert splits == {0: {1: 5}, 1: {0: 4, 1: 1}}
+
+
+def test_gang_placement_cost_does_not_grow_with_gang_size():
+    engine = PlacementEngine('best_fit')
+    clusters = 50
+    splits = {}
+    assignments, _ = engine.place(
+        requests=[(1, 1, 1)],
+        allowed=np.ones((1, clusters), dtype=bool),
+        free=[(100, 100, 8)] * clusters,
+        totals=[(100, 100, 8)] * clusters,
+        replicas=[400],
+        splits=splits,
+    )
+    assert assignments[0] >= 0
+    assert sum(splits[0].values()) == 400
+    assert len(splits[0]) == 50
@@ -0,0 +1,188 @@
+import threading
+import pytest
+import redis
+from queue_backends import (
+    ALL_QUEUES, PRIORITY_STRIDE, InProcessQueue, RedisQueue, create_queue_backend, get_connection_pool,
+)
+
+
+def redis_available():
+    try:
+        return redis.Redis(connection_pool=get_connection_pool()).ping()
+    except redis.exceptions.ConnectionError:
+        return False
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def queue(request):
+    """Fixture yielding an empty queue of each backend; Redis is skipped without a server."""
+    if request.param == 'memory':
+        yield InProcessQueue()
+        return
+    if not redis_available():
+        pytest.skip('no Redis server')
+    backend = RedisQueue(name='test_deployment_queue')
+    keys = backend.redis.keys('test_deployment_queue*')
+    if keys:
+        backend.redis.delete(*keys)
+    yield backend
+    keys = backend.redis.keys('test_deployment_queue*')
+    if keys:
+        backend.redis.delete(*keys)
+
+
+def test_pop_orders_by_priority_then_fifo(queue):
+    """
+    Test that every backend pops higher priorities first and FIFO within a priority.
+    """
+    queue.enqueue([(1, 1, None), (2, 5, None), (3, 1, None), (4, 5, None)])
+    assert [deployment_id for deployment_id, _ in queue.pop(count=10)] == [2, 4, 1, 3]
+    assert queue.length() == 0
+
+
+def test_restore_keeps_place_in_line(queue):
+    """
+    Test that restored deployments go back ahead of those enqueued later.
+    """
+    queue.enqueue([(1, 1, 7), (2, 1, 7)])
+    popped = queue.pop(7)
+    queue.enqueue([(3, 1, 7)])
+    queue.restore(7, dict(popped))
+
+    assert [deployment_id for deployment_id, _ in queue.pop(7, 3)] == [1, 2, 3]
+    assert queue.cluster_ids() == [7]
+
+
+def test_requeue_uses_recorded_priority(queue):
+    """
+    Test that requeueing moves a deployment behind its priority band and ignores unknown ones.
+    """
+    queue.enqueue([(1, 5, None), (2, 5, None), (3, 1, None)])
+    assert queue.requeue(1) == 5
+    assert queue.requeue(99) is None
+    queue.forget(2)
+    assert queue.requeue(2) is None
+
+    assert [deployment_id for deployment_id, _ in queue.pop(count=3)] == [2, 1, 3]
+
+
+def test_wait_reports_freed_capacity_first(queue):
+    """
+    Test that waiting returns freed clusters before the enqueue wake-up, then times out.
+    """
+    queue.enqueue([(1, 1, None)])
+    queue.notify_freed(3)
+
+    assert queue.wait(timeout=1) == 3
+    assert queue.wait(timeout=1) == ALL_QUEUES
+    assert queue.wait(timeout=1) is None
+
+
+def test_in_process_queue_wakes_waiting_thread():
+    """
+    Test that an enqueue from another thread wakes a blocked waiter.
+    """
+    queue = InProcessQueue()
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(queue.wait(timeout=5)))
+    waiter.start()
+    queue.enqueue([(1, 1, None)])
+    waiter.join(timeout=5)
+
+    assert woken == [ALL_QUEUES]
+
+
+def test_in_process_queue_concurrent_pops_are_disjoint():
+    """
+    Test that concurrent pops never hand the same deployment to two threads.
+    """
+    queue = InProcessQueue()
+    queue.enqueue([(deployment_id, 1, None) for deployment_id in range(1000)])
+    popped = []
+
+    def drain():
+        while True:
+            batch = queue.pop(count=7)
+            if not batch:
+                return
+            popped.extend(deployment_id for deployment_id, _ in batch)
+
+    threads = [threading.Thread(target=drain) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(popped) == list(range(1000))
+
+
+def test_in_process_queue_persists_to_sqlite(tmp_path):
+    """
+    Test that a persisted queue reloads its deployments, priorities and sequence, and that
+    deployments popped but never acknowledged are back in line after a restart.
+    """
+    path = str(tmp_path / 'queue.db')
+    queue = InProcessQueue(path)
+    queue.enqueue([(1, 1, None), (2, 5, 4), (3, 5, 4), (5, 1, None)])
+    queue.ack(*[deployment_id for deployment_id, _ in queue.pop(4)])
+    queue.pop()
+
+    reloaded = InProcessQueue(path)
+    assert reloaded.length() == 2
+    assert reloaded.length(4) == 1
+    assert reloaded.pop() == [(1, -PRIORITY_STRIDE + 1)]
+    reloaded.ack(1)
+    assert reloaded.cluster_ids() == [4]
+    reloaded.enqueue([(4, 5, 4)])
+    assert reloaded.requeue(5) == 1
+    assert [deployment_id for deployment_id, _ in reloaded.pop(4, 2)] == [3, 4]
+
+
+def test_create_queue_backend_from_config():
+    """
+    Test that the backend is chosen by QUEUE_BACKEND and unknown names are rejected.
+    """
+    assert isinstance(create_queue_backend({'QUEUE_BACKEND': 'memory'}), InProcessQueue)
+    assert isinstance(create_queue_backend({'QUEUE_BACKEND': 'redis'}), RedisQueue)
+    with pytest.raises(ValueError):
+        create_queue_backend({'QUEUE_BACKEND': 'kafka'})
+
+
+def test_redis_queues_share_connection_pool():
+    """
+    Test that queues for the same Redis server reuse one connection pool.
+    """
+    assert get_connection_pool('localhost', 6379) is get_connection_pool('localhost', 6379)
+    assert get_connection_pool('localhost', 6379) is not get_connection_pool('localhost', 6380)
+
+
+def test_depth_by_priority(queue):
+    """
+    Test that queue depth is reported per priority.
+    """
+    queue.enqueue([(1, 1, None), (2, 5, None), (3, 5, None), (4, 0, None), (5, 12, None)])
+    queue.pop()
+
+    assert queue.depth_by_priority() == {0: 1, 1: 1, 5: 2}
+    assert queue.depth_by_priority(3) == {}
+
+
+def test_popped_deployments_are_leased_until_acknowledged(queue):
+    """
+    Test that popped deployments stay in flight until acknowledged or restored, and that
+    recover() puts back those whose lease expired at their original positions.
+    """
+    queue.enqueue([(1, 1, None), (2, 5, None), (3, 1, None), (4, 1, None)])
+    popped = dict(queue.pop(count=3))
+    assert queue.queued_ids() == {1, 2, 3, 4}
+
+    queue.ack(2)
+    queue.restore(None, {3: popped[3]})
+    assert queue.recover() == 0
+    assert queue.queued_ids() == {1, 3, 4}
+
+    queue.lease_seconds = -1
+    queue.renew([1])
+    assert queue.recover() == 1
+    assert queue.wait(timeout=1) == ALL_QUEUES
+    assert [deployment_id for deployment_id, _ in queue.pop(count=10)] == [1, 3, 4]
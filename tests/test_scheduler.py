@@ -1,5 +1,6 @@
 import pytest
-from scheduler import Scheduler
+from scheduler import Scheduler, ALL_QUEUES
+from queue_backends import InProcessQueue
 from models import db, Deployment, Cluster
 from app import app
 
@@ -12,7 +13,7 @@ def scheduler():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
     with app.app_context():
         db.create_all()
-        yield Scheduler()
+        yield Scheduler(queue=InProcessQueue())
 
 @pytest.fixture
 def sample_deployment(scheduler):
@@ -147,3 +148,589 @@ def test_requeue_deployment_by_priority(scheduler):
         # Verify higher priority deployment is dequeued first
         dequeued_id = scheduler.dequeue_deployment()
         assert dequeued_id == deployment_high.id
+
+def test_queue_orders_by_priority_then_fifo(scheduler):
+    """
+    Test that the queue pops higher priorities first and keeps FIFO order within a priority.
+    """
+    scheduler.enqueue_deployment(101, priority=1)
+    scheduler.enqueue_deployment(102, priority=3)
+    scheduler.enqueue_deployment(103, priority=1)
+    scheduler.enqueue_deployment(104, priority=3)
+
+    # Requeueing without a priority reuses the one recorded at enqueue time
+    assert scheduler.dequeue_deployment() == 102
+    scheduler.requeue_deployment_by_priority(102)
+
+    assert [scheduler.dequeue_deployment() for _ in range(4)] == [104, 102, 101, 103]
+    assert scheduler.get_queue_length() == 0
+
+def test_schedule_pass_terminates_with_unplaceable_deployments(scheduler, sample_deployment):
+    """
+    Test that a pass places what fits and leaves the rest queued instead of spinning.
+    """
+    with app.app_context():
+        blocked = Deployment(
+            name="BlockedDeployment",
+            user_id=1,
+            cluster_id=sample_deployment.cluster_id,
+            docker_image="testimage",
+            required_ram=100,
+            required_cpu=1,
+            required_gpu=0,
+            priority=5
+        )
+        db.session.add(blocked)
+        db.session.commit()
+
+        scheduler.enqueue_deployment(blocked.id, blocked.priority)
+        scheduler.enqueue_deployment(sample_deployment.id, sample_deployment.priority)
+
+        assert scheduler.schedule_deployments() == 1
+        assert scheduler.get_queue_length() == 1
+        assert scheduler.dequeue_deployment() == blocked.id
+
+def test_wait_for_work_wakes_on_enqueue(scheduler):
+    """
+    Test that the worker's blocking wait returns as soon as work is enqueued.
+    """
+    scheduler.enqueue_deployment(201)
+    scheduler.enqueue_deployment(202)
+    assert scheduler.wait_for_work(timeout=1)
+    # Wake-ups coalesce, so the second enqueue did not leave another token
+    assert not scheduler.wait_for_work(timeout=1)
+
+def test_schedule_deployments_per_cluster_queues(scheduler):
+    """
+    Test that a saturated cluster does not block placement on another cluster.
+    """
+    with app.app_context():
+        full = Cluster(name="FullCluster", total_ram=4, total_cpu=2, total_gpu=0,
+                       available_ram=0, available_cpu=0, available_gpu=0, organization_id=1)
+        free = Cluster(name="FreeCluster", total_ram=8, total_cpu=4, total_gpu=1,
+                       available_ram=8, available_cpu=4, available_gpu=1, organization_id=1)
+        db.session.add_all([full, free])
+        db.session.commit()
+
+        waiting = Deployment(name="Waiting", user_id=1, cluster_id=full.id, docker_image="testimage",
+                             required_ram=2, required_cpu=1, required_gpu=0, priority=5)
+        placed = [
+            Deployment(name=f"Placed{i}", user_id=1, cluster_id=free.id, docker_image="testimage",
+                       required_ram=4, required_cpu=2, required_gpu=0, priority=1)
+            for i in range(2)
+        ]
+        db.session.add_all([waiting] + placed)
+        db.session.commit()
+
+        for deployment in [waiting] + placed:
+            scheduler.enqueue_deployment(deployment.id, deployment.priority, deployment.cluster_id)
+        assert scheduler.get_queue_length(full.id) == 1
+        assert scheduler.get_queue_length(free.id) == 2
+
+        assert scheduler.schedule_deployments() == 2
+        assert scheduler.get_queue_length(full.id) == 1
+        assert scheduler.get_queue_length(free.id) == 0
+
+        db.session.expire_all()
+        assert Cluster.query.get(free.id).available_ram == 0
+        assert Deployment.query.get(waiting.id).status == 'queued'
+
+def test_reserve_and_release_resources(scheduler, sample_deployment):
+    """
+    Test that reservations never over-commit a cluster and releases happen once.
+    """
+    with app.app_context():
+        deployment = Deployment.query.get(sample_deployment.id)
+        deployment.required_ram = 6
+        db.session.commit()
+
+        assert scheduler.reserve_resources(deployment)
+        deployment.status = 'running'
+        db.session.commit()
+        # Only 4 RAM left, so a second reservation must be refused
+        assert not scheduler.reserve_resources(deployment)
+        assert Cluster.query.get(deployment.cluster_id).available_ram == 4
+
+        assert scheduler.release_resources(deployment, 'completed')
+        db.session.commit()
+        assert not scheduler.release_resources(deployment, 'completed')
+        db.session.commit()
+
+        db.session.expire_all()
+        assert Deployment.query.get(deployment.id).status == 'completed'
+        assert Cluster.query.get(deployment.cluster_id).available_ram == 10
+
+def test_freed_capacity_wakes_worker_for_that_cluster(scheduler):
+    """
+    Test that released capacity is reported ahead of new work, naming the freed cluster.
+    """
+    scheduler.enqueue_deployment(301, cluster_id=7)
+    scheduler.notify_capacity_freed(3)
+    assert scheduler.wait_for_work(timeout=1) == 3
+    assert scheduler.wait_for_work(timeout=1) == ALL_QUEUES
+    assert scheduler.wait_for_work(timeout=1) is None
+
+def test_schedule_deployments_in_batches(scheduler, sample_deployment):
+    """
+    Test that batched passes place in queue order across batches and report throughput.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        deployments = [
+            Deployment(name=f"Batch{i}", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                       required_ram=3, required_cpu=1, required_gpu=0, priority=1)
+            for i in range(5)
+        ]
+        db.session.add_all(deployments)
+        db.session.commit()
+        for deployment in deployments:
+            scheduler.enqueue_deployment(deployment.id, deployment.priority, cluster_id)
+
+        scheduler.batch_size = 2
+        # 10 RAM fits the first three 3-RAM deployments
+        assert scheduler.schedule_deployments() == 3
+        assert scheduler.last_pass['placed'] == 3
+        assert scheduler.last_pass['deployments_per_sec'] > 0
+        assert [scheduler.dequeue_deployment(cluster_id) for _ in range(2)] == [d.id for d in deployments[3:]]
+
+        db.session.expire_all()
+        assert [Deployment.query.get(d.id).status for d in deployments] == ['running'] * 3 + ['queued'] * 2
+        assert Cluster.query.get(cluster_id).available_ram == 1
+
+def test_schedule_deployment_on_any_cluster_in_organization(scheduler):
+    """
+    Test that a deployment without a cluster is placed on a cluster of its organization.
+    """
+    with app.app_context():
+        other_org = Cluster(name="OtherOrgCluster", total_ram=64, total_cpu=16, total_gpu=4,
+                            available_ram=64, available_cpu=16, available_gpu=4, organization_id=2)
+        small = Cluster(name="SmallCluster", total_ram=4, total_cpu=2, total_gpu=0,
+                        available_ram=4, available_cpu=2, available_gpu=0, organization_id=1)
+        large = Cluster(name="LargeCluster", total_ram=32, total_cpu=8, total_gpu=2,
+                        available_ram=32, available_cpu=8, available_gpu=2, organization_id=1)
+        db.session.add_all([other_org, small, large])
+        db.session.commit()
+
+        deployment = Deployment(name="AnyCluster", user_id=1, organization_id=1, docker_image="testimage",
+                                required_ram=8, required_cpu=2, required_gpu=1, priority=1)
+        db.session.add(deployment)
+        db.session.commit()
+
+        scheduler.enqueue_deployment(deployment.id, deployment.priority)
+        assert scheduler.schedule_deployments() == 1
+
+        db.session.expire_all()
+        placed = Deployment.query.get(deployment.id)
+        assert placed.status == 'running'
+        assert placed.cluster_id == large.id
+        assert Cluster.query.get(large.id).available_gpu == 1
+
+def test_preemption_evicts_lower_priority_deployments(scheduler, sample_deployment):
+    """
+    Test that a high-priority deployment evicts just enough lower-priority work and the victims are requeued.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        running = [
+            Deployment(name=f"Running{i}", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                       required_ram=5, required_cpu=1, required_gpu=0, priority=1 + i, status='running')
+            for i in range(2)
+        ]
+        urgent = Deployment(name="Urgent", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                            required_ram=4, required_cpu=1, required_gpu=0, priority=5)
+        db.session.add_all(running + [urgent])
+        Cluster.query.get(cluster_id).available_ram = 0
+        db.session.commit()
+
+        scheduler.enqueue_deployment(urgent.id, urgent.priority, cluster_id)
+        assert scheduler.schedule_deployments() == 0
+
+        scheduler.preemption = True
+        assert scheduler.schedule_deployments() == 1
+
+        db.session.expire_all()
+        assert Deployment.query.get(urgent.id).status == 'running'
+        assert Deployment.query.get(running[0].id).status == 'preempted'
+        assert Deployment.query.get(running[1].id).status == 'running'
+        assert Cluster.query.get(cluster_id).available_ram == 1
+        assert scheduler.dequeue_deployment(cluster_id) == running[0].id
+
+def test_requeue_keeps_recorded_priority(scheduler):
+    """
+    Test that requeueing without a priority uses the one recorded at enqueue time.
+    """
+    with app.app_context():
+        scheduler.enqueue_deployments([(1, 1, None), (2, 5, None), (3, 5, None)])
+        scheduler.requeue_deployment_by_priority(2)
+        scheduler.requeue_deployment_by_priority(99)
+
+        assert [scheduler.dequeue_deployment() for _ in range(3)] == [3, 2, 1]
+        assert scheduler.get_queue_length() == 0
+
+def test_scheduling_records_metrics(scheduler, sample_deployment):
+    """
+    Test that placements, time-to-placement and requeues are counted.
+    """
+    from scheduler import PLACEMENTS, REQUEUES, TIME_TO_PLACEMENT_SECONDS
+    with app.app_context():
+        placements = PLACEMENTS.value()
+        waits = TIME_TO_PLACEMENT_SECONDS.count()
+        requeues = REQUEUES.value(reason='requeue')
+
+        scheduler.enqueue_deployment(sample_deployment.id, 1, sample_deployment.cluster_id)
+        scheduler.requeue_deployment_by_priority(sample_deployment.id, cluster_id=sample_deployment.cluster_id)
+        assert scheduler.queue_depth_by_priority() == {1: 1}
+        assert scheduler.schedule_deployments() == 1
+
+        assert PLACEMENTS.value() == placements + 1
+        assert TIME_TO_PLACEMENT_SECONDS.count() == waits + 1
+        assert REQUEUES.value(reason='requeue') == requeues + 1
+        assert scheduler.queue_depth_by_priority() == {}
+
+def test_capacity_index_tracks_reservations(scheduler, sample_deployment):
+    """
+    Test that the capacity index follows placements and releases, and recovers from stale entries.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 1
+        assert scheduler.capacity.get_many([cluster_id])[cluster_id].available_ram == 8
+
+        deployment = Deployment.query.get(sample_deployment.id)
+        scheduler.release_resources(deployment, 'completed')
+        db.session.commit()
+        assert scheduler.capacity.get_many([cluster_id])[cluster_id].available_ram == 10
+
+        # Capacity taken behind the index's back: the reservation fails and refreshes the entry
+        Cluster.query.get(cluster_id).available_ram = 1
+        db.session.commit()
+        retry = Deployment(name="Retry", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                           required_ram=2, required_cpu=1, required_gpu=0, priority=1)
+        db.session.add(retry)
+        db.session.commit()
+        scheduler.enqueue_deployment(retry.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 0
+        assert scheduler.capacity.get_many([cluster_id])[cluster_id].available_ram == 1
+        assert scheduler.get_queue_length(cluster_id) == 1
+
+        assert scheduler.reconcile_capacity() == []
+
+def test_status_changes_are_published(scheduler, sample_deployment):
+    """
+    Test that placements, failures and preemptions are published after they are committed.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        subscription = scheduler.events.subscribe(1)
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 1
+        assert subscription.get(1) == (sample_deployment.id, 1, 'running', cluster_id)
+
+        orphan = Deployment(name="Orphan", user_id=1, cluster_id=999, docker_image="testimage",
+                            required_ram=1, required_cpu=1, required_gpu=0, priority=1)
+        urgent = Deployment(name="Urgent", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                            required_ram=10, required_cpu=1, required_gpu=0, priority=5)
+        db.session.add_all([orphan, urgent])
+        db.session.commit()
+        scheduler.enqueue_deployment(orphan.id, 1, 999)
+        assert scheduler.schedule_deployments() == 0
+        assert subscription.get(1) == (orphan.id, 1, 'failed', 999)
+
+        scheduler.preemption = True
+        scheduler.enqueue_deployment(urgent.id, 5, cluster_id)
+        assert scheduler.schedule_deployments() == 1
+        assert [subscription.get(1), subscription.get(1)] == [
+            (sample_deployment.id, 1, 'preempted', cluster_id), (urgent.id, 1, 'running', cluster_id)]
+        assert subscription.get(0.01) is None
+
+def test_gang_is_placed_across_clusters_all_or_nothing(scheduler):
+    """
+    Test that a gang spans clusters in its organization when it must, waits while it cannot fit
+    whole, and releases every replica's resources together.
+    """
+    with app.app_context():
+        clusters = [Cluster(name=f"Gang{i}", total_ram=16, total_cpu=8, total_gpu=4, available_ram=16,
+                            available_cpu=8, available_gpu=4, organization_id=1) for i in range(2)]
+        db.session.add_all(clusters)
+        db.session.commit()
+        big = Deployment(name="Big", user_id=1, organization_id=1, docker_image="trainer",
+                         required_ram=2, required_cpu=1, required_gpu=1, priority=1, replicas=9)
+        gang = Deployment(name="Gang", user_id=1, organization_id=1, docker_image="trainer",
+                          required_ram=2, required_cpu=1, required_gpu=1, priority=1, replicas=6)
+        db.session.add_all([big, gang])
+        db.session.commit()
+
+        # Nine GPUs are needed and only eight exist: nothing is taken
+        scheduler.enqueue_deployment(big.id, 1)
+        assert scheduler.schedule_deployments() == 0
+        assert [c.available_gpu for c in Cluster.query.order_by(Cluster.id)] == [4, 4]
+        db.session.get(Deployment, big.id).status = 'stopped'
+        db.session.commit()
+
+        scheduler.enqueue_deployment(gang.id, 1)
+        assert scheduler.schedule_deployments() == 1
+        db.session.expire_all()
+        deployment = db.session.get(Deployment, gang.id)
+        assert deployment.status == 'running'
+        assert scheduler.placement_split(deployment) == {clusters[0].id: 4, clusters[1].id: 2}
+        assert [c.available_gpu for c in Cluster.query.order_by(Cluster.id)] == [0, 2]
+        assert [c.available_gpu for c in scheduler.capacity.all()] == [0, 2]
+
+        assert sorted(scheduler.release_resources(deployment, 'completed')) == [clusters[0].id, clusters[1].id]
+        db.session.commit()
+        assert [c.available_gpu for c in Cluster.query.order_by(Cluster.id)] == [4, 4]
+        assert scheduler.placement_split(deployment) == {}
+
+def test_gang_reservation_conflict_returns_partial_reservations(scheduler):
+    """
+    Test that a gang whose second cluster was taken behind the index's back keeps nothing.
+    """
+    with app.app_context():
+        clusters = [Cluster(name=f"Stale{i}", total_ram=16, total_cpu=8, total_gpu=4, available_ram=16,
+                            available_cpu=8, available_gpu=4, organization_id=1) for i in range(2)]
+        db.session.add_all(clusters)
+        gang = Deployment(name="Gang", user_id=1, organization_id=1, docker_image="trainer",
+                          required_ram=2, required_cpu=1, required_gpu=1, priority=1, replicas=6)
+        db.session.add(gang)
+        db.session.commit()
+        scheduler.reconcile_capacity()
+        clusters[1].available_gpu = 1
+        db.session.commit()
+
+        scheduler.enqueue_deployment(gang.id, 1)
+        assert scheduler.schedule_deployments() == 0
+        db.session.expire_all()
+        assert db.session.get(Deployment, gang.id).status == 'queued'
+        assert [c.available_gpu for c in Cluster.query.order_by(Cluster.id)] == [4, 1]
+        assert scheduler.get_queue_length() == 1
+        assert scheduler.reconcile_capacity() == []
+
+def test_admission_rejects_infeasible_and_over_quota(scheduler, sample_deployment):
+    """
+    Test that submissions that can never fit, or exceed the organization's quota, are rejected
+    before they are queued, and that usage is rebuilt from the database and released on completion.
+    """
+    from admission import Quota
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.quotas = {'default': Quota(ram=8)}
+
+        def spec(**fields):
+            values = {'cluster_id': cluster_id, 'organization_id': None, 'required_ram': 2, 'required_cpu': 1,
+                      'required_gpu': 0, 'priority': 1, 'replicas': 1}
+            values.update(fields)
+            return values
+
+        admissions = scheduler.admit([
+            spec(required_gpu=3),
+            spec(cluster_id=999),
+            spec(cluster_id=None, organization_id=1, replicas=6),
+            spec(cluster_id=None, organization_id=2),
+            spec(required_ram=4),
+            spec(required_ram=4),
+        ])
+        assert [(a.reason, a.message) for a in admissions[:4]] == [
+            ('infeasible', "Requested resources exceed the cluster's total capacity!"),
+            ('infeasible', 'Cluster not found!'),
+            ('infeasible', "Requested resources exceed the total capacity of the organization's clusters!"),
+            ('infeasible', 'No clusters in the organization!'),
+        ]
+        # The queued sample deployment already holds 2 of the 8 RAM allowed
+        assert [(a.reason, a.estimate) for a in admissions[4:]] == [(None, 0.0), ('quota', None)]
+        assert scheduler.usage.usage(1) == (6, 2, 0, 2)
+
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 1
+        scheduler.release_resources(db.session.get(Deployment, sample_deployment.id), 'completed')
+        db.session.commit()
+        assert scheduler.usage.usage(1) == (4, 1, 0, 1)
+
+
+def test_admission_estimates_start_from_queue_ahead(scheduler, sample_deployment):
+    """
+    Test that the estimated start counts the deployments of equal or higher priority queued ahead.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.enqueue_deployments([(100, 3, cluster_id), (101, 1, cluster_id)])
+        spec = {'cluster_id': cluster_id, 'organization_id': None, 'required_ram': 2, 'required_cpu': 1,
+                'required_gpu': 0, 'priority': 2, 'replicas': 1}
+
+        assert [a.estimate for a in scheduler.admit([spec])] == [None]
+        scheduler.usage.record_placements(300)
+        # One deployment per second: one ahead of the first spec, two ahead of the second
+        assert [a.estimate for a in scheduler.admit([spec, spec])] == [2.0, 3.0]
+
+
+def test_expired_leases_are_recovered_and_placed(scheduler, sample_deployment):
+    """
+    Test that a deployment popped by a worker that died before committing is put back in line
+    once its lease expires, and then placed.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        # A worker pops the deployment and dies
+        assert scheduler.queue.pop(cluster_id) != []
+        assert scheduler.schedule_deployments() == 0
+        assert scheduler.recover_queue() == 0
+
+        scheduler.queue.lease_seconds = 0
+        scheduler.queue.renew([sample_deployment.id])
+        assert scheduler.recover_queue() == 1
+        assert scheduler.schedule_deployments() == 1
+        assert scheduler.queue.queued_ids() == set()
+
+
+def test_reconcile_queue_rebuilds_from_database(scheduler, sample_deployment):
+    """
+    Test that queued and preempted deployments missing from the queue are enqueued again, in
+    priority order and in the queue they target, without duplicating those still queued.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        anywhere = Deployment(name="Anywhere", user_id=1, organization_id=1, docker_image="testimage",
+                              required_ram=1, required_cpu=1, required_gpu=0, priority=3, status='preempted')
+        urgent = Deployment(name="Urgent", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                            required_ram=1, required_cpu=1, required_gpu=0, priority=5)
+        done = Deployment(name="Done", user_id=1, cluster_id=cluster_id, docker_image="testimage",
+                          required_ram=1, required_cpu=1, required_gpu=0, priority=5, status='completed')
+        db.session.add_all([anywhere, urgent, done])
+        db.session.commit()
+        scheduler.enqueue_deployment(urgent.id, 5, cluster_id)
+
+        assert scheduler.reconcile_queue(chunk_size=1) == 2
+        assert scheduler.reconcile_queue() == 0
+        assert [deployment_id for deployment_id, _ in scheduler.queue.pop(cluster_id, 10)] == [
+            urgent.id, sample_deployment.id]
+        assert [deployment_id for deployment_id, _ in scheduler.queue.pop(None, 10)] == [anywhere.id]
+
+
+def test_redelivered_deployment_is_placed_once(scheduler, sample_deployment, monkeypatch):
+    """
+    Test that a deployment placed by another worker while this one was deciding is dropped
+    and its reservation handed back.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        place = scheduler.placement.place
+
+        def place_after_other_worker(**arguments):
+            # The other worker commits its placement after this batch loaded the deployment
+            db.session.execute(Deployment.__table__.update().where(Deployment.id == sample_deployment.id)
+                               .values(status='running'))
+            return place(**arguments)
+        monkeypatch.setattr(scheduler.placement, 'place', place_after_other_worker)
+
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 0
+        db.session.expire_all()
+        assert db.session.get(Cluster, cluster_id).available_ram == 10
+        assert scheduler.capacity.get_many([cluster_id])[cluster_id].available_ram == 10
+        assert scheduler.queue.queued_ids() == set()
+
+
+def test_utilization_history_is_rolled_up_and_queried(scheduler, sample_deployment):
+    """
+    Test that placing and releasing a deployment logs allocation events, and that queries give
+    the same result from raw events and from rollups, which are written once.
+    """
+    from models import UtilizationEvent
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        assert scheduler.schedule_deployments() == 1
+        scheduler.release_resources(db.session.get(Deployment, sample_deployment.id), 'completed')
+        db.session.commit()
+        events = db.session.query(UtilizationEvent).order_by(UtilizationEvent.id).all()
+        assert [(event.ram, event.cpu, event.gpu) for event in events] == [(2, 1, 0), (-2, -1, 0)]
+        # Placed at 1000 and completed at 1600
+        for event, ts in zip(events, (1000, 1600)):
+            event.ts = ts
+        db.session.commit()
+
+        def allocated(step):
+            seconds, covered = scheduler.cluster_utilization(cluster_id, 0, 7200, step, now=5000)
+            return seconds.sum(axis=0).tolist(), covered.sum()
+
+        assert allocated(3600) == ([1200, 600, 0], 5000)
+        assert scheduler.roll_up_utilization(now=2000) == 2
+        assert scheduler.roll_up_utilization(now=2000) == 0
+        assert scheduler.roll_up_utilization(now=3000) == 0
+        assert allocated(3600) == ([1200, 600, 0], 5000)
+        assert allocated(60) == ([1200, 600, 0], 5000)
+
+
+def test_worker_survives_failed_iteration(scheduler, monkeypatch):
+    """
+    Test that an error in a scheduling pass is logged and the worker carries on with the next pass.
+    """
+    from sqlalchemy.exc import OperationalError
+
+    class StopWorker(BaseException):
+        pass
+
+    calls = []
+
+    def handle_wakeup(woken):
+        calls.append(woken)
+        if len(calls) == 1:
+            raise OperationalError('UPDATE clusters', {}, Exception('database is locked'))
+        raise StopWorker
+    monkeypatch.setattr(scheduler, 'handle_wakeup', handle_wakeup)
+
+    with app.app_context():
+        with pytest.raises(StopWorker):
+            scheduler.run_worker(poll_timeout=0)
+    assert calls == [ALL_QUEUES, ALL_QUEUES]
+
+
+def test_failed_pass_restores_its_deployments(scheduler, sample_deployment, monkeypatch):
+    """
+    Test that the deployments a failed pass holds are back in line at once, not after their lease expires.
+    """
+    from sqlalchemy.exc import OperationalError
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        scheduler.enqueue_deployment(sample_deployment.id, 1, cluster_id)
+        schedule_batch = scheduler._schedule_batch
+
+        def locked(popped, deferred, reservations, organization_id):
+            raise OperationalError('UPDATE clusters', {}, Exception('database is locked'))
+        monkeypatch.setattr(scheduler, '_schedule_batch', locked)
+        with pytest.raises(OperationalError):
+            scheduler.schedule_queue(cluster_id)
+        assert scheduler.get_queue_length(cluster_id) == 1
+
+        monkeypatch.setattr(scheduler, '_schedule_batch', schedule_batch)
+        assert scheduler.schedule_deployments() == 1
+        assert scheduler.recover_queue() == 0
+
+
+def test_freed_capacity_schedules_organization_wide_deployments(scheduler, sample_deployment):
+    """
+    Test that capacity freed on a cluster is offered to organization-wide deployments of the
+    cluster's organization at once, passing over other organizations' deployments.
+    """
+    with app.app_context():
+        cluster_id = sample_deployment.cluster_id
+        holder = db.session.get(Deployment, sample_deployment.id)
+        holder.status = 'running'
+        cluster = db.session.get(Cluster, cluster_id)
+        cluster.available_ram, cluster.available_cpu, cluster.available_gpu = 0, 0, 0
+        ours = Deployment(name="Ours", user_id=1, organization_id=1, docker_image="testimage",
+                          required_ram=2, required_cpu=1, required_gpu=0)
+        theirs = Deployment(name="Theirs", user_id=2, organization_id=2, docker_image="testimage",
+                            required_ram=2, required_cpu=1, required_gpu=0, priority=5)
+        db.session.add_all([ours, theirs])
+        db.session.commit()
+        scheduler.enqueue_deployments([(theirs.id, 5, None), (ours.id, 1, None)])
+
+        scheduler.release_resources(holder, 'completed')
+        db.session.commit()
+        assert scheduler.handle_wakeup(cluster_id) == 1
+        db.session.expire_all()
+        assert db.session.get(Deployment, ours.id).status == 'running'
+        assert db.session.get(Deployment, theirs.id).status == 'queued'
+        assert [deployment_id for deployment_id, _ in scheduler.queue.pop(None, 10)] == [theirs.id]
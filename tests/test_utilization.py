@@ -0,0 +1,63 @@
+import random
+import numpy as np
+from utilization import Rollup, allocated_seconds, resolution_for, roll_up
+
+
+def integrate(events, start, end, step, now):
+    """Integrates allocation per step directly from (ts, ram, cpu, gpu) events, second by second."""
+    level = np.zeros(3, dtype=np.int64)
+    seconds = np.zeros(((end - start) // step, 3), dtype=np.int64)
+    pending = sorted(events)
+    for second in range(min(events)[0], min(end, now)):
+        while pending and pending[0][0] <= second:
+            level += pending.pop(0)[1:]
+        if second >= start:
+            seconds[(second - start) // step] += level
+    return seconds
+
+
+def test_roll_up_continues_latest_bucket():
+    """
+    Test that events are folded into bucket integrals and levels, continuing the latest rollup.
+    """
+    rollups = roll_up([(10, 4, 1, 0), (30, 2, 1, 1)], None, 60)
+    assert rollups == [Rollup(0, (80, 20, 0), (6, 2, 1), 30)]
+
+    rollups = roll_up([(50, -6, -2, -1), (130, 1, 0, 0)], rollups[0], 60)
+    assert rollups == [Rollup(0, (200, 60, 20), (0, 0, 0), 50), Rollup(120, (0, 0, 0), (1, 0, 0), 130)]
+
+
+def test_resolution_for():
+    assert resolution_for(60) == 60
+    assert resolution_for(7200) == 3600
+    assert resolution_for(7 * 86400) == 86400
+    assert resolution_for(90) is None
+
+
+def test_allocated_seconds_matches_raw_events():
+    """
+    Test that integrating rollups, built in two passes, matches integrating the raw events,
+    at every resolution, with a window starting after the first events and ending after now.
+    """
+    rng = random.Random(7)
+    now = 2 * 86400 + 1234
+    events = []
+    level = [0, 0, 0]
+    for ts in sorted(rng.sample(range(0, now), 300)):
+        change = [rng.randint(-amount, 8) for amount in level]
+        level = [amount + delta for amount, delta in zip(level, change)]
+        events.append((ts, *change))
+    start, end = 86400, 3 * 86400
+
+    for resolution, step in ((60, 600), (3600, 7200), (86400, 86400)):
+        first = roll_up(events[:150], None, resolution)
+        second = roll_up(events[150:], first[-1], resolution)
+        rollups = {rollup.bucket: rollup for rollup in first + second}
+        in_window = [rollups[bucket] for bucket in sorted(rollups) if start <= bucket < end]
+        before = [rollups[bucket] for bucket in sorted(rollups) if bucket < start]
+        start_level = before[-1].level if before else (0, 0, 0)
+
+        seconds, covered = allocated_seconds(in_window, start_level, start, end, resolution, step, now)
+
+        assert (seconds == integrate(events, start, end, step, now)).all()
+        assert covered.sum() == now - start
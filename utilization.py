@@ -0,0 +1,98 @@
+from collections import namedtuple
+import numpy as np
+
+# Widths, in seconds, of the buckets allocation events are rolled up into. Queries
+# read the widest resolution that divides their step.
+RESOLUTIONS = (60, 3600, 86400)
+
+# Most points one utilization query may return
+MAX_POINTS = 1000
+
+# Events are rolled up only once they are this old, so transactions still committing
+# when a roll-up starts are not skipped; newer events are read raw by queries
+ROLLUP_DELAY_SECONDS = 10
+
+# One cluster's allocation over one bucket: integral holds the (ram, cpu, gpu)
+# resource-seconds allocated from the bucket's start up to last_ts, the time of its
+# last event, and level what was allocated after that event. Until the next bucket
+# with events, allocation stays at level.
+Rollup = namedtuple('Rollup', ['bucket', 'integral', 'level', 'last_ts'])
+
+
+def rollup_from_row(row):
+    """Builds a Rollup from a UtilizationRollup instance or a row with the same columns."""
+    return Rollup(row.bucket, (row.integral_ram, row.integral_cpu, row.integral_gpu),
+                  (row.level_ram, row.level_cpu, row.level_gpu), row.last_ts)
+
+
+def rollup_values(cluster_id, resolution, rollup):
+    """Returns the UtilizationRollup column values of a cluster's Rollup at the given resolution."""
+    (integral_ram, integral_cpu, integral_gpu), (level_ram, level_cpu, level_gpu) = rollup.integral, rollup.level
+    return dict(cluster_id=cluster_id, resolution=resolution, bucket=rollup.bucket,
+                integral_ram=integral_ram, integral_cpu=integral_cpu, integral_gpu=integral_gpu,
+                level_ram=level_ram, level_cpu=level_cpu, level_gpu=level_gpu, last_ts=rollup.last_ts)
+
+
+def roll_up(events, latest, resolution):
+    """
+    Folds (ts, ram, cpu, gpu) allocation events, sorted by time and no older than
+    latest.last_ts, into buckets of the given resolution, continuing from latest,
+    the cluster's most recent Rollup (None if it has none). Returns the Rollups of
+    every bucket with events, in order; the first replaces latest if they share a bucket.
+    """
+    rollups = []
+    current = latest
+    level = latest.level if latest is not None else (0, 0, 0)
+    for ts, *change in events:
+        bucket = ts - ts % resolution
+        if current is not None and current.bucket == bucket:
+            integral = tuple(total + amount * (ts - current.last_ts)
+                             for total, amount in zip(current.integral, level))
+        else:
+            integral = tuple(amount * (ts - bucket) for amount in level)
+        level = tuple(amount + delta for amount, delta in zip(level, change))
+        current = Rollup(bucket, integral, level, ts)
+        if rollups and rollups[-1].bucket == bucket:
+            rollups[-1] = current
+        else:
+            rollups.append(current)
+    return rollups
+
+
+def resolution_for(step):
+    """Returns the widest resolution dividing step (seconds), or None if none does."""
+    fitting = [resolution for resolution in RESOLUTIONS if step % resolution == 0]
+    return max(fitting) if fitting else None
+
+
+def allocated_seconds(rollups, start_level, start, end, resolution, step, now):
+    """
+    Integrates allocation over [start, end) in steps of step seconds, both multiples
+    of resolution, from the Rollups of buckets in that range and start_level, the
+    allocation at start. Time after now is not counted. Returns an array of
+    (ram, cpu, gpu) resource-seconds per step and an array of the seconds each covers.
+    """
+    count = (end - start) // resolution
+    bucket_starts = start + np.arange(count, dtype=np.int64) * resolution
+    covered = np.clip(np.minimum(bucket_starts + resolution, now) - bucket_starts, 0, resolution)
+
+    has_rollup = np.zeros(count, dtype=bool)
+    integral = np.zeros((count, 3), dtype=np.int64)
+    level = np.zeros((count, 3), dtype=np.int64)
+    last_ts = np.zeros(count, dtype=np.int64)
+    if rollups:
+        index = (np.array([rollup.bucket for rollup in rollups], dtype=np.int64) - start) // resolution
+        has_rollup[index] = True
+        integral[index] = [rollup.integral for rollup in rollups]
+        level[index] = [rollup.level for rollup in rollups]
+        last_ts[index] = [rollup.last_ts for rollup in rollups]
+
+    # Buckets without events keep the level of the last bucket with one
+    last_with_rollup = np.maximum.accumulate(np.where(has_rollup, np.arange(count), -1))
+    level = np.where((last_with_rollup >= 0)[:, None], level[last_with_rollup],
+                     np.asarray(start_level, dtype=np.int64))
+    tail = np.clip(bucket_starts + covered - last_ts, 0, None)
+    seconds = np.where(has_rollup[:, None], integral + level * tail[:, None], level * covered[:, None])
+
+    per_step = step // resolution
+    return seconds.reshape(-1, per_step, 3).sum(axis=1), covered.reshape(-1, per_step).sum(axis=1)
@@ -1,8 +1,100 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask import request, jsonify, current_app, g
 from functools import wraps
+from collections import OrderedDict, namedtuple
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+import hashlib
+import hmac
+import os
+import threading
+import time
 import uuid
 
+
+class CredentialCache:
+    """
+    Bounded, TTL-evicting cache of verified credentials, so repeat requests skip
+    the password KDF. Entries map a username to an HMAC digest of the password
+    (keyed per process, never the password itself), the user ID and the password
+    hash it was verified against; a changed password hash invalidates the entry.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, f'{username}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def lookup(self, username, password):
+        """Returns (user_id, password_hash) if these credentials were verified recently, else None."""
+        digest = self._digest(username, password)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[3] < time.monotonic() or not hmac.compare_digest(entry[0], digest):
+                return None
+            self._entries.move_to_end(username)
+            return entry[1], entry[2]
+
+    def store(self, username, password, user_id, password_hash):
+        """Remembers verified credentials, evicting the least recently used entry when full."""
+        entry = (self._digest(username, password), user_id, password_hash, time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[username] = entry
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """Forgets any cached credentials for a user, e.g. after a password change."""
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def record(self, hit):
+        """Counts a cache hit or miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Returns the hit and miss counters and the current number of entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+credential_cache = CredentialCache()
+
+
+def verify_credentials(username, password):
+    """
+    Returns the user for a username and password, or None if they do not match.
+    Credentials verified recently are served from credential_cache with a
+    primary-key lookup instead of a password hash check.
+    """
+    from models import db, User
+    cached = credential_cache.lookup(username, password)
+    if cached:
+        user_id, password_hash = cached
+        user = db.session.get(User, user_id)
+        if user and user.password == password_hash:
+            credential_cache.record(hit=True)
+            return user
+        credential_cache.invalidate(username)
+    credential_cache.record(hit=False)
+
+    user = User.query.filter_by(username=username).first()
+    if user and user.verify_password(password):
+        credential_cache.store(username, password, user.id, user.password)
+        return user
+    return None
+
+
 # Basic Authentication Decorator
 def basic_auth(f):
     @wraps(f)
@@ -15,14 +107,38 @@ def basic_auth(f):
 
 def authenticate(username, password):
     """Authenticates a user based on username and password."""
-    from models import User
-    with current_app.app_context():
-        user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
-            g.current_user = user
-            return True
+    user = verify_credentials(username, password)
+    if user:
+        g.current_user = user
+        return True
     return False
 
+# What a bearer token vouches for; enough for the routes without loading the user row
+TokenUser = namedtuple('TokenUser', ['id', 'username', 'organization_id'])
+
+
+def _token_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='auth-token')
+
+
+def generate_auth_token(user):
+    """Returns a signed bearer token for the user, valid for AUTH_TOKEN_TTL seconds."""
+    return _token_serializer().dumps([user.id, user.username, user.organization_id])
+
+
+def verify_auth_token(token):
+    """
+    Returns a TokenUser for a valid, unexpired bearer token, or None.
+    Only the HMAC signature and timestamp are checked, so no database query is needed.
+    """
+    try:
+        user_id, username, organization_id = _token_serializer().loads(
+            token, max_age=current_app.config['AUTH_TOKEN_TTL'])
+    except (BadSignature, ValueError, TypeError):
+        return None
+    return TokenUser(user_id, username, organization_id)
+
+
 def generate_invite_code():
     """Generates a unique invite code."""
     return str(uuid.uuid4())